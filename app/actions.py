@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+from app import events
+
+"""
+    Vectorized actions, applied to every masked row of a column at once (see app/events.py for the masks)
+"""
+
+
+def substitute(values: pd.Series, mask: np.ndarray, reference: Optional[pd.Series] = None, lookback: Optional[str] = '1min') -> tuple[pd.Series, dict[str, int]]:
+    """
+    Substitution rules (as IrradianceProcessor._substitute, for all masked rows at once):
+    - Masked rows take the reference value (already aligned to the values) if it exists and is not zero
+    - Otherwise they take the value at t - lookback (or the previous row, if no lookback), as it is after its own substitution
+    - Rows where that value does not exist or is missing are left missing
+
+    Also returns how many rows came from each source (reference, previous and unfilled)
+    Obs.: the reference keeps the value when the reference value is zero and copies it when it is missing, here both take the previous value
+    """
+    previous = events.preceding(values.index, lookback)
+    array, counts = substitute_array(values.to_numpy(dtype=float), mask, reference.to_numpy(dtype=float) if reference is not None else None, previous)
+    return pd.Series(array, index=values.index, name=values.name), counts
+
+
+def substitute_array(values: np.ndarray, mask: np.ndarray, reference: Optional[np.ndarray] = None, previous: Optional[np.ndarray] = None) -> tuple[np.ndarray, dict[str, int]]:
+    """ Same as substitute, on arrays (values is not modified), previous holds the position of the previous value of each row (-1 if none, the previous row if None) """
+    array = values.astype(float, copy=True)
+    from_reference = np.zeros_like(mask)
+    if reference is not None:
+        from_reference = mask & ~np.isnan(reference) & (reference != 0)
+
+    from_previous = mask & ~from_reference
+    positions = np.arange(len(array))
+    if previous is None: previous = positions - 1
+    chained = from_previous & (previous == positions - 1)
+    if not (from_previous & ~chained & (previous >= 0)).any():
+        if reference is not None: array[from_reference] = reference[from_reference]
+        array[from_previous & ~chained] = np.nan
+        # Consecutive rows taking the previous value all take the value before them
+        sources = np.where(chained, 0, positions)
+        np.maximum.accumulate(sources, out=sources)
+        array[chained] = array[sources[chained]]
+    else:
+        # Irregular index, substituted one row at a time in index order as the reference does
+        for position in np.flatnonzero(mask).tolist():
+            if from_reference[position]: array[position] = reference[position]
+            else: array[position] = array[previous[position]] if previous[position] >= 0 else np.nan
+
+    unfilled = int(np.isnan(array[from_previous]).sum())
+    counts = {
+        'reference': int(from_reference.sum()),
+        'previous': int(from_previous.sum()) - unfilled,
+        'unfilled': unfilled,
+    }
+    return array, counts
+
+
+def interpolate(array: np.ndarray) -> np.ndarray:
+    """ Each missing value takes the straight line between the values around it, by position (missing values at the edges take the nearest value) """
+    missing = np.isnan(array)
+    if missing.all(): return array.copy()
+    positions = np.arange(len(array))
+    interpolated = array.copy()
+    interpolated[missing] = np.interp(positions[missing], positions[~missing], array[~missing])
+    return interpolated
@@ -0,0 +1,55 @@
+import itertools
+import pandas as pd
+from typing import BinaryIO, Iterator
+
+from app.config import CHUNK_SIZE
+from app.io_functions import FileType, IoArgs, scan_csv
+from app.pipeline import Pipeline
+from app.planner import pushdown
+
+"""
+    Chunked execution mode, used for files too big to be loaded at once
+
+    The file is read chunk_size rows at a time and every chunk goes through the whole pipeline before the next one is read,
+    so peak memory is bounded by the chunk size instead of the file size.
+    Only row local operations (__row_local__, which give the same result whether they run on all rows or chunk by chunk) are accepted.
+    Filters and projections the pipeline starts with are run by the reader (see planner.pushdown), so skipped columns are never decoded.
+"""
+
+
+def validate_chunked(pipeline: Pipeline):
+    """ Rejects pipelines with operations that need all rows at once (e.g. sorts, duplicates, resamples) """
+    codes = [op.__code__ for op in pipeline.operations if not op.__row_local__]
+    if len(codes):
+        raise ValueError(f'operations {", ".join(codes)} need all rows at once and cannot run in chunked mode')
+
+
+def run_chunked(source: BinaryIO | str, rules: IoArgs, pipeline: Pipeline, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Validation and the first chunk happen right away, the other chunks are only read as the result is iterated
+    Obs.: errors the data causes (e.g. a missing column) are raised here, before a streamed response starts
+    """
+    validate_chunked(pipeline)
+    if rules.file_type != FileType.CSV:
+        raise ValueError('chunked mode only reads CSV files')
+
+    chunks = _run_chunks(source, rules, pipeline, chunk_size)
+    first = next(chunks, None)
+    if first is None: return iter(())
+    return itertools.chain([first], chunks)
+
+
+def _run_chunks(source: BinaryIO | str, rules: IoArgs, pipeline: Pipeline, chunk_size: int) -> Iterator[pd.DataFrame]:
+    scan, pushed = pushdown(pipeline.operations)
+    remaining = pipeline.skip(pushed)
+    for chunk in scan_csv(source, rules, scan, chunk_size):
+        yield remaining(chunk)
+
+
+def write_chunked(source: BinaryIO | str, target: str, rules: IoArgs, pipeline: Pipeline, chunk_size: int = CHUNK_SIZE) -> int:
+    """ Writes each processed chunk to a CSV file as soon as it is ready, returns the number of rows written """
+    rows = 0
+    for i, chunk in enumerate(run_chunked(source, rules, pipeline, chunk_size)):
+        chunk.to_csv(target, mode='w' if i == 0 else 'a', header=i == 0, index=chunk.index.name is not None, decimal=rules.decimal, sep=rules.sep)
+        rows += len(chunk)
+    return rows
@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+"""
+    Server settings, read once from environment variables so they can be tuned per container
+"""
+
+# Number of rows encoded at a time on streamed responses
+RESPONSE_BATCH_SIZE: int = int(os.environ.get('RESPONSE_BATCH_SIZE', 10_000))
+
+# Number of compiled pipelines kept in memory (0 disables the cache)
+PIPELINE_CACHE_SIZE: int = int(os.environ.get('PIPELINE_CACHE_SIZE', 256))
+
+# Number of rows read at a time by the chunked execution mode (bounds its peak memory)
+CHUNK_SIZE: int = int(os.environ.get('CHUNK_SIZE', 100_000))
+
+# Local directory and size limit (in bytes) of the dataset store, least recently used datasets are evicted above it
+DATASET_STORE_DIR: str = os.environ.get('DATASET_STORE_DIR', os.path.join(tempfile.gettempdir(), 'data-wrangling', 'datasets'))
+DATASET_STORE_MAX_BYTES: int = int(os.environ.get('DATASET_STORE_MAX_BYTES', 10 * 1024 ** 3))
+
+# Threads used by MAP_DATA_TABLE to run the tables of a Data Group concurrently (per operation)
+MAP_WORKERS: int = int(os.environ.get('MAP_WORKERS', os.cpu_count() or 1))
+
+# Threads used by operations that work on each of their columns separately (e.g. PARSE_DATETIME_COLUMN)
+COLUMN_WORKERS: int = int(os.environ.get('COLUMN_WORKERS', os.cpu_count() or 1))
+
+# Pool that runs pipelines away from the event loop
+# WORKER_MODE -> "thread" or "process"
+# WORKER_QUEUE_SIZE -> Pipelines allowed to wait for a free worker, above it requests are answered with 503
+# WORKER_TIMEOUT -> Seconds a request waits for its pipeline (queue time included) before being answered with 504
+# WORKER_RETRY_AFTER -> Seconds sent on the Retry-After header of 503 responses
+WORKER_MODE: str = os.environ.get('WORKER_MODE', 'thread')
+WORKER_COUNT: int = int(os.environ.get('WORKER_COUNT', os.cpu_count() or 1))
+WORKER_QUEUE_SIZE: int = int(os.environ.get('WORKER_QUEUE_SIZE', 64))
+WORKER_TIMEOUT: float = float(os.environ.get('WORKER_TIMEOUT', 300))
+WORKER_RETRY_AFTER: int = int(os.environ.get('WORKER_RETRY_AFTER', 5))
+
+# Asynchronous jobs: workers running them, where their results are kept and for how long (seconds after they finish)
+JOB_WORKERS: int = int(os.environ.get('JOB_WORKERS', os.cpu_count() or 1))
+JOB_RESULT_DIR: str = os.environ.get('JOB_RESULT_DIR', os.path.join(tempfile.gettempdir(), 'data-wrangling', 'jobs'))
+JOB_RESULT_TTL: float = float(os.environ.get('JOB_RESULT_TTL', 3600))
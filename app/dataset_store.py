@@ -0,0 +1,89 @@
+import hashlib
+import os
+import re
+import threading
+import uuid
+import pandas as pd
+import pyarrow as pa
+from pydantic import BaseModel
+
+from app.io_functions import read_arrow
+
+DATASET_ID = re.compile(r'^[0-9a-f]{64}$')
+EXTENSION = '.arrow'
+
+
+class DatasetInfo(BaseModel):
+    dataset_id: str
+    rows: int
+    columns: list[str]
+    bytes: int
+
+
+class DatasetStore():
+    """
+    Content addressed store of parsed datasets, so a dataset is uploaded once and used by many pipelines
+
+    - Datasets are kept on local disk as Arrow IPC files, their id is the hash of that file (same data, same id)
+    - Loads memory map the file, numeric columns are used straight from the map without being read or copied
+    - When the store goes over max_bytes, the least recently used datasets are evicted (the file mtime is the last use)
+    - root is created with the first dataset, so building a store does not touch the disk
+    """
+    root: str
+    max_bytes: int
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def path(self, dataset_id: str) -> str:
+        if not DATASET_ID.match(dataset_id):
+            raise KeyError(f'dataset {dataset_id} does not exist')
+        return os.path.join(self.root, dataset_id + EXTENSION)
+
+    def put(self, df: pd.DataFrame) -> DatasetInfo:
+        table = pa.Table.from_pandas(df)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        buffer = sink.getvalue()
+
+        dataset_id = hashlib.sha256(memoryview(buffer)).hexdigest()
+        path = self.path(dataset_id)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            # Written under a temporary name first, so a dataset is never loaded half written
+            temporary_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            os.makedirs(self.root, exist_ok=True)
+            with open(temporary_path, 'wb') as file:
+                file.write(memoryview(buffer))
+            os.replace(temporary_path, path)
+            self.evict(keep=dataset_id)
+
+        return DatasetInfo(dataset_id=dataset_id, rows=len(df), columns=[str(column) for column in df.columns], bytes=buffer.size)
+
+    def get(self, dataset_id: str) -> pd.DataFrame:
+        path = self.path(dataset_id)
+        try:
+            df = read_arrow(path)
+            os.utime(path)
+        except FileNotFoundError:
+            raise KeyError(f'dataset {dataset_id} does not exist')
+        return df
+
+    def evict(self, keep: str | None = None):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.root):
+                if not name.endswith(EXTENSION): continue
+                stat = os.stat(os.path.join(self.root, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes: break
+                if name == f'{keep}{EXTENSION}': continue
+                os.remove(os.path.join(self.root, name))
+                total -= size
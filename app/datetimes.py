@@ -0,0 +1,115 @@
+import re
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+"""
+    Datetime parsing for columns of timestamps written as text
+
+    - Fixed width formats made only of %d, %m, %Y, %H, %M and %S (e.g. "%d/%m/%Y %H:%M:%S") are parsed with numpy,
+      reading the digits straight from the bytes of the strings
+    - Anything else (other directives, strings of other widths, invalid dates) is left to pd.to_datetime,
+      so results and errors are the same as calling it directly.
+      Each distinct string is only parsed once there and the result broadcast back to every row (exports repeat the same timestamps across tags)
+"""
+
+# Width of each directive accepted on the fixed width path
+FIXED_WIDTHS: dict[str, int] = {'d': 2, 'm': 2, 'Y': 4, 'H': 2, 'M': 2, 'S': 2}
+
+DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+# Whole seconds within the range of datetime64[ns] (pd.Timestamp.min and pd.Timestamp.max)
+SECONDS_MIN = -(-pd.Timestamp.min.value // 1_000_000_000)
+SECONDS_MAX = pd.Timestamp.max.value // 1_000_000_000
+
+
+def parse(values: pd.Series, formatting: str) -> pd.Series:
+    """ Same result as pd.to_datetime(values, format=formatting) """
+    if values.dtype != object and not pd.api.types.is_string_dtype(values.dtype):
+        return pd.to_datetime(values, format=formatting)
+
+    strings = values.to_numpy(dtype=object)
+    missing = pd.isna(strings)
+    has_missing = missing.any()
+    parsed = parse_fixed_width(strings[~missing] if has_missing else strings, formatting)
+    if parsed is not None:
+        if has_missing:
+            parsed, present = np.full(len(strings), np.datetime64('NaT', 'ns')), parsed
+            parsed[~missing] = present
+        return pd.Series(parsed, index=values.index, name=values.name)
+
+    # Missing values have code -1, which takes NaT
+    codes, uniques = pd.factorize(values)
+    parsed = pd.to_datetime(uniques, format=formatting).take(codes, allow_fill=True, fill_value=pd.NaT)
+    return pd.Series(parsed, index=values.index, name=values.name)
+
+
+def fixed_width_layout(formatting: str) -> Optional[list[tuple[str, int, int]]]:
+    """ (directive or literal, start, width) of each part of the format, None if the format has no fixed width """
+    layout = []
+    position = 0
+    for part in re.split(r'(%.)', formatting):
+        if not part: continue
+        if part.startswith('%'):
+            width = FIXED_WIDTHS.get(part[1])
+            if width is None: return None
+            layout.append((part, position, width))
+            position += width
+        else:
+            if '%' in part: return None
+            layout.append((part, position, len(part)))
+            position += len(part)
+    return layout
+
+
+def parse_fixed_width(strings: np.ndarray | pd.Index, formatting: str) -> Optional[np.ndarray]:
+    """ datetime64[ns] values of the strings, None if any of them does not exactly follow the fixed width format """
+    layout = fixed_width_layout(formatting)
+    if layout is None or not len(strings) or pd.api.types.infer_dtype(strings, skipna=False) != 'string': return None
+
+    width = sum(part_width for _, _, part_width in layout)
+    try:
+        # One extra byte to detect strings longer than the format
+        encoded = np.asarray(strings, dtype=object).astype(f'S{width + 1}')
+    except UnicodeEncodeError:
+        return None
+    # One row per position of the strings, so each position is read from contiguous memory
+    characters = np.ascontiguousarray(encoded.view(np.uint8).reshape(len(strings), width + 1).T)
+    if characters[width].any(): return None
+
+    fields = {'Y': 1970, 'm': 1, 'd': 1, 'H': 0, 'M': 0, 'S': 0}
+    for part, start, part_width in layout:
+        if not part.startswith('%'):
+            for offset, character in enumerate(part.encode()):
+                if (characters[start + offset] != character).any(): return None
+            continue
+
+        value = np.zeros(len(strings), dtype=np.int32)
+        for offset in range(part_width):
+            digit = characters[start + offset] - np.uint8(ord('0'))
+            # Characters below "0" wrap around to big numbers, as the bytes are unsigned
+            if (digit > 9).any(): return None
+            value = value * 10 + digit
+        fields[part[1]] = value
+
+    year, month, day = (np.asarray(fields[key], dtype=np.int64) for key in ('Y', 'm', 'd'))
+    hour, minute, second = fields['H'], fields['M'], fields['S']
+    if np.any((month < 1) | (month > 12)) or np.any(hour > 23) or np.any(minute > 59) or np.any(second > 59): return None
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    if np.any((day < 1) | (day > DAYS_IN_MONTH[month - 1] + (leap & (month == 2)))): return None
+
+    seconds = days_from_civil(year, month, day) * 86_400 + np.asarray(hour) * 3600 + np.asarray(minute) * 60 + np.asarray(second)
+    # Dates nanoseconds can not hold would overflow silently, pd.to_datetime raises OutOfBoundsDatetime on them instead
+    if np.any(seconds < SECONDS_MIN) or np.any(seconds > SECONDS_MAX): return None
+    return np.broadcast_to(seconds, (len(strings),)).astype('datetime64[s]').astype('datetime64[ns]')
+
+
+def days_from_civil(year: np.ndarray, month: np.ndarray, day: np.ndarray) -> np.ndarray:
+    """ Days since 1970-01-01 of proleptic Gregorian dates, with integer arithmetic only (faster than numpy's datetime64[M] casts) """
+    # Years start in March, so the leap day is the last day of the year
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146_097 + day_of_era - 719_468
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+"""
+    Smaller dtypes for the same values, so more of the data fits in cache for every following operation
+
+    - Strings with few distinct values become categoricals (categories sorted, so sorting by them is unchanged)
+    - Other strings become Arrow backed strings
+    - Integers are downcast to the smallest type that holds them, floats to float32 only if every value stays exactly the same
+"""
+
+
+def optimize(df: pd.DataFrame, column_names: Optional[list[str]] = None, category_ratio: float = 0.5, downcast: bool = True, arrow_strings: bool = True) -> pd.DataFrame:
+    """
+    Bytes before and after (deep, so the strings themselves are counted) and the changed dtypes are kept in df.attrs["memory"]
+    """
+    before = int(df.memory_usage(deep=True).sum())
+    columns: dict[str, pd.Series] = {}
+    for column in column_names if column_names is not None else df.columns:
+        values = df[column]
+        optimized = optimize_column(values, category_ratio, downcast, arrow_strings)
+        if optimized is not values: columns[column] = optimized
+
+    optimized_df = df.assign(**columns) if len(columns) else df.copy(deep=False)
+    optimized_df.attrs['memory'] = {
+        'bytes_before': before,
+        'bytes_after': int(optimized_df.memory_usage(deep=True).sum()),
+        'dtypes': {column: f'{df[column].dtype} -> {values.dtype}' for column, values in columns.items()},
+    }
+    return optimized_df
+
+
+def optimize_column(values: pd.Series, category_ratio: float, downcast: bool, arrow_strings: bool) -> pd.Series:
+    """ The same series is returned if its dtype can not be made smaller """
+    if values.dtype == object:
+        if pd.api.types.infer_dtype(values, skipna=True) != 'string': return values
+
+        codes, uniques = pd.factorize(values, sort=True)
+        if len(uniques) <= category_ratio * len(values):
+            return pd.Series(pd.Categorical.from_codes(codes, uniques), index=values.index, name=values.name)
+        if arrow_strings: return values.astype('string[pyarrow]')
+        return values
+
+    if not downcast: return values
+    if pd.api.types.is_bool_dtype(values.dtype): return values
+    if pd.api.types.is_integer_dtype(values.dtype) and isinstance(values.dtype, np.dtype):
+        return downcast_integers(values)
+    if values.dtype == np.float64:
+        return downcast_floats(values)
+    return values
+
+
+def downcast_integers(values: pd.Series) -> pd.Series:
+    if not len(values): return values
+    low, high = values.min(), values.max()
+    for dtype in (np.int8, np.int16, np.int32):
+        if dtype(0).itemsize >= values.dtype.itemsize: break
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max: return values.astype(dtype)
+    return values
+
+
+def downcast_floats(values: pd.Series) -> pd.Series:
+    array = values.to_numpy()
+    with np.errstate(over='ignore'):
+        downcast = array.astype(np.float32)
+    # Missing values stay missing, everything else must come back exactly
+    same = (downcast.astype(np.float64) == array) | (np.isnan(array) & np.isnan(downcast))
+    if not same.all(): return values
+    return pd.Series(downcast, index=values.index, name=values.name)
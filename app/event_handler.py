@@ -1,140 +1,235 @@
+import json
+import numpy as np
 import pandas as pd
 from enum import Enum
-from typing import Type, Callable, Self, Optional
-from pydantic import BaseModel
+from typing import Any, Callable, Optional
+from pydantic import BaseModel, PrivateAttr, model_validator
+
+from app import actions, events
+from app.models import DataGroup, DataTable
+
+"""
+    Rule based engine of events and actions, over the tables of a Data Group (or a single dataframe)
+
+    Each rule finds an event on a column as a boolean mask of the whole column (see app/events.py),
+    compares it with the same event on a reference column and applies its action to every masked row at once (see app/actions.py).
+    Rules run in order and each one sees the changes of the previous ones, as the stages of the reference irradiance processor do.
+    Masks are kept while their column is not changed, so an event checked by many rules (e.g. as their reference) is only computed once.
+"""
+
+
+class EventType(str, Enum):
+    ABRUPT = 'ABRUPT'
+    STAGNANT = 'STAGNANT'
+
+
+class AbruptArgs(BaseModel):
+    threshold: float
+    lookahead: Optional[str] = '1min'
+
+
+class StagnantArgs(BaseModel):
+    frequency: int
+    threshold: float
+    include_trailing: bool = False
 
-class EventType(Enum):
-    ABRUPT = 1
-    STAGNANT = 2
 
 class Event(BaseModel):
-    type: Type[EventType]
-    args: dict[str, any]
-    
-class ActionType(Enum):
-    SUBSTITUTE = 1
+    """ args -> Arguments of the event (AbruptArgs or StagnantArgs), validated when the rule is built """
+    type: EventType
+    args: dict[str, Any] = {}
+
+    _parsed: BaseModel = PrivateAttr()
+
+    @model_validator(mode='after')
+    def parse_args(self):
+        self._parsed = EVENT_ARGS[self.type](**self.args)
+        return self
+
+    def mask(self, values: pd.Series) -> np.ndarray:
+        return EVENTS[self.type](values, self._parsed)
+
+    def key(self) -> str:
+        """ Same key for the same event and arguments, used to reuse masks """
+        return json.dumps([self.type.value, self._parsed.model_dump()], sort_keys=True, default=str)
+
+
+class ActionType(str, Enum):
+    SUBSTITUTE = 'SUBSTITUTE'
+    REMOVE = 'REMOVE'
+
+
+class SubstituteArgs(BaseModel):
+    """ Column the values are taken from, the reference of the rule if column_name is None, and how far back the previous value is (lookback) """
+    df_name: Optional[str] = None
+    column_name: Optional[str] = None
+    lookback: Optional[str] = '1min'
+
+
+class RemoveArgs(BaseModel):
+    pass
+
 
 class Action(BaseModel):
-    type: Type[ActionType]
-    args: dict[str, any]
-    
-class ReferenceComparisonType(Enum):
-    NO_COMPARISON = 1
-    ONLY = 2
-    BOTH = 3
+    """
+    SUBSTITUTE -> Masked rows take the source value if it exists and is not zero, otherwise the value one lookback earlier (see actions.substitute)
+    REMOVE -> Masked rows become missing values
+    """
+    type: ActionType
+    args: dict[str, Any] = {}
+
+    _parsed: BaseModel = PrivateAttr()
+
+    @model_validator(mode='after')
+    def parse_args(self):
+        self._parsed = ACTION_ARGS[self.type](**self.args)
+        return self
+
+    @property
+    def arguments(self) -> BaseModel:
+        return self._parsed
+
+
+class ReferenceComparisonType(str, Enum):
+    """
+    NO_COMPARISON -> Only the event on the column is used
+    ONLY -> Rows where the event happens on the column but not on the reference
+    BOTH -> Rows where the event happens on both
+    """
+    NO_COMPARISON = 'NO_COMPARISON'
+    ONLY = 'ONLY'
+    BOTH = 'BOTH'
+
 
 class ReferenceDataframe(BaseModel):
-    df_name: str
+    """ df_name -> Table of the reference column, the table of the rule if None """
+    df_name: Optional[str] = None
     column_name: str
-    comparison: Type[ReferenceComparisonType]
+    comparison: ReferenceComparisonType = ReferenceComparisonType.ONLY
+
 
 class HandleEventRules(BaseModel):
-    df_name: str
+    """ df_name -> Table of the column, None when running on a single dataframe """
+    df_name: Optional[str] = None
     column_name: str
-    reference: Optional[ReferenceDataframe]
-
-class Context(BaseModel):
-    df: pd.DataFrame
-    column_name : str
-    
-    index: any
-    previous_index: any
-    previous_value: any
-    window_count: int
-    window_start: any
-    
-    def initialize(self, starting_index: int = 0) -> Self:
-        self.index = starting_index
-        self.previous_index = self.df.index[self.index]
-        self.previous_value = self.df.iloc[self.index][self.column_name]
-        self.window_count = 0
-        self.window_start = None
-        return self
-    
-    def __iter__(self):
-        yield self.df
-        yield self.column_name
-        yield self.index
-        yield self.previous_index
-        yield self.previous_value
-        yield self.window_count
-        yield self.window_start
-
-class EventHandler(BaseModel):
-    event_type: Type[EventType]
-    __event_function__: Callable[..., bool]
-    
-    action_type: Type[ActionType]
-    __action_function__: Callable[..., pd.DataFrame]
-    
+    reference: Optional[ReferenceDataframe] = None
+
+
+class EventRule(BaseModel):
+    """ name -> Key of the counts of the rule, default is "<column_name>_<event>" """
+    name: Optional[str] = None
+    event: Event
+    action: Action
     rules: HandleEventRules
-    __comparison_function__: Callable[[bool, bool], bool]
-    
-    __context__: Context
-    __ref_context__: Context
-    
-    def __init__(self, both: bool = False, **kwargs):
-        super.__init__(**kwargs)
-        self.both = both
-        self.set_event_function()
-        self.set_action_function()
-        self.set_comparison_function()
-        
-    def set_event_function(self):
-        match self.event_type:
-            case EventType.ABRUPT:
-                self.__event_function__ = abrupt
-            case EventType.STAGNANT:
-                self.__event_function__ = stagnant
-
-    def set_action_function(self):
-        match self.action_type:
-            case ActionType.SUBSTITUTE:
-                self.__action_function__ = substitute
-                
-    def set_comparison_function(self):
-        if self.rules.reference == None: return
-        match self.rules.reference.comparison:
-            case ReferenceComparisonType.ONLY:
-                self.__comparison_function__ = lambda a, b: a and not b
-            case ReferenceComparisonType.BOTH:
-                self.__comparison_function__ = lambda a, b: a and b
-            # The no comparison case houldn't be called but is left here just in case
-            case ReferenceComparisonType.NO_COMPARISON:
-                self.__comparison_function__ = lambda a, _: a    
-    
-    def create_context(self, df_group: dict[str, pd.DataFrame]):
-        self.__context__ = Context(df=df_group[self.rules.df_name], column_name=self.rules.column_name).initialize()
-        if self.rules.reference != None: self.__ref_context__ = Context(df=df_group[self.rules.reference.df_name], column_name=self.rules.reference.column_name)
-        
-    def set_index(self, index):
-        self.__context__.index = index
-        if self.__ref_context__ != None: self.__ref_context__.index = index
-        
-    def check_event(self, **kwargs) -> bool:
-        check = self.__event_function__(self.__context__, **kwargs)
-        if self.rules.reference == None or self.rules.reference.comparison == ReferenceComparisonType.NO_COMPARISON: return check
-        return self.__comparison_function__(check, self.__event_function__(self.__ref_context__, **kwargs))
-    
-    def run_action(self, **kwargs):
-        self.__context__.df = self.__action_function__(**kwargs)
-        
-
-def handle_event(df_group: dict[str, pd.DataFrame], event: Event, action: Action, rules: HandleEventRules) -> dict[str, pd.DataFrame]:
-    event_handler = EventHandler(event_type=event.type, action_type=action.type, rules=rules)
-    event_handler.create_context(df_group==df_group)
-    
-    for index, row in event_handler.__context__.df.index():
-        event_handler.set_index(index)
-        if event_handler.check_event(event.args):
-            event_handler.run_action(action.args)
-
- 
-def substitute():
-    return
-
-def abrupt() -> bool:
-    return
-
-def stagnant() -> bool:
-    return
\ No newline at end of file
+
+    def key(self) -> str:
+        return self.name or f'{self.rules.column_name}_{self.event.type.value.lower()}'
+
+
+EVENT_ARGS: dict[EventType, type[BaseModel]] = {EventType.ABRUPT: AbruptArgs, EventType.STAGNANT: StagnantArgs}
+
+EVENTS: dict[EventType, Callable[[pd.Series, Any], np.ndarray]] = {
+    EventType.ABRUPT: lambda values, args: events.abrupt(values, args.threshold, lookahead=args.lookahead),
+    EventType.STAGNANT: lambda values, args: events.stagnant(values, args.frequency, args.threshold, args.include_trailing),
+}
+
+ACTION_ARGS: dict[ActionType, type[BaseModel]] = {ActionType.SUBSTITUTE: SubstituteArgs, ActionType.REMOVE: RemoveArgs}
+
+COMPARISONS: dict[ReferenceComparisonType, Callable[[np.ndarray, np.ndarray], np.ndarray]] = {
+    ReferenceComparisonType.NO_COMPARISON: lambda mask, _: mask,
+    ReferenceComparisonType.ONLY: lambda mask, reference: mask & ~reference,
+    ReferenceComparisonType.BOTH: lambda mask, reference: mask & reference,
+}
+
+
+class EventEngine():
+    """
+    Tables being changed by a list of rules, with the masks computed on them so far
+
+    tables -> Current dataframe of each table (None is the key of a single dataframe)
+    counts -> Rows hit by each rule and where the values of its action came from
+    """
+    tables: dict[Optional[str], pd.DataFrame]
+    counts: dict[str, dict[str, int]]
+
+    def __init__(self, tables: dict[Optional[str], pd.DataFrame]):
+        self.tables = tables
+        self.counts = {}
+        self._masks: dict[tuple[Optional[str], str, str], np.ndarray] = {}
+
+    def table(self, df_name: Optional[str]) -> pd.DataFrame:
+        if df_name not in self.tables:
+            if df_name is None: raise ValueError('df_name must be passed to run on a Data Group')
+            raise KeyError(f'table {df_name} is not in the Data Group')
+        return self.tables[df_name]
+
+    def column(self, df_name: Optional[str], column_name: str, index: Optional[pd.Index] = None) -> pd.Series:
+        """ Column of a table, aligned by index to another table if index is passed """
+        values = self.table(df_name)[column_name]
+        if index is not None and not values.index.equals(index): values = values.reindex(index)
+        return values
+
+    def mask(self, df_name: Optional[str], column_name: str, event: Event) -> np.ndarray:
+        key = (df_name, column_name, event.key())
+        if key not in self._masks: self._masks[key] = event.mask(self.column(df_name, column_name))
+        return self._masks[key]
+
+    def run(self, rule: EventRule):
+        target = rule.rules
+        df = self.table(target.df_name)
+        mask = self.mask(target.df_name, target.column_name, rule.event)
+
+        reference = target.reference
+        if reference is not None and reference.comparison != ReferenceComparisonType.NO_COMPARISON:
+            reference_name = reference.df_name or target.df_name
+            reference_mask = self.mask(reference_name, reference.column_name, rule.event)
+            reference_index = self.table(reference_name).index
+            if not reference_index.equals(df.index):
+                # Rows the reference does not have take no event
+                reference_mask = pd.Series(reference_mask, index=reference_index).reindex(df.index, fill_value=False).to_numpy(dtype=bool)
+            mask = COMPARISONS[reference.comparison](mask, reference_mask)
+
+        values, counts = self.act(rule, df, mask)
+        df = df.assign(**{target.column_name: values})
+        df.attrs['events'] = {**df.attrs.get('events', {}), rule.key(): {'hits': int(mask.sum()), **counts}}
+        self.tables[target.df_name] = df
+        self.counts[rule.key()] = df.attrs['events'][rule.key()]
+
+        # Masks of the changed column are stale now
+        self._masks = {key: value for key, value in self._masks.items() if key[:2] != (target.df_name, target.column_name)}
+
+    def act(self, rule: EventRule, df: pd.DataFrame, mask: np.ndarray) -> tuple[pd.Series, dict[str, int]]:
+        values = df[rule.rules.column_name]
+        if rule.action.type == ActionType.REMOVE:
+            return values.mask(mask), {}
+
+        args: SubstituteArgs = rule.action.arguments
+        source = None
+        if args.column_name is not None:
+            source = self.column(args.df_name or rule.rules.df_name, args.column_name, df.index)
+        elif rule.rules.reference is not None:
+            reference = rule.rules.reference
+            source = self.column(reference.df_name or rule.rules.df_name, reference.column_name, df.index)
+        return actions.substitute(values, mask, source, args.lookback)
+
+
+def handle_events(data: pd.DataFrame | DataGroup, rules: list[EventRule]) -> tuple[pd.DataFrame | DataGroup, dict[str, dict[str, int]]]:
+    """ Runs the rules in order, returns the changed data and the counts of each rule (only the changed columns are replaced, nothing is copied) """
+    names = [rule.key() for rule in rules]
+    if len(set(names)) != len(names):
+        raise ValueError('rules must have different names (pass a name to rules on the same column and event)')
+
+    if isinstance(data, DataGroup):
+        engine = EventEngine({table.alias: table.df for table in data.dfs})
+    else:
+        engine = EventEngine({None: data})
+    for rule in rules: engine.run(rule)
+
+    if isinstance(data, DataGroup):
+        return DataGroup(dfs=[DataTable(alias=table.alias, df=engine.tables[table.alias]) for table in data.dfs]), engine.counts
+    return engine.tables[None], engine.counts
+
+
+def handle_event(df_group: DataGroup, event: Event, action: Action, rules: HandleEventRules) -> DataGroup:
+    """ Runs a single rule """
+    return handle_events(df_group, [EventRule(event=event, action=action, rules=rules)])[0]
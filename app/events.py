@@ -1,41 +1,137 @@
+import numpy as np
 import pandas as pd
-from event_handler import Context
-
-def abrupt(context: Context, threshold: int) -> bool:
-    df, column_name, index, previous_index, previous_value = context
-    is_abrupt = False
-    
-    # First we need to check if the current and previous indexes both exist in the dataframe
-    if not index in df.index: return False
-    if not previous_index in df.index: return False
-
-    if abs(df.loc[index][column_name] - previous_value) >= threshold:
-        is_abrupt = True
-
-    # TODO: Suellen code added another condition after this, which would check if the following
-    # line was also abrupt, which would mean that this would be the faulty line.
-    # This would require more than one event checks to be ran before an action could happen.
-        
-    context.previous_index = index
-    context.previous_value = df.loc[index][column_name]
-    
+from typing import Optional
+
+"""
+    Vectorized events, each one is computed for a whole column at once and returns a boolean mask (True where the event happens)
+
+    They follow the rules of refference/irradiance_processor.py, without walking the index row by row (abrupt changes only walk the rows right after a substituted one).
+"""
+
+
+def abrupt(values: pd.Series, threshold: float, reference: Optional[pd.Series] = None, lookahead: Optional[str] = '1min', substituted: bool = False) -> np.ndarray:
+    """
+    Abrupt change rules (as IrradianceProcessor._fix_abrupt_changes):
+    - The value changes at least threshold from the previous row
+    - The reference (already aligned to the values) changes less than threshold between the same rows
+    - The value also changes at least threshold to the value at t + lookahead (or to the next row, if no lookahead)
+
+    The reference compares each row with the previous one after it was substituted, so a spike right after another one is compared with the fixed value.
+    That is what substituted=True does, for masks that are substituted from the same reference (see actions.substitute, lookahead is also its lookback).
+    Otherwise rows are compared with the raw previous row.
+    """
+    array = values.to_numpy(dtype=float)
+    reference_array = reference.to_numpy(dtype=float) if reference is not None else None
+    confirmed = np.abs(following(values, lookahead) - array) >= threshold
+    if reference is not None:
+        confirmed &= jumps(reference_array) < threshold
+
+    is_abrupt = (jumps(array) >= threshold) & confirmed
+    if substituted:
+        return abrupt_substituted(is_abrupt, array, confirmed, threshold, reference_array, preceding(values.index, lookahead))
     return is_abrupt
 
-def stagnant(context: Context, frequency: int, threshold: float) -> bool:
-    df, column_name, index, window_count, window_start, previous_index, previous_value = context
-    
-    # First we need to check if the current and previous indexes both exist in the dataframe
-    if not index in df.index: return False
-    if not previous_index in df.index: return False
-    
-    if abs(df.loc[index][column_name] - previous_value) <= threshold:
-        if window_count == 0: window_start = index
-        window_count += 1
-    else:
-        if window_count >= frequency:
-            stagnant_indexes = pd.date_range(window_start, previous_index, freq="1min")
-            for i in stagnant_indexes:
-                # Oh no, this requires changing many at a time
-                return False
-    
-    return False
\ No newline at end of file
+
+def abrupt_substituted(is_abrupt: np.ndarray, array: np.ndarray, confirmed: np.ndarray, threshold: float, reference: Optional[np.ndarray] = None, previous: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Abrupt rows (is_abrupt, comparing with the raw previous rows) redone comparing each row with the previous one after its substitution
+    Only rows after a value the substitution changed can change, so only those chains are walked (confirmed holds the other rules of each row)
+    """
+    is_abrupt, running = is_abrupt.copy(), array.copy()
+    done = -1
+    for position in np.flatnonzero(is_abrupt).tolist():
+        if position <= done: continue
+        while True:
+            # Same value actions.substitute gives the row (the reference value is never missing on abrupt rows)
+            source = previous[position] if previous is not None else position - 1
+            if reference is not None and reference[position] != 0: running[position] = reference[position]
+            else: running[position] = running[source] if source >= 0 else np.nan
+
+            done = position
+            if running[position] == array[position] or position + 1 == len(array): break
+            position += 1
+            is_abrupt[position] = confirmed[position] and abs(array[position] - running[position - 1]) >= threshold
+            done = position
+            if not is_abrupt[position]: break
+    return is_abrupt
+
+
+def stagnant(values: pd.Series, frequency: int, threshold: float, include_trailing: bool = False) -> np.ndarray:
+    """
+    Stagnant values rules (same as IrradianceProcessor._fix_stagnant_data):
+    - A row is part of a window when it changes at most threshold from the previous row
+    - Windows of at least frequency rows are stagnant
+    - A window still open at the end of the data is only stagnant if include_trailing is True (the reference never closes it)
+    """
+    return windows(jumps(values.to_numpy(dtype=float)) <= threshold, frequency, include_trailing)
+
+
+def windows(is_flat: np.ndarray, frequency: int, include_trailing: bool = False) -> np.ndarray:
+    """ Rows inside runs of at least frequency flat rows (the run still open at the end only if include_trailing is True) """
+    starts, ends = runs(is_flat)
+    is_stagnant = (ends - starts) >= frequency
+    if not include_trailing: is_stagnant &= ends < len(is_flat)
+    return spans(starts[is_stagnant], ends[is_stagnant], len(is_flat))
+
+
+def runs(flags: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Start and end (exclusive) positions of every run of True values """
+    edges = np.diff(np.concatenate(([0], flags.view(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def spans(starts: np.ndarray, ends: np.ndarray, length: int) -> np.ndarray:
+    """ Boolean mask that is True inside every [start, end) span """
+    edges = np.zeros(length + 1, dtype=np.int32)
+    edges[starts] += 1
+    edges[ends] -= 1
+    return np.cumsum(edges[:-1]) > 0
+
+
+def jumps(array: np.ndarray) -> np.ndarray:
+    """ Absolute change from the previous row (the first row is compared with itself, as in the reference loops) """
+    changes = np.empty_like(array)
+    changes[:1] = 0
+    np.abs(np.subtract(array[1:], array[:-1], out=changes[1:]), out=changes[1:])
+    return changes
+
+
+def following(values: pd.Series, lookahead: Optional[str] = None) -> np.ndarray:
+    """ Value at t + lookahead for every row (NaN where that timestamp does not exist) or at the next row """
+    array = values.to_numpy(dtype=float)
+    if lookahead is None or not isinstance(values.index, pd.DatetimeIndex):
+        return np.append(array[1:], np.nan)
+
+    step = np.timedelta64(pd.Timedelta(lookahead))
+    # Regular series (e.g. after reindexing by a date range) have t + lookahead on the next row
+    if values.index.is_monotonic_increasing and (np.diff(values.index.to_numpy()) == step).all():
+        return np.append(array[1:], np.nan)
+
+    positions = lookup(values.index, values.index + step)
+    return np.where(positions >= 0, array[positions], np.nan)
+
+
+
+def preceding(index: pd.Index, lookback: Optional[str] = None) -> Optional[np.ndarray]:
+    """ Position of the row at t - lookback for every row (-1 where that timestamp does not exist), None when it is always the previous row """
+    if lookback is None or not isinstance(index, pd.DatetimeIndex): return None
+
+    step = np.timedelta64(pd.Timedelta(lookback))
+    if index.is_monotonic_increasing and (np.diff(index.to_numpy()) == step).all(): return None
+    return lookup(index, index - step)
+
+def lookup(index: pd.Index, labels: pd.Index) -> np.ndarray:
+    """ Positions of labels on an index (-1 where missing), with a binary search when the index is sorted """
+    if not index.is_monotonic_increasing:
+        if not index.is_unique: raise ValueError('index must not have duplicated labels')
+        return index.get_indexer(labels)
+
+    index_values, label_values = index.to_numpy(), labels.to_numpy()
+    # A sorted index only has duplicated labels next to each other
+    if (index_values[1:] == index_values[:-1]).any():
+        raise ValueError('index must not have duplicated labels')
+
+    positions = np.searchsorted(index_values, label_values)
+    found = positions < len(index_values)
+    found[found] = index_values[positions[found]] == label_values[found]
+    return np.where(found, positions, -1)
@@ -0,0 +1,376 @@
+import threading
+import time
+import uuid
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from typing import Optional
+from pydantic import BaseModel, model_validator
+
+from app import actions, datetimes, events, triplets
+
+"""
+    Incremental mode for sensor exports that keep arriving (e.g. a new irradiance export every few minutes)
+
+    Every step of refference/irradiance_processor.py is kept for each sensor, one value per timestamp of a shared grid
+    (clean and reindex, fill missing, clip, stagnant values, abrupt changes and incorrect zeroes, vectorized as app/events.py and app/actions.py do).
+    Each new batch only recomputes the tail of the steps its rows can change:
+    - Filling and clipping: from the first timestamp that got a new reading (the gap up to it continues from the last filled value)
+    - Stagnant values: from the start of the flat window holding the row before it (a window still open may become stagnant)
+    - Abrupt changes: from one row before the first changed row (its t + 1 lookahead changed)
+    - Incorrect zeroes: from the first changed row of the sensor or of its equivalent
+    Only the rows whose processed values changed (or are new) are returned, so the cost follows the size of each batch and not the history.
+
+    Obs.: the grid starts at the first timestamp of the grid sensor on the first batch, older readings are ignored
+"""
+
+# Rows compared at a time when looking back for the start of a flat window
+RUN_BLOCK = 1024
+
+# Steps kept for each sensor, in the order they run
+STEPS = ('raw', 'filled', 'clipped', 'stagnant', 'abrupt', 'final')
+
+# Raw time of timestamps without a reading, so any reading is earlier
+NO_READING = np.iinfo(np.int64).max
+
+
+class StreamRules(BaseModel):
+    """
+    Rules of each step, the defaults are the ones of refference/script.py
+
+    tags -> Sensor of each tag name on the export (SENSORS on the processor)
+    equivalents -> Sensor used as reference by each sensor to fill and fix its values (SENSOR_EQUIVALENTS), sensors missing use themselves
+    untouched -> Sensors whose gaps are filled with zero and whose values are never fixed (GHI on the processor)
+    grid_sensor -> Sensor whose first and last timestamps bound the timestamps of every sensor
+    clip -> (lower, upper) limits of every sensor, unless it has its own on sensor_clips
+    abrupt_threshold -> Threshold of abrupt changes of every sensor, unless it has its own on sensor_abrupt_thresholds
+    """
+    tags: dict[str, str] = {
+        'Datalogger[7].Meteo[1].MRI_IrradianceGlobal': 'GHI',
+        'Datalogger[1].SensorAI[2].MRI_Value01': 'PIR1',
+        'Datalogger[2].SensorAI[2].MRI_Value01': 'PIR2',
+        'Datalogger[5].SensorAI[2].MRI_Value01': 'PIR5',
+        'Datalogger[7].SensorAI[2].MRI_Value01': 'PIR7',
+        'Datalogger[1].Meteo[1].MRI_TemperatureAmbient': 'Temp2',
+        'Datalogger[7].Meteo[1].MRI_Humidity': 'RH2',
+        'Datalogger[7].Meteo[1].MRI_TemperatureAmbient': 'Temp3',
+    }
+    equivalents: dict[str, str] = {'PIR1': 'PIR2', 'PIR2': 'PIR1', 'PIR5': 'PIR7', 'PIR7': 'PIR5'}
+    untouched: list[str] = ['GHI']
+    grid_sensor: str = 'GHI'
+    formatting: str = '%d/%m/%Y %H:%M:%S'
+    frequency: str = '1min'
+    clip: tuple[Optional[float], Optional[float]] = (0, 1500)
+    sensor_clips: dict[str, tuple[Optional[float], Optional[float]]] = {'Temp2': (0, 50), 'Temp3': (0, 50)}
+    stagnant_frequency: int = 6
+    stagnant_threshold: float = 0.0001
+    abrupt_threshold: float = 800
+    sensor_abrupt_thresholds: dict[str, float] = {'Temp2': 4, 'Temp3': 4}
+
+    @model_validator(mode='after')
+    def enforce_known_sensors(self):
+        sensors = set(self.tags.values())
+        unknown = ({self.grid_sensor} | set(self.equivalents) | set(self.equivalents.values()) | set(self.untouched)) - sensors
+        if len(unknown):
+            raise ValueError(f'sensors {", ".join(sorted(unknown))} have no tag')
+        return self
+
+    def sensors(self) -> list[str]:
+        return list(dict.fromkeys(self.tags.values()))
+
+    def equivalent(self, sensor: str) -> str:
+        return self.equivalents.get(sensor, sensor)
+
+
+class StreamInfo(BaseModel):
+    stream_id: str
+    sensors: list[str]
+    rows: int = 0
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    batches: int = 0
+    created_at: float
+
+
+class SensorSeries():
+    """
+    Values of every step (see STEPS) for one sensor, in arrays that grow in place (doubling), so appending costs the rows appended
+
+    raw_time -> Timestamp (before flooring) of each raw value, the earliest reading of each interval is kept, as the processor does
+    pending -> Readings after the end of the grid by position, kept until the grid reaches them
+    """
+    capacity: int
+    steps: dict[str, np.ndarray]
+    raw_time: np.ndarray
+    pending: dict[int, tuple[int, float]]
+
+    def __init__(self):
+        self.capacity = 0
+        self.steps = {step: np.empty(0) for step in STEPS}
+        self.raw_time = np.empty(0, dtype=np.int64)
+        self.pending = {}
+
+    def grow(self, length: int):
+        if length <= self.capacity: return
+        capacity = max(length, 2 * self.capacity, RUN_BLOCK)
+        for step, array in self.steps.items():
+            self.steps[step] = np.concatenate((array, np.full(capacity - self.capacity, np.nan)))
+        self.raw_time = np.concatenate((self.raw_time, np.full(capacity - self.capacity, NO_READING, dtype=np.int64)))
+        self.capacity = capacity
+
+
+class SensorStream():
+    """
+    Processed series of every sensor of an export, appended to batch by batch (see append)
+    """
+    info: StreamInfo
+    rules: StreamRules
+    start: Optional[np.datetime64]
+    step: np.timedelta64
+    length: int
+    sensors: dict[str, SensorSeries]
+
+    def __init__(self, info: StreamInfo, rules: StreamRules):
+        self.info = info
+        self.rules = rules
+        self.start = None
+        self.step = np.timedelta64(pd.Timedelta(rules.frequency).value, 'ns')
+        self.length = 0
+        self.sensors = {sensor: SensorSeries() for sensor in rules.sensors()}
+        self._lock = threading.Lock()
+
+    def append(self, export: pd.DataFrame) -> pd.DataFrame:
+        """
+        Adds the rows of a new export (same layout the processor reads, a (tag name, value, timestamp) triplet of columns per sensor)
+        and returns the processed rows that changed, one column per sensor indexed by timestamp
+        """
+        readings = self.readings(export)
+        with self._lock:
+            old_length = self.length
+            first_changed = self.store(readings)
+            self.info.batches += 1
+            if first_changed >= self.length: return self.frame(np.arange(0))
+
+            starts = self.starts(first_changed)
+            low = min(starts['final'].values())
+            previous = {sensor: series.steps['final'][low:old_length].copy() for sensor, series in self.sensors.items()}
+            self.process(starts)
+
+            changed = np.zeros(self.length - low, dtype=bool)
+            changed[old_length - low:] = True
+            for sensor, series in self.sensors.items():
+                old, new = previous[sensor], series.steps['final'][low:old_length]
+                changed[:len(old)] |= (old != new) & ~(np.isnan(old) & np.isnan(new))
+            return self.frame(low + np.flatnonzero(changed))
+
+    def readings(self, export: pd.DataFrame) -> dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """ (floored timestamps, raw timestamps, values) of the readings of each sensor, as the processor cleans them """
+        readings = {}
+        for tag, table in triplets.split(export):
+            if tag not in self.rules.tags:
+                raise ValueError(f'tag {tag} has no sensor on the rules of the stream')
+            if not len(table): continue
+
+            raw = datetimes.parse(table[triplets.TIMESTAMP], self.rules.formatting).to_numpy(dtype='datetime64[ns]').view(np.int64)
+            # Same as flooring the timestamps to the frequency
+            step = self.step.astype(np.int64)
+            floored = (raw // step * step).view('datetime64[ns]')
+            readings[self.rules.tags[tag]] = (floored, raw, table[triplets.VALUE].to_numpy(dtype=float))
+        return readings
+
+    def store(self, readings: dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]]) -> int:
+        """ Extends the grid and keeps the new raw readings, returns the first position whose raw value changed """
+        grid = readings.get(self.rules.grid_sensor)
+        if self.start is None:
+            if grid is None:
+                raise ValueError(f'the first batch must have readings of {self.rules.grid_sensor}')
+            self.start = grid[0].min()
+
+        old_length = self.length
+        positions = {sensor: (floored - self.start) // self.step for sensor, (floored, _, _) in readings.items()}
+        if grid is not None: self.length = max(self.length, int(positions[self.rules.grid_sensor].max()) + 1)
+
+        first_changed = old_length
+        for sensor, series in self.sensors.items():
+            series.grow(self.length)
+            # Readings that were ahead of the grid go in first, they arrived before any reading of this batch
+            reached = [position for position in series.pending if position < self.length]
+            if len(reached):
+                raw, values = zip(*(series.pending.pop(position) for position in reached))
+                first_changed = min(first_changed, self.merge(series, np.array(reached, dtype=np.int64), np.array(raw, dtype=np.int64), np.array(values)))
+            if sensor not in readings: continue
+
+            _, raw, values = readings[sensor]
+            position = positions[sensor].astype(np.int64)
+            # The earliest reading of each interval is kept (ties keep the one that arrived first)
+            order = np.argsort(raw, kind='stable')
+            position, raw, values = position[order], raw[order], values[order]
+            _, first = np.unique(position, return_index=True)
+            position, raw, values = position[first], raw[first], values[first]
+
+            ahead = position >= self.length
+            for i in np.flatnonzero(ahead):
+                kept = series.pending.get(int(position[i]))
+                if kept is None or raw[i] < kept[0]: series.pending[int(position[i])] = (int(raw[i]), float(values[i]))
+            inside = ~ahead & (position >= 0)
+            first_changed = min(first_changed, self.merge(series, position[inside], raw[inside], values[inside]))
+
+        self.info.rows = self.length
+        self.info.start = pd.Timestamp(self.start).to_pydatetime()
+        self.info.end = pd.Timestamp(self.start + (self.length - 1) * self.step).to_pydatetime() if self.length else None
+        return first_changed
+
+    def merge(self, series: SensorSeries, positions: np.ndarray, raw: np.ndarray, values: np.ndarray) -> int:
+        """ Keeps the readings earlier than the ones already kept on their positions, returns the first position changed """
+        earlier = raw < series.raw_time[positions]
+        positions = positions[earlier]
+        series.raw_time[positions] = raw[earlier]
+        series.steps['raw'][positions] = values[earlier]
+        return int(positions.min()) if len(positions) else self.length
+
+    def starts(self, first_changed: int) -> dict[str, dict[str, int]]:
+        """
+        First position recomputed by each step of each sensor
+        Positions before the first changed one keep their values on every step, so the starts are known before anything runs
+        """
+        rules = self.rules
+        starts = {step: {} for step in ('clipped', 'stagnant', 'abrupt', 'final')}
+        # The flat window holding the row before the first changed one may grow (or be closed)
+        windows = {
+            sensor: _run_start(series.steps['clipped'], first_changed - 1, rules.stagnant_threshold) if first_changed else 0
+            for sensor, series in self.sensors.items()
+        }
+        for sensor in self.sensors:
+            starts['clipped'][sensor] = first_changed
+            if sensor in rules.untouched:
+                for step in ('stagnant', 'abrupt', 'final'): starts[step][sensor] = first_changed
+            else:
+                starts['stagnant'][sensor] = min(windows[sensor], windows[rules.equivalent(sensor)])
+        for sensor in self.sensors:
+            if sensor in rules.untouched: continue
+            equivalent = rules.equivalent(sensor)
+            # The row before the first changed one looks ahead to it
+            starts['abrupt'][sensor] = max(min(starts['stagnant'][sensor], starts['stagnant'][equivalent]) - 1, 0)
+        for sensor in self.sensors:
+            if sensor in rules.untouched: continue
+            starts['final'][sensor] = min(starts['abrupt'][sensor], starts['abrupt'][rules.equivalent(sensor)])
+        return starts
+
+    def process(self, starts: dict[str, dict[str, int]]):
+        """ Runs every step from its start, each step of every sensor only after the previous step of all of them (equivalents included) """
+        rules, end = self.rules, self.length
+        steps = {sensor: series.steps for sensor, series in self.sensors.items()}
+
+        for sensor, values in steps.items():
+            start = starts['clipped'][sensor]
+            raw = values['raw'][start:end]
+            if sensor in rules.untouched:
+                values['filled'][start:end] = np.where(np.isnan(raw), 0, raw)
+            else:
+                _substitute_tail(values['filled'], values['raw'], start, end, np.isnan(raw), steps[rules.equivalent(sensor)]['raw'])
+            lower, upper = rules.sensor_clips.get(sensor, rules.clip)
+            values['clipped'][start:end] = values['filled'][start:end] if lower is None and upper is None else np.clip(values['filled'][start:end], lower, upper)
+
+        for sensor, values in steps.items():
+            if sensor not in rules.untouched: continue
+            start = starts['final'][sensor]
+            for step in ('stagnant', 'abrupt', 'final'): values[step][start:end] = values['clipped'][start:end]
+
+        fixed = [sensor for sensor in steps if sensor not in rules.untouched]
+        for sensor in fixed:
+            start, values, reference = starts['stagnant'][sensor], steps[sensor], steps[rules.equivalent(sensor)]
+            mask = _stagnant_tail(values['clipped'], start, end, rules.stagnant_frequency, rules.stagnant_threshold)
+            mask &= ~_stagnant_tail(reference['clipped'], start, end, rules.stagnant_frequency, rules.stagnant_threshold)
+            _substitute_tail(values['stagnant'], values['clipped'], start, end, mask, reference['clipped'])
+
+        for sensor in fixed:
+            start, values, reference = starts['abrupt'][sensor], steps[sensor], steps[rules.equivalent(sensor)]
+            threshold = rules.sensor_abrupt_thresholds.get(sensor, rules.abrupt_threshold)
+            mask = _abrupt_tail(values['stagnant'], reference['stagnant'], values['abrupt'], start, end, threshold)
+            _substitute_tail(values['abrupt'], values['stagnant'], start, end, mask, reference['stagnant'])
+
+        for sensor in fixed:
+            start, values, reference = starts['final'][sensor], steps[sensor], steps[rules.equivalent(sensor)]
+            # Missing values on the equivalent are different from zero, as on the processor
+            mask = (values['abrupt'][start:end] == 0) & (reference['abrupt'][start:end] != 0)
+            _substitute_tail(values['final'], values['abrupt'], start, end, mask, reference['abrupt'])
+
+    def frame(self, positions: Optional[np.ndarray] = None) -> pd.DataFrame:
+        """ Processed values on the positions of the grid (all of them if None), one column per sensor """
+        if positions is None: positions = np.arange(self.length)
+        index = pd.DatetimeIndex(self.start + positions * self.step if self.start is not None else [], name='Timestamp')
+        return pd.DataFrame({sensor: series.steps['final'][positions] for sensor, series in self.sensors.items()}, index=index)
+
+
+def _run_start(values: np.ndarray, position: int, threshold: float) -> int:
+    """ First position of the run of flat rows (see events.stagnant) holding position, position itself if it starts one or is not flat """
+    end = position
+    while end > 0:
+        first = max(end - RUN_BLOCK, 0)
+        # Row first + k + 1 is flat when flat[k] is True
+        flat = np.abs(np.diff(values[first:end + 1])) <= threshold
+        breaks = np.flatnonzero(~flat)
+        if len(breaks):
+            row = first + int(breaks[-1]) + 1
+            return position if row == position else row + 1
+        end = first
+    return 0
+
+
+def _stagnant_tail(values: np.ndarray, start: int, end: int, frequency: int, threshold: float) -> np.ndarray:
+    """ events.stagnant of values[:end] for the rows from start on, looking back only to the start of the flat run holding start """
+    run_start = _run_start(values, start, threshold)
+    first = max(run_start - 1, 0)
+    is_flat = events.jumps(values[first:end]) <= threshold
+    # The row before the run is only there to compare the run's first row with
+    if run_start > 0: is_flat = is_flat[1:]
+    return events.windows(is_flat, frequency)[start - run_start:]
+
+
+def _abrupt_tail(values: np.ndarray, reference: np.ndarray, output: np.ndarray, start: int, end: int, threshold: float) -> np.ndarray:
+    """ events.abrupt (substituted) of values[:end] for the rows from start on, output holds the substituted rows before start (the grid is regular, so t + 1 is the next row) """
+    first = max(start - 1, 0)
+    window = values[first:end].copy()
+    confirmed = events.jumps(reference[first:end]) < threshold
+    confirmed &= np.abs(np.append(window[1:], np.nan) - window) >= threshold
+    if start > 0: window[0] = output[start - 1]
+    is_abrupt = (events.jumps(window) >= threshold) & confirmed
+    if start > 0: is_abrupt[0] = False
+    return events.abrupt_substituted(is_abrupt, window, confirmed, threshold, reference[first:end])[start - first:]
+
+
+def _substitute_tail(output: np.ndarray, values: np.ndarray, start: int, end: int, mask: np.ndarray, reference: np.ndarray):
+    """ Writes actions.substitute of values[start:end] on output[start:end], taking output[start - 1] as the value before start """
+    first = max(start - 1, 0)
+    segment = values[first:end].copy()
+    if start > 0:
+        segment[0] = output[start - 1]
+        mask = np.concatenate(([False], mask))
+    substituted, _ = actions.substitute_array(segment, mask, reference[first:end])
+    output[start:end] = substituted[start - first:]
+
+
+class StreamManager():
+    """
+    Streams kept in memory by id, each one holds the processed series of its sensors
+    Obs.: streams are lost when the server restarts
+    """
+
+    def __init__(self):
+        self._streams: dict[str, SensorStream] = {}
+        self._lock = threading.Lock()
+
+    def create(self, rules: StreamRules) -> StreamInfo:
+        info = StreamInfo(stream_id=uuid.uuid4().hex, sensors=rules.sensors(), created_at=time.time())
+        with self._lock:
+            self._streams[info.stream_id] = SensorStream(info, rules)
+        return info
+
+    def get(self, stream_id: str) -> SensorStream:
+        """ Raises KeyError if the stream does not exist """
+        with self._lock:
+            return self._streams[stream_id]
+
+    def delete(self, stream_id: str) -> StreamInfo:
+        with self._lock:
+            return self._streams.pop(stream_id).info
@@ -1,35 +1,424 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet
 from enum import Enum
-from typing import Type
+from typing import Any, Type, BinaryIO, Callable, Iterable, Iterator, Optional
+import datetime
 import io
+import itertools
+import json
+import math
+import os
+import uuid
+
+from app import predicates
+from app.config import CHUNK_SIZE, RESPONSE_BATCH_SIZE
 
 class FileType(Enum):
     CSV = 1
+    ARROW = 2
+    PARQUET = 3
+    JSON = 4
+    JSON_SPLIT = 5
+    NDJSON = 6
+
+# Maps the media types accepted on uploads to the file type used to decode them
+MEDIA_TYPES: dict[str, FileType] = {
+    'text/csv': FileType.CSV,
+    'application/csv': FileType.CSV,
+    'application/vnd.apache.arrow.stream': FileType.ARROW,
+    'application/vnd.apache.arrow.file': FileType.ARROW,
+    'application/vnd.apache.parquet': FileType.PARQUET,
+    'application/x-parquet': FileType.PARQUET,
+}
+
+# Used when the client does not send a meaningful media type (e.g. application/octet-stream)
+EXTENSIONS: dict[str, FileType] = {
+    'csv': FileType.CSV,
+    'arrow': FileType.ARROW,
+    'arrows': FileType.ARROW,
+    'feather': FileType.ARROW,
+    'parquet': FileType.PARQUET,
+}
+
+# Maps the media types accepted on the Accept header to the file type used to encode responses
+# Obs.: "application/json; orient=split" selects FileType.JSON_SPLIT
+RESPONSE_MEDIA_TYPES: dict[str, FileType] = {
+    'application/json': FileType.JSON,
+    'application/x-ndjson': FileType.NDJSON,
+    'application/ndjson': FileType.NDJSON,
+    'text/csv': FileType.CSV,
+    'application/vnd.apache.arrow.stream': FileType.ARROW,
+}
+
+ARROW_FILE_MAGIC = b'ARROW1'
 
 class IoArgs():
     file_type: Type[FileType]
     decimal: str
     sep: str
-    
-    def __init__(self, file_type: Type[FileType], decimal: str, sep: str):
+
+    def __init__(self, file_type: Type[FileType], decimal: str = '.', sep: str = ','):
         self.file_type = file_type
         self.decimal = decimal
         self.sep = sep
 
-def open(source: io.StringIO, rules: IoArgs) -> pd.DataFrame:
+
+class MissingColumns(ValueError):
+    """ Columns the operations of a scan need are not in the file (the file itself could be read) """
+    pass
+
+
+class Scan():
+    """
+    Columns and rows kept while a file is read, taken from the operations its pipeline starts with (see planner.pushdown)
+
+    columns -> Columns kept, in this order. If None, every column of the file not dropped is kept (in file order)
+    dropped -> Columns never kept
+    filters -> Predicates every kept row must satisfy, checked on each chunk as it is read (see app/predicates.py)
+    report -> Columns and rows of the file and how many of them were skipped, filled while reading (also kept in df.attrs["scan"])
+    """
+    columns: Optional[list[str]]
+    dropped: set[str]
+    filters: list
+    report: dict[str, int]
+
+    def __init__(self):
+        self.columns = None
+        self.dropped = set()
+        self.filters = []
+        self.report = {'columns': 0, 'columns_skipped': 0, 'rows': 0, 'rows_skipped': 0}
+
+    def keeps(self, column: str) -> bool:
+        return (self.columns is None or column in self.columns) and column not in self.dropped
+
+    def reads(self, column: str) -> bool:
+        """ Columns that are not kept are still read if a filter needs them """
+        return self.keeps(column) or any(column in predicates.columns(predicate) for predicate in self.filters)
+
+    def is_empty(self) -> bool:
+        return self.columns is None and not len(self.dropped) and not len(self.filters)
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        """ Filters and projects a decoded chunk of the file, counting what was skipped """
+        rows = len(df)
+        for predicate in self.filters:
+            df = df[predicates.evaluate(predicate, df)]
+        self.report['rows'] += rows
+        self.report['rows_skipped'] += rows - len(df)
+
+        if self.columns is None: return df[[column for column in df.columns if column not in self.dropped]]
+        return df[[column for column in self.columns if column not in self.dropped]]
+
+    def check(self, names: list[str]):
+        """ Raises MissingColumns if a selected, dropped or filtered column is not in the file, as the operations themselves would """
+        filtered = sorted(set().union(*(predicates.columns(predicate) for predicate in self.filters)))
+        missing = [column for column in dict.fromkeys([*(self.columns or []), *sorted(self.dropped), *filtered]) if column not in names]
+        if len(missing):
+            raise MissingColumns(f'columns {", ".join(missing)} are not in the file')
+
+
+def file_type_of(media_type: str | None, filename: str | None = None) -> FileType | None:
+    if media_type:
+        file_type = MEDIA_TYPES.get(media_type.split(';')[0].strip().lower())
+        if file_type is not None: return file_type
+    if filename and '.' in filename:
+        return EXTENSIONS.get(filename.rsplit('.', 1)[1].lower())
+    return None
+
+
+def open(source: BinaryIO | io.StringIO, rules: IoArgs, scan: Optional[Scan] = None) -> pd.DataFrame:
+    """ If a scan is passed, only the columns and rows it keeps are returned (CSV files are filtered chunk by chunk while read) """
+    if scan is not None and not scan.is_empty():
+        return open_scan(source, rules, scan)
+
     match rules.file_type:
         case FileType.CSV:
-            return pd.read_csv(dir=source, decimal=rules.decimal, sep=rules.sep)
-        
-        
-        
+            return pd.read_csv(source, decimal=rules.decimal, sep=rules.sep)
+        case FileType.ARROW:
+            return open_arrow(source)
+        case FileType.PARQUET:
+            return pd.read_parquet(source)
+
+
+def open_scan(source: BinaryIO | io.StringIO, rules: IoArgs, scan: Scan) -> pd.DataFrame:
+    if rules.file_type == FileType.CSV:
+        chunks = list(scan_csv(source, rules, scan))
+        df = chunks[0] if len(chunks) == 1 else pd.concat(chunks)
+    else:
+        if rules.file_type == FileType.PARQUET:
+            # Parquet stores each column apart, so the ones not read are never decoded
+            names = pa.parquet.read_schema(source).names
+            source.seek(0)
+            df = pd.read_parquet(source, columns=[name for name in names if scan.reads(name)])
+        else:
+            df = open(source, rules)
+            names = list(df.columns)
+        scan.check(names)
+        scan.report['columns'] = len(names)
+        df = scan.apply(df)
+        scan.report['columns_skipped'] = scan.report['columns'] - len(df.columns)
+
+    df.attrs['scan'] = dict(scan.report)
+    return df
+
+
+def scan_csv(source: BinaryIO | io.StringIO, rules: IoArgs, scan: Scan, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Reads a CSV file chunk_size rows at a time, yielding each chunk already filtered and projected by the scan
+    Columns that are neither kept nor needed by a filter are never decoded (usecols)
+    """
+    # usecols is called more than once for each column, so the header is kept without repetitions
+    header: dict[str, None] = {}
+    def usecols(column: str) -> bool:
+        header[column] = None
+        return scan.reads(column)
+
+    with pd.read_csv(source, decimal=rules.decimal, sep=rules.sep, usecols=usecols, chunksize=chunk_size) as reader:
+        for i, chunk in enumerate(reader):
+            if i == 0: scan.check(list(header))
+            chunk = scan.apply(chunk)
+            scan.report['columns'] = len(header)
+            scan.report['columns_skipped'] = len(header) - len(chunk.columns)
+            yield chunk
+
+
+def open_arrow(source: BinaryIO) -> pd.DataFrame:
+    """ Reads both Arrow IPC layouts (stream and file), which only differ by the leading magic bytes """
+    magic = source.read(len(ARROW_FILE_MAGIC))
+    source.seek(0)
+    if magic == ARROW_FILE_MAGIC:
+        return pa.ipc.open_file(source).read_pandas()
+    return pa.ipc.open_stream(source).read_pandas()
+
+
+def write_arrow(dataframe: pd.DataFrame, path: str):
+    """ Writes an Arrow IPC file under a temporary name first, so it is never read half written """
+    temporary_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    table = pa.Table.from_pandas(dataframe)
+    with pa.OSFile(temporary_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(temporary_path, path)
+
+
+def read_arrow(path: str) -> pd.DataFrame:
+    """
+    Memory maps an Arrow IPC file instead of reading it
+    Obs.: split_blocks keeps each column on its own block, so columns without nulls are not copied out of the map
+    """
+    return pa.ipc.open_file(pa.memory_map(path)).read_all().to_pandas(split_blocks=True)
+
+
+def negotiate(accept: str | None) -> FileType | None:
+    """ Picks the response file type from an Accept header, following the quality values sent """
+    if not accept: return FileType.JSON
+
+    candidates: list[tuple[float, str, dict[str, str]]] = []
+    for entry in accept.split(','):
+        media_type, *params = [part.strip() for part in entry.split(';')]
+        params = dict(param.split('=', 1) for param in params if '=' in param)
+        try:
+            quality = float(params.pop('q', 1))
+        except ValueError:
+            # A malformed quality value (e.g. q=abc) is taken as q=0, the media range is not acceptable
+            continue
+        if quality > 0: candidates.append((quality, media_type.lower(), params))
+
+    for _, media_type, params in sorted(candidates, key=lambda candidate: -candidate[0]):
+        if media_type in ('*/*', 'application/*'): return FileType.JSON
+        file_type = RESPONSE_MEDIA_TYPES.get(media_type)
+        if file_type == FileType.JSON and params.get('orient') == 'split': return FileType.JSON_SPLIT
+        if file_type is not None: return file_type
+    return None
+
+
+def media_type_of(file_type: FileType) -> str:
+    if file_type == FileType.JSON_SPLIT: return 'application/json'
+    return next(media_type for media_type, value in RESPONSE_MEDIA_TYPES.items() if value == file_type)
+
+
+def stream(dataframe: pd.DataFrame, alias: str, file_type: FileType, batch_size: int = RESPONSE_BATCH_SIZE, trailer: Optional[Callable[[], dict]] = None) -> Iterator[str | bytes]:
+    """
+    Encodes the dataframe in batches of rows, so the full encoded body never exists in memory
+    Obs.: JSON layouts keep the shape of FileData (alias, orient, data) and, like records, drop the index
+    """
+    return stream_batches(batches(dataframe, batch_size), alias, file_type, schema=dataframe, trailer=trailer)
+
+
+def stream_batches(dataframes: Iterable[pd.DataFrame], alias: str, file_type: FileType, schema: pd.DataFrame | None = None, trailer: Optional[Callable[[], dict]] = None) -> Iterator[str | bytes]:
+    """
+    Encodes dataframes that arrive one batch at a time (e.g. chunks of a file) as a single body
+
+    schema -> Frame whose columns and types are used for the whole body. If None, the first batch is used
+    trailer -> Fields added after "data" on JSON layouts, only called once all the data was encoded (e.g. a profile)
+    """
+    dataframes = iter(dataframes)
+    if schema is None:
+        schema = next(dataframes, pd.DataFrame())
+        dataframes = itertools.chain([schema], dataframes)
+
+    match file_type:
+        case FileType.JSON:
+            return _stream_json(dataframes, alias, trailer)
+        case FileType.JSON_SPLIT:
+            return _stream_json_split(dataframes, alias, schema, trailer)
+        case FileType.NDJSON:
+            return _stream_ndjson(dataframes)
+        case FileType.CSV:
+            return _stream_csv(dataframes, schema)
+        case FileType.ARROW:
+            return _stream_arrow(dataframes, schema)
+
+
+def batches(dataframe: pd.DataFrame, batch_size: int) -> Iterator[pd.DataFrame]:
+    for start in range(0, len(dataframe), batch_size):
+        yield dataframe.iloc[start:start + batch_size]
+
+
+def _with_named_index(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """ Columnar layouts keep the index when it carries information (e.g. after REINDEX_COLUMN) """
+    if any(name is not None for name in dataframe.index.names): return dataframe.reset_index()
+    return dataframe
+
+
+def _stream_json(dataframes: Iterator[pd.DataFrame], alias: str, trailer: Optional[Callable[[], dict]] = None) -> Iterator[str]:
+    yield f'{{"alias":{json.dumps(alias)},"orient":"records","data":['
+    separator = ''
+    for batch in dataframes:
+        if not len(batch): continue
+        yield separator + ','.join(_json_rows(batch, 'records'))
+        separator = ','
+    yield ']' + _encode_trailer(trailer) + '}'
+
+
+def _stream_json_split(dataframes: Iterator[pd.DataFrame], alias: str, schema: pd.DataFrame, trailer: Optional[Callable[[], dict]] = None) -> Iterator[str]:
+    columns = json.dumps([str(column) for column in schema.columns])
+    yield f'{{"alias":{json.dumps(alias)},"orient":"split","data":{{"columns":{columns},"data":['
+    separator = ''
+    for batch in dataframes:
+        if not len(batch): continue
+        yield separator + ','.join(_json_rows(batch, 'values'))
+        separator = ','
+    yield ']}' + _encode_trailer(trailer) + '}'
+
+
+def _encode_trailer(trailer: Optional[Callable[[], dict]]) -> str:
+    if trailer is None: return ''
+    return ''.join(f',{json.dumps(key)}:{json.dumps(value, default=str)}' for key, value in trailer().items())
+
+
+def _stream_ndjson(dataframes: Iterator[pd.DataFrame]) -> Iterator[str]:
+    for batch in dataframes:
+        if not len(batch): continue
+        yield '\n'.join(_json_rows(batch, 'records')) + '\n'
+
+
+def _json_rows(batch: pd.DataFrame, layout: str) -> list[str]:
+    """
+    JSON text of each row, as an object ("records") or a list ("values")
+    Obs.: DataFrame.to_json is not used as it rounds floats (double_precision) and adds milliseconds to every datetime,
+    values are encoded as the first responses did (json.dumps of the records): floats read back exactly and datetimes use isoformat
+    """
+    columns = [_json_column(batch.iloc[:, i]) for i in range(len(batch.columns))]
+    if layout == 'values':
+        template = '[' + ','.join(['%s'] * len(columns)) + ']'
+    else:
+        template = '{' + ','.join(json.dumps(str(column)).replace('%', '%%') + ':%s' for column in batch.columns) + '}'
+    if not len(columns): return [template] * len(batch)
+    return list(map(template.__mod__, zip(*columns)))
+
+
+def _json_column(values: pd.Series) -> list[str]:
+    """ JSON text of every value of a column, missing values are null. Numpy dtypes are encoded column at a time """
+    dtype = values.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return _json_codes(values.cat.codes.to_numpy(), _json_column(pd.Series(dtype.categories)))
+    if isinstance(dtype, np.dtype) and dtype.kind in 'biufM':
+        array = values.to_numpy()
+        match dtype.kind:
+            case 'b':
+                return np.where(array, 'true', 'false').tolist()
+            case 'i' | 'u':
+                return list(map(str, array.tolist()))
+            case 'f':
+                # repr is the shortest text that reads back as the same float
+                tokens = list(map(float.__repr__, array.tolist()))
+                for i in np.flatnonzero(~np.isfinite(array)).tolist(): tokens[i] = 'null'
+                return tokens
+            case 'M':
+                return _json_datetimes(array)
+
+    # Text repeats a lot (e.g. sensor names), so each distinct value is only encoded once
+    # Obs.: only text, as factorize takes equal values of other types as the same (1, 1.0 and True)
+    if isinstance(dtype, pd.StringDtype) or (dtype == object and pd.api.types.infer_dtype(values, skipna=True) == 'string'):
+        codes, uniques = pd.factorize(values)
+        return _json_codes(codes, list(map(_json_value, np.asarray(uniques, dtype=object).tolist())))
+    return [_json_value(value) for value in values.to_numpy(dtype=object).tolist()]
+
+
+def _json_codes(codes: np.ndarray, tokens: list[str]) -> list[str]:
+    """ Tokens taken by code, missing values have code -1 and take the null appended at the end """
+    return np.array([*tokens, 'null'], dtype=object)[codes].tolist()
+
+
+def _json_datetimes(array: np.ndarray) -> list[str]:
+    """ Same text as Timestamp.isoformat, the fraction of a second is only written when there is one (6 digits, 9 for nanoseconds) """
+    tokens = np.array(list(map('"{}"'.format, np.datetime_as_string(array, unit='s').tolist())), dtype=object)
+    unit, count = np.datetime_data(array.dtype)
+    per_second = {'ms': 10**3, 'us': 10**6, 'ns': 10**9}.get(unit)
+    if per_second is not None and count == 1:
+        nanoseconds = (array.view('i8') % per_second) * (10**9 // per_second)
+        for i in np.flatnonzero(nanoseconds.astype(bool) & ~np.isnat(array)).tolist():
+            fraction = int(nanoseconds[i])
+            tokens[i] = tokens[i][:-1] + (f'.{fraction // 1000:06d}"' if fraction % 1000 == 0 else f'.{fraction:09d}"')
+    tokens[np.isnat(array)] = 'null'
+    return tokens.tolist()
+
+
+def _json_value(value: Any) -> str:
+    if isinstance(value, np.datetime64): value = pd.Timestamp(value)
+    if value is None or value is pd.NaT or value is pd.NA: return 'null'
+    if isinstance(value, np.generic): value = value.item()
+    if isinstance(value, float) and not math.isfinite(value): return 'null'
+    if isinstance(value, (datetime.date, datetime.time)): return json.dumps(value.isoformat())
+    if isinstance(value, datetime.timedelta): return repr(value.total_seconds())
+    return json.dumps(value, default=str, separators=(',', ':'))
+
+
+def _stream_csv(dataframes: Iterator[pd.DataFrame], schema: pd.DataFrame) -> Iterator[str]:
+    yield _with_named_index(schema.iloc[:0]).to_csv(index=False)
+    for batch in dataframes:
+        yield _with_named_index(batch).to_csv(index=False, header=False)
+
+
+def _stream_arrow(dataframes: Iterator[pd.DataFrame], schema: pd.DataFrame) -> Iterator[bytes]:
+    # The schema is taken from a single frame so that every batch is written with the same types
+    arrow_schema = pa.Schema.from_pandas(_with_named_index(schema), preserve_index=False)
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, arrow_schema)
+    for batch in dataframes:
+        writer.write_batch(pa.RecordBatch.from_pandas(_with_named_index(batch), schema=arrow_schema, preserve_index=False))
+        yield _drain(sink)
+    writer.close()
+    yield _drain(sink)
+
+
+def _drain(sink: io.BytesIO) -> bytes:
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
 def convert(dataframe: pd.DataFrame, rules: IoArgs) -> any: # Figure out how to type this properly
     match rules.file_type:
         case FileType.CSV:
             return convert_to_csv(dataframe=dataframe, rules=rules)
-            
-            
+
+
 def convert_to_csv(dataframe: pd.DataFrame, rules: IoArgs) -> io.StringIO:
     csv = io.StringIO()
     dataframe.to_csv(csv)
-    return csv
\ No newline at end of file
+    return csv
@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+import uuid
+import pandas as pd
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import StrEnum
+from typing import Optional
+from pydantic import BaseModel
+
+from app.io_functions import read_arrow, write_arrow
+from app.models import Operation
+from app.pipeline import Pipeline
+from app.workers import Reservation, WorkerPool
+
+
+class JobState(StrEnum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+
+FINISHED_STATES = (JobState.DONE, JobState.FAILED, JobState.CANCELLED)
+
+
+class JobInfo(BaseModel):
+    job_id: str
+    alias: str
+    state: JobState = JobState.QUEUED
+    operations_total: int
+    operations_done: int = 0
+    current_operation: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float
+    finished_at: Optional[float] = None
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job():
+    info: JobInfo
+    future: Optional[Future]
+    reservation: Reservation
+    cancel_requested: bool
+
+    def __init__(self, info: JobInfo, reservation: Reservation):
+        self.info = info
+        self.future = None
+        self.reservation = reservation
+        self.cancel_requested = False
+
+
+class JobManager():
+    """
+    Runs pipelines in the background, so clients do not hold a connection open while they run
+
+    - Jobs run on a local thread pool, progress is updated between operations
+    - Each job holds a place on the worker pool of the server from submission until it finishes, so jobs share its limits (WorkerPoolFull when it is full)
+    - Cancelling a queued job drops it, a running job stops before its next operation
+    - Results are kept as Arrow IPC files on local disk (root is created with the first one) and removed ttl seconds after the job finished
+    """
+    root: str
+    ttl: float
+
+    def __init__(self, root: str, ttl: float, workers: int, pool: WorkerPool):
+        self.root = root
+        self.ttl = ttl
+        self.workers = workers
+        self.pool = pool
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+        return self._executor
+
+    def result_path(self, job_id: str) -> str:
+        return os.path.join(self.root, job_id + '.arrow')
+
+    def submit(self, pipeline: Pipeline, df: pd.DataFrame, alias: str) -> JobInfo:
+        self.expire()
+        job = Job(JobInfo(job_id=uuid.uuid4().hex, alias=alias, operations_total=len(pipeline), created_at=time.time()), self.pool.reserve())
+        with self._lock:
+            self._jobs[job.info.job_id] = job
+        job.future = self.executor.submit(self._run, job, pipeline, df)
+        return job.info
+
+    def get(self, job_id: str) -> JobInfo:
+        self.expire()
+        return self._job(job_id).info
+
+    def result(self, job_id: str) -> pd.DataFrame:
+        job = self._job(job_id)
+        if job.info.state != JobState.DONE:
+            raise ValueError(f'job {job_id} is {job.info.state}, results only exist for done jobs')
+        try:
+            return read_arrow(self.result_path(job_id))
+        except FileNotFoundError:
+            # Expired (or cancelled) since its state was read
+            raise KeyError(f'job {job_id} does not exist')
+
+    def cancel(self, job_id: str) -> JobInfo:
+        """ Cancels unfinished jobs, finished jobs are forgotten and their results removed """
+        job = self._job(job_id)
+        if job.info.state in FINISHED_STATES:
+            self._remove(job_id)
+            return job.info
+
+        job.cancel_requested = True
+        if job.future is not None and job.future.cancel():
+            job.reservation.stop()
+            self._finish(job, JobState.CANCELLED)
+        return job.info
+
+    def expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items() if job.info.finished_at is not None and now - job.info.finished_at > self.ttl]
+        for job_id in expired: self._remove(job_id)
+
+        # Results left behind by previous runs of the server
+        if not os.path.isdir(self.root): return
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if name.split('.')[0] not in self._jobs and now - os.path.getmtime(path) > self.ttl: os.remove(path)
+            except FileNotFoundError:
+                # Removed by a request expiring jobs at the same time
+                pass
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _job(self, job_id: str) -> Job:
+        with self._lock:
+            if job_id not in self._jobs: raise KeyError(f'job {job_id} does not exist')
+            return self._jobs[job_id]
+
+    def _remove(self, job_id: str):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+        try:
+            os.remove(self.result_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def _run(self, job: Job, pipeline: Pipeline, df: pd.DataFrame):
+        job.reservation.start()
+        try:
+            self._run_reserved(job, pipeline, df)
+        finally:
+            job.reservation.stop(job.info.state == JobState.DONE)
+
+    def _run_reserved(self, job: Job, pipeline: Pipeline, df: pd.DataFrame):
+        job.info.state = JobState.RUNNING
+
+        def on_step(i: int, op: Operation):
+            if job.cancel_requested: raise JobCancelled()
+            job.info.operations_done = i
+            job.info.current_operation = op.__code__
+
+        try:
+            result = pipeline(df, on_step=on_step)
+            if not isinstance(result, pd.DataFrame):
+                raise ValueError(f'operations must result in a dataframe, not {type(result).__name__}')
+            os.makedirs(self.root, exist_ok=True)
+            write_arrow(result, self.result_path(job.info.job_id))
+            job.info.operations_done = len(pipeline)
+            self._finish(job, JobState.DONE)
+        except JobCancelled:
+            self._finish(job, JobState.CANCELLED)
+        except Exception as e:
+            job.info.error = str(e)
+            self._finish(job, JobState.FAILED)
+
+    def _finish(self, job: Job, state: JobState):
+        job.info.state = state
+        job.info.current_operation = None
+        job.info.finished_at = time.time()
@@ -1,34 +1,61 @@
-import io
 import pandas as pd
-from typing import List, Dict, Any, Union
-from fastapi import FastAPI, UploadFile, HTTPException, File
-from pydantic import BaseModel
-from io import BytesIO
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Iterator, List, Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from fastapi.exceptions import RequestValidationError
+from pydantic import TypeAdapter, ValidationError
+from starlette.datastructures import FormData, UploadFile
 
+from app.io_functions import FileType, IoArgs, MissingColumns, file_type_of, media_type_of, negotiate, stream, stream_batches, open as open_file
+from app.chunked import run_chunked
+from app.config import CHUNK_SIZE, DATASET_STORE_DIR, DATASET_STORE_MAX_BYTES, PIPELINE_CACHE_SIZE
+from app.config import WORKER_COUNT, WORKER_MODE, WORKER_QUEUE_SIZE, WORKER_RETRY_AFTER, WORKER_TIMEOUT
+from app.config import JOB_RESULT_DIR, JOB_RESULT_TTL, JOB_WORKERS
+from app.dataset_store import DatasetInfo, DatasetStore
+from app.incremental import SensorStream, StreamInfo, StreamManager, StreamRules
+from app.jobs import JobInfo, JobManager
+from app.metrics import Metrics
+from app.models import FileData, OperationData, RequestBody
 from app.operations import OPERATIONS, Operation
+from app.pipeline import Pipeline, PipelineCache, pipeline_key
+from app.planner import explain, plan, pushdown
+from app.profiling import StepProfile, Stopwatch, measured, run_profiled, server_timing
+from app.workers import Reservation, WorkerPool, WorkerPoolFull
 
-app = FastAPI()
 
-class OperationData(BaseModel):
-    code: str
-    attributes: Dict[str, Any]
+def copy_on_write():
+    """
+    Operations return new frames that share every column they do not change, copy-on-write makes that safe:
+    a column is only copied when one of the frames sharing it is modified
+    """
+    pd.set_option('mode.copy_on_write', True)
 
 
-class FileData(BaseModel):
-    alias: str
-    data: list[dict]
+# Set for the whole process when the app is imported, so every thread runs with it however the app is started
+# (uvicorn, or a TestClient with or without its lifespan). Code that needs it off in the same process has to turn it off itself
+copy_on_write()
 
-    def to_dataframe(self) -> pd.DataFrame:
-        return pd.DataFrame(self.data)
+PIPELINES = PipelineCache(maxsize=PIPELINE_CACHE_SIZE)
+DATASETS = DatasetStore(root=DATASET_STORE_DIR, max_bytes=DATASET_STORE_MAX_BYTES)
+WORKERS = WorkerPool(mode=WORKER_MODE, workers=WORKER_COUNT, queue_size=WORKER_QUEUE_SIZE, timeout=WORKER_TIMEOUT, initializer=copy_on_write)
+JOBS = JobManager(root=JOB_RESULT_DIR, ttl=JOB_RESULT_TTL, workers=JOB_WORKERS, pool=WORKERS)
+METRICS = Metrics()
+STREAMS = StreamManager()
 
-    def set_file_data(self, file: pd.DataFrame):
-        self.data = file.to_dict('records')
-        return
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    WORKERS.shutdown()
+    JOBS.shutdown()
 
-class RequestBody(BaseModel):
-    file: FileData
-    operations: list[OperationData]
+
+app = FastAPI(lifespan=lifespan)
+
+OPERATIONS_ADAPTER = TypeAdapter(list[OperationData])
 
 
 # Health check endpoint
@@ -37,37 +64,383 @@ async def hello():
     return "Hello!"
 
 
+@app.get('/pipelines/cache')
+async def pipeline_cache_info() -> dict[str, int]:
+    return PIPELINES.info()
+
+
+@app.get('/workers')
+async def worker_pool_info() -> dict[str, Any]:
+    return WORKERS.info()
+
+
+@app.get('/metrics')
+async def metrics() -> PlainTextResponse:
+    """ Latency histograms of operations and request phases, in the Prometheus text format """
+    return PlainTextResponse(METRICS.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.post('/datasets')
+async def upload_dataset(request: Request) -> DatasetInfo:
+    """
+    Stores a file once so many pipelines can run over it by passing its "dataset_id" to /file
+    - application/json: FileData
+    - multipart/form-data: a "file" part (CSV, Arrow IPC or Parquet), as on /file
+    """
+    media_type = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    try:
+        if media_type == 'multipart/form-data':
+            file = read_form_file(await request.form())
+        else:
+            file = FileData.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+    validate_file(file)
+    return DATASETS.put(file.to_dataframe())
+
+
+def load_dataset(dataset_id: str) -> pd.DataFrame:
+    try:
+        return DATASETS.get(dataset_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"dataset {dataset_id} does not exist")
+
+
 @app.post("/file")
-async def data_wrangle(body: RequestBody) -> FileData:
-    validate_operations(body.operations)
+async def data_wrangle(request: Request) -> FileData:
+    """
+    Accepts the file in the body in one of these layouts (chosen by content type):
+    - application/json: RequestBody, with the file data as records or in a columnar orient
+    - multipart/form-data: a "file" part (CSV, Arrow IPC or Parquet) and an "operations" part (JSON list)
+    Instead of the file, the "dataset_id" of a dataset stored on /datasets may be passed.
+
+    The response is streamed in the format asked on the Accept header (see io_functions.RESPONSE_MEDIA_TYPES),
+    JSON records being the default.
+    Time spent on each step is sent on the Server-Timing header, JSON responses also get a "profile" if it was asked for.
+    Filters and projections at the start of the plan are run while uploaded files are read (see planner.pushdown),
+    the rows and columns of the file and the ones kept are on the "parse" step of the profile.
+    """
+    file_type = negotiate_response(request)
+    parse, validate = Stopwatch(), Stopwatch()
+    parse.start()
+    body = await read_request_body(request)
+    parse.stop()
+    validate.start()
+    pipeline = validate_operations(body.operations)
+    if body.explain:
+        return JSONResponse({'operations': [op.model_dump() for op in body.operations], 'plan': explain(pipeline.operations)})
+    validate_file(body.file)
+    validate.stop()
+    parse_step = parse.step('parse')
+    if body.file.pushed_operations:
+        scan = body.file.to_dataframe().attrs['scan']
+        parse_step.rows_in, parse_step.rows_out = scan['rows'], scan['rows'] - scan['rows_skipped']
+        parse_step.columns_in, parse_step.columns_out = scan['columns'], scan['columns'] - scan['columns_skipped']
+    processed_file, steps = await run_operations(pipeline.skip(body.file.pushed_operations), body.file, profile=body.profile)
+    return stream_file(processed_file, file_type, [parse_step, validate.step('validate')] + steps, body.profile)
+
+
+@app.post('/jobs', status_code=202)
+async def submit_job(request: Request) -> JobInfo:
+    """ Runs the operations in the background, the body is the same as on /file (inline file or dataset_id) """
+    body = await read_request_body(request)
+    pipeline = validate_operations(body.operations)
     validate_file(body.file)
-    processed_file = run_operations(body.operations, body.file)
-    return processed_file
+    try:
+        return JOBS.submit(pipeline.skip(body.file.pushed_operations), body.file.to_dataframe(), body.file.alias)
+    except WorkerPoolFull:
+        raise server_busy()
+
+
+@app.get('/jobs/{job_id}')
+async def get_job(job_id: str) -> JobInfo:
+    try:
+        return JOBS.get(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"job {job_id} does not exist")
 
 
-def run_operations(operations: List[OperationData], file: FileData) -> FileData:
-    file_df = file.to_dataframe()
-    for operation in operations:
-        op: Operation = OPERATIONS[operation.code](**operation.attributes)
-        file_df = op(file_df)
+@app.get('/jobs/{job_id}/result')
+async def get_job_result(job_id: str, request: Request) -> FileData:
+    """ Streams the result of a done job, in the format asked on the Accept header (as on /file) """
+    file_type = negotiate_response(request)
+    try:
+        info = JOBS.get(job_id)
+        result = JOBS.result(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"job {job_id} does not exist")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return stream_file(FileData.from_dataframe(info.alias, result), file_type)
 
-    file.set_file_data(file_df)
-    return file
-    
 
-def validate_operations(operations: List[OperationData]):
-    for op in operations:
-        if op.code not in OPERATIONS:
-            raise HTTPException(status_code=501, detail=f"operation {op.code} is not a valid operation")
-        
+@app.delete('/jobs/{job_id}')
+async def cancel_job(job_id: str) -> JobInfo:
+    try:
+        return JOBS.cancel(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"job {job_id} does not exist")
+
+
+@app.post("/file/chunked")
+async def data_wrangle_chunked(request: Request) -> FileData:
+    """
+    Chunked execution mode, for CSV files too big to be loaded at once (see app/chunked.py)
+    - multipart/form-data with a CSV "file" part and an "operations" part, as on /file
+    - "chunk_size" (optional) is the number of rows processed at a time
+    """
+    file_type = negotiate_response(request)
+    form = await request.form()
+    try:
+        operations = read_form_operations(form)
+        chunk_size = int(form.get('chunk_size', CHUNK_SIZE))
+    except (ValidationError, ValueError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    upload, rules = read_upload(form)
+    pipeline = validate_operations(operations)
+    try:
+        # Chunks are read while the response streams, so the work holds a place of the worker pool instead of running on it
+        reservation = WORKERS.reserve()
+    except WorkerPoolFull:
+        raise server_busy()
+    try:
+        chunks = await run_in_threadpool(run_reserved, reservation, run_chunked, upload.file, rules, pipeline, chunk_size)
+    except (KeyError, ValueError) as e:
+        raise unprocessable(e)
+
+    alias = form.get('alias', upload.filename or 'file')
+    # Also freed when the client disconnects before the last chunk
+    return StreamingResponse(stream_batches(chunks, alias, file_type), media_type=media_type_of(file_type), background=BackgroundTask(reservation.stop))
+
+
+@app.post('/streams')
+async def create_stream(request: Request) -> StreamInfo:
+    """ Starts an incremental stream of sensor exports (see app/incremental.py), the body is StreamRules (empty for the default rules) """
+    body = await request.body()
+    try:
+        rules = StreamRules.model_validate_json(body) if len(body) else StreamRules()
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    return STREAMS.create(rules)
+
+
+@app.get('/streams/{stream_id}')
+async def get_stream(stream_id: str) -> StreamInfo:
+    return load_stream(stream_id).info
+
+
+@app.post('/streams/{stream_id}/rows')
+async def append_stream(stream_id: str, request: Request) -> FileData:
+    """
+    Appends the rows of a new export to the stream and streams back only the processed rows that changed (Accept as on /file)
+    - application/json: FileData
+    - multipart/form-data: a "file" part (e.g. the CSV export, with "decimal" and "sep"), as on /file
+    """
+    file_type = negotiate_response(request)
+    stream = load_stream(stream_id)
+    media_type = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    try:
+        if media_type == 'multipart/form-data':
+            file = read_form_file(await request.form())
+        else:
+            file = FileData.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+    validate_file(file)
+    try:
+        changed = await run_in_threadpool(stream.append, file.to_dataframe())
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return stream_file(FileData.from_dataframe(file.alias, changed.reset_index()), file_type)
+
+
+@app.get('/streams/{stream_id}/rows')
+async def get_stream_rows(stream_id: str, request: Request) -> FileData:
+    """ Streams every processed row of the stream so far (Accept as on /file) """
+    file_type = negotiate_response(request)
+    stream = load_stream(stream_id)
+    return stream_file(FileData.from_dataframe(stream_id, stream.frame().reset_index()), file_type)
+
+
+@app.delete('/streams/{stream_id}')
+async def delete_stream(stream_id: str) -> StreamInfo:
+    try:
+        return STREAMS.delete(stream_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"stream {stream_id} does not exist")
+
+
+def load_stream(stream_id: str) -> SensorStream:
+    try:
+        return STREAMS.get(stream_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"stream {stream_id} does not exist")
+
+
+def negotiate_response(request: Request) -> FileType:
+    file_type = negotiate(request.headers.get('accept'))
+    if file_type is None:
+        raise HTTPException(status_code=406, detail=f"none of the accepted media types {request.headers.get('accept')} are supported")
+    return file_type
+
+
+def stream_file(file: FileData, file_type: FileType, steps: Optional[list[StepProfile]] = None, profile: bool = False) -> StreamingResponse:
+    """ If steps are passed, they are recorded on METRICS and sent on the Server-Timing header, along with the encoding time if profile is True """
+    if steps is None:
+        return StreamingResponse(stream(file.to_dataframe(), file.alias, file_type), media_type=media_type_of(file_type))
+
+    for step in steps:
+        histogram = METRICS.operation_seconds if step.operation else METRICS.phase_seconds
+        histogram.observe(step.name, step.wall_seconds)
+
+    # The body is encoded while it is sent, so encoding is only known when the profile is written at its end
+    encode = Stopwatch()
+    trailer = None
+    if profile: trailer = lambda: {'profile': {'steps': [step.model_dump(exclude_none=True) for step in steps + [encode.step('encode')]]}}
+    chunks = measured(stream(file.to_dataframe(), file.alias, file_type, trailer=trailer), encode, lambda: METRICS.phase_seconds.observe('encode', encode.wall_seconds))
+    return StreamingResponse(chunks, media_type=media_type_of(file_type), headers={'Server-Timing': server_timing(steps)})
+
+
+async def read_request_body(request: Request) -> RequestBody:
+    media_type = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    try:
+        if media_type == 'multipart/form-data':
+            body = read_multipart_body(await request.form())
+        else:
+            body = RequestBody.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+    if body.dataset_id is not None:
+        body.file = FileData.from_dataframe(body.dataset_id, load_dataset(body.dataset_id))
+    return body
+
+
+def read_multipart_body(form: FormData) -> RequestBody:
+    explain_only = form.get('explain', 'false').lower() in ('true', '1')
+    profile = form.get('profile', 'false').lower() in ('true', '1')
+    if 'dataset_id' in form:
+        return RequestBody(dataset_id=form.get('dataset_id'), operations=read_form_operations(form), explain=explain_only, profile=profile)
+
+    # Operations are compiled before the file is read, so the reader can run the ones it is able to
+    operations = read_form_operations(form)
+    file = read_form_file(form, validate_operations(operations))
+    return RequestBody.model_construct(file=file, dataset_id=None, operations=operations, explain=explain_only, profile=profile)
+
+
+def read_form_file(form: FormData, pipeline: Optional[Pipeline] = None) -> FileData:
+    """ If a pipeline is passed, its leading filters and projections are run while the file is read """
+    upload, rules = read_upload(form)
+    scan, pushed = pushdown(pipeline.operations) if pipeline is not None else (None, 0)
+    try:
+        df = open_file(upload.file, rules, scan)
+    except MissingColumns as e:
+        # The file was read, the operations do not fit it
+        raise unprocessable(e)
+    except Exception:
+        raise HTTPException(status_code=422, detail=f"unprocessable file")
+
+    optimize_dtypes = form.get('optimize_dtypes', 'false').lower() in ('true', '1')
+    return FileData.from_dataframe(form.get('alias', upload.filename or 'file'), df, optimize_dtypes, pushed)
+
+
+def read_upload(form: FormData) -> tuple[UploadFile, IoArgs]:
+    upload = form.get('file')
+    if not isinstance(upload, UploadFile):
+        raise HTTPException(status_code=422, detail="multipart body must have a \"file\" part")
+
+    file_type = file_type_of(upload.content_type, upload.filename)
+    if file_type is None:
+        raise HTTPException(status_code=415, detail=f"file type {upload.content_type} is not supported")
+
+    return upload, IoArgs(file_type=file_type, decimal=form.get('decimal', '.'), sep=form.get('sep', ','))
+
+
+def read_form_operations(form: FormData) -> list[OperationData]:
+    operations = form.get('operations', '[]')
+    if isinstance(operations, UploadFile): operations = operations.file.read()
+    return OPERATIONS_ADAPTER.validate_json(operations)
+
+
+async def run_operations(pipeline: Pipeline, file: FileData, profile: bool = False) -> tuple[FileData, list[StepProfile]]:
+    """ Pipelines run on the worker pool, so the event loop keeps serving other requests meanwhile """
+    wait = Stopwatch()
+    try:
+        wait.start()
+        df, steps = await WORKERS.run(run_profiled, pipeline, file.to_dataframe(), profile)
+        wait.stop()
+        file.set_dataframe(df)
+    except WorkerPoolFull:
+        raise server_busy()
+    except TimeoutError:
+        raise HTTPException(status_code=504, detail=f"operations did not finish in {WORKERS.timeout} seconds")
+    except (KeyError, ValueError) as e:
+        raise unprocessable(e)
+    waited = wait.wall_seconds - sum(step.wall_seconds for step in steps)
+    return file, [StepProfile(name='wait', wall_seconds=max(waited, 0))] + steps
+
+
+def run_reserved(reservation: Reservation, function: Callable[..., Iterator], *args) -> Iterator:
+    """ Runs function once one of the workers is free, the place is held until its result is read to the end or it fails """
+    reservation.start()
+    try:
+        result = function(*args)
+    except BaseException:
+        reservation.stop(completed=False)
+        raise
+    return read_reserved(reservation, result)
+
+
+def read_reserved(reservation: Reservation, result: Iterator) -> Iterator:
+    try:
+        yield from result
+    except BaseException:
+        reservation.stop(completed=False)
+        raise
+    reservation.stop()
+
+
+def server_busy() -> HTTPException:
+    return HTTPException(status_code=503, detail="server is busy, try again later", headers={'Retry-After': str(WORKER_RETRY_AFTER)})
+
+
+def unprocessable(e: KeyError | ValueError) -> HTTPException:
+    """ Operations that can not run on the data sent (e.g. on a column it does not have) """
+    # KeyError quotes its message
+    detail = e.args[0] if isinstance(e, KeyError) and len(e.args) else e
+    return HTTPException(status_code=422, detail=str(detail))
+
+
+def validate_operations(operations: List[OperationData]) -> Pipeline:
+    """ Compiles and plans operations into a pipeline, reusing the cached one when the same operations were already sent """
+    key = pipeline_key(operations)
+    pipeline = PIPELINES.get(key)
+    if pipeline is None:
         try:
-            OPERATIONS[op.code](**op.attributes)
-        except:
-            raise HTTPException(status_code=422, detail=f"attributes {op.attributes} for operation {op.code} are not valid")
+            pipeline = Pipeline(key, plan([build_operation(op) for op in operations]))
+        except TypeError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if pipeline.returns is not pd.DataFrame:
+            raise HTTPException(status_code=422, detail=f"operations must result in a DataFrame, not in a {pipeline.returns.__name__} (e.g. end them with JOIN_DATA_TABLE)")
+        PIPELINES.put(pipeline)
+    return pipeline
+
+
+def build_operation(op: OperationData) -> Operation:
+    if op.code not in OPERATIONS:
+        raise HTTPException(status_code=501, detail=f"operation {op.code} is not a valid operation")
+
+    try:
+        return OPERATIONS[op.code](**op.attributes)
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"attributes {op.attributes} for operation {op.code} are not valid: {e}")
 
 
 def validate_file(file: FileData):
     try:
         file.to_dataframe()
     except Exception as e:
-        raise HTTPException(status_code=422, detail=f"unprocessable file")
\ No newline at end of file
+        raise HTTPException(status_code=422, detail=f"unprocessable file")
@@ -0,0 +1,67 @@
+import math
+import threading
+from typing import Iterable
+
+"""
+    Metrics kept in memory and exposed on /metrics in the Prometheus text format
+"""
+
+# Upper bounds (in seconds) of the latency buckets
+DEFAULT_BUCKETS: tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram():
+    """
+    Cumulative histogram with one series per value of a single label (e.g. the operation code)
+    """
+    name: str
+    documentation: str
+    label: str
+    buckets: tuple[float, ...]
+
+    def __init__(self, name: str, documentation: str, label: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series: dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float):
+        with self._lock:
+            counts, total = self._series.setdefault(label_value, [[0] * len(self.buckets), 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: counts[i] += 1
+            self._series[label_value][1] = total + value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_value, (counts, total) in sorted(self._series.items()):
+                label = f'{self.label}="{_escape(label_value)}"'
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label},le="{_format_bound(bound)}"}} {count}')
+                lines.append(f'{self.name}_sum{{{label}}} {total}')
+                lines.append(f'{self.name}_count{{{label}}} {counts[-1]}')
+        return lines
+
+
+class Metrics():
+    """ Histograms collected from /file requests (see app/profiling.py) """
+    operation_seconds: Histogram
+    phase_seconds: Histogram
+
+    def __init__(self):
+        self.operation_seconds = Histogram('data_wrangling_operation_seconds', 'Time spent running each operation', 'code')
+        self.phase_seconds = Histogram('data_wrangling_request_phase_seconds', 'Time spent on each phase of a /file request', 'phase')
+
+    def render(self) -> str:
+        return '\n'.join(self.operation_seconds.render() + self.phase_seconds.render()) + '\n'
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == math.inf else repr(float(bound))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
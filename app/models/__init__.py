@@ -1,3 +1,4 @@
-from .operation import *
 from .data_table import *
-from .data_group import *
\ No newline at end of file
+from .data_group import *
+from .operation import *
+from .request_model import *
\ No newline at end of file
@@ -5,3 +5,13 @@ from app.models import DataTable
 class DataGroup(BaseModel):
     dfs: list[DataTable] = []
 
+    def get(self, alias: str) -> DataTable:
+        for table in self.dfs:
+            if table.alias == alias: return table
+
+        raise KeyError(f'table {alias} is not in the Data Group')
+
+    def replace(self, table: DataTable) -> 'DataGroup':
+        """ New Data Group with the table of the same alias replaced (tables are not copied) """
+        self.get(table.alias)
+        return DataGroup(dfs=[table if current.alias == table.alias else current for current in self.dfs])
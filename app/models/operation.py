@@ -1,9 +1,52 @@
+from typing import Optional
 from pydantic import BaseModel
 import pandas as pd
 
+from app.io_functions import Scan
+from app.models.data_group import DataGroup
+
 
 class Operation(BaseModel):
+    """
+    Operation rules:
+    - The dataframe (or Data Group) received is never modified, a new one is returned
+    - Columns that are not changed are shared with the input instead of copied
+    Obs.: sharing columns is only safe with copy-on-write, importing the app enables it (see app/main.py)
+    """
     __code__: str = ''
 
+    # Hints used by the planner (app/planner.py) to reorder and fuse operations
+    # __filters_rows__ -> Only removes rows, values and order of the remaining rows are left untouched
+    # __sorts_rows__ -> Only changes the order of rows
+    # __row_local__ -> Each row only depends on itself, so running on chunks of rows gives the same result (see app/chunked.py)
+    __filters_rows__: bool = False
+    __sorts_rows__: bool = False
+    __row_local__: bool = False
+
+    # Types of data the operation runs on, checked when pipelines are compiled (see app/pipeline.py)
+    # __takes__ -> Types accepted as input
+    # __returns__ -> Type returned, None if it is the same type taken
+    __takes__: tuple[type, ...] = (pd.DataFrame,)
+    __returns__: Optional[type] = None
+
     def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
-        pass
\ No newline at end of file
+        pass
+
+    def returns(self, taken: type) -> type:
+        """ Type returned when running on the type taken, raises TypeError if the operation does not run on it """
+        if taken not in self.__takes__:
+            accepted = ' or '.join(accepted.__name__ for accepted in self.__takes__)
+            raise TypeError(f'{self.__code__} runs on a {accepted}, not on a {taken.__name__}')
+        return self.__returns__ or taken
+
+    def commutes_with(self, previous: 'Operation') -> bool:
+        """ Whether running this operation before the previous one gives exactly the same result """
+        return False
+
+    def merge(self, following: 'Operation') -> Optional['Operation']:
+        """ Single operation equivalent to running this one and then the following one, if there is one """
+        return None
+
+    def push_into(self, scan: Scan) -> bool:
+        """ Hands the operation to the reader of the file (see planner.pushdown), returns False if the reader can not run it """
+        return False
@@ -0,0 +1,97 @@
+import pandas as pd
+from typing import Any, Dict, Literal, Optional
+from pydantic import BaseModel, PrivateAttr, model_validator
+
+from app import dtypes
+
+
+class OperationData(BaseModel):
+    code: str
+    attributes: Dict[str, Any]
+
+
+class FileData(BaseModel):
+    """
+    File rules:
+    - Data can be sent as a list of records or in a columnar layout (orient)
+    - "split" expects {"columns": [...], "data": [[...], ...]} and optionally "index"
+    - "columns" expects {column_name: [values, ...]}
+
+    Files decoded from other formats (CSV, Arrow, Parquet) keep their dataframe directly,
+    so no records are ever built for them.
+
+    optimize_dtypes -> If True, the dataframe gets smaller dtypes as soon as it is built (as OPTIMIZE_DTYPES with its defaults)
+    pushed_operations -> How many operations of the pipeline the reader already ran while decoding the file (see planner.pushdown)
+    """
+    alias: str
+    orient: Literal['records', 'split', 'columns'] = 'records'
+    data: list[dict] | dict[str, Any] = []
+    optimize_dtypes: bool = False
+
+    _dataframe: Optional[pd.DataFrame] = PrivateAttr(default=None)
+    _pushed_operations: int = PrivateAttr(default=0)
+
+
+    @model_validator(mode='after')
+    def enforce_orient(self):
+        if (self.orient == 'records') == isinstance(self.data, list):
+            return self
+
+        raise ValueError(f'data does not match the "{self.orient}" orient')
+
+
+    @classmethod
+    def from_dataframe(cls, alias: str, df: pd.DataFrame, optimize_dtypes: bool = False, pushed_operations: int = 0) -> 'FileData':
+        file = cls(alias=alias, optimize_dtypes=optimize_dtypes)
+        file._dataframe = dtypes.optimize(df) if optimize_dtypes else df
+        file._pushed_operations = pushed_operations
+        return file
+
+    @property
+    def pushed_operations(self) -> int:
+        return self._pushed_operations
+
+    def to_dataframe(self) -> pd.DataFrame:
+        if self._dataframe is None:
+            match self.orient:
+                case 'split':
+                    self._dataframe = pd.DataFrame(data=self.data['data'], columns=self.data['columns'], index=self.data.get('index'))
+                case _:
+                    self._dataframe = pd.DataFrame(self.data)
+            if self.optimize_dtypes: self._dataframe = dtypes.optimize(self._dataframe)
+
+        return self._dataframe
+
+    def set_dataframe(self, file: pd.DataFrame):
+        """ Keeps only the dataframe, records are built solely if set_file_data is called """
+        self._dataframe = file
+        self.orient = 'records'
+        self.data = []
+
+    def set_file_data(self, file: pd.DataFrame):
+        self._dataframe = file
+        self.orient = 'records'
+        self.data = file.to_dict('records')
+        return
+
+
+class RequestBody(BaseModel):
+    """
+    file -> File sent inline
+    dataset_id -> Id of a dataset already uploaded to /datasets, used instead of an inline file
+    explain -> If True, the optimized plan for the operations is returned instead of running them
+    profile -> If True, allocations are measured too and the profile of each step is added to JSON responses (see app/profiling.py)
+    """
+    file: Optional[FileData] = None
+    dataset_id: Optional[str] = None
+    operations: list[OperationData]
+    explain: bool = False
+    profile: bool = False
+
+
+    @model_validator(mode='after')
+    def enforce_one_source(self):
+        if (self.file is None) != (self.dataset_id is None):
+            return self
+
+        raise ValueError('either file or dataset_id must be passed')
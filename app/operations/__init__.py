@@ -8,4 +8,5 @@ from .row_operations import *
 OPERATIONS: dict[str, BaseModel] = {
     **COLUMN_OPERATIONS,
     **DATASET_OPERATIONS,
+    **ROW_OPERATIONS,
 }
\ No newline at end of file
@@ -1,7 +1,11 @@
 import sys, inspect
 import pandas as pd
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Optional
 
+from app import datetimes, dtypes, predicates
+from app.config import COLUMN_WORKERS
+from app.io_functions import Scan
 from app.models import Operation
 
 
@@ -10,14 +14,16 @@ class SortColumn(Operation):
     Sort rules:
     - Defining the column from which the dataframe will be sorted
     - Can be sorted ascending or descending (default is ascending)
+    - Sorting is stable, rows with equal values keep their relative order
     """
     __code__ = 'SORT_COLUMN'
+    __sorts_rows__ = True
     
     column_name: str
     ascending: bool = True
 
     def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
-        return df.sort_values(self.column_name, ascending=self.ascending)
+        return df.sort_values(self.column_name, ascending=self.ascending, kind='stable')
 
 
 class ReindexColumn(Operation):
@@ -26,6 +32,7 @@ class ReindexColumn(Operation):
     - Defining the column which will be the new index
     """
     __code__ = 'REINDEX_COLUMN'
+    __row_local__ = True
 
     column_name: str
         
@@ -39,12 +46,20 @@ class RemoveDuplicateValuesColumn(Operation):
     - Defining the columns which will be considered to remove duplicates
     """
     __code__ = 'REMOVE_DUPLICATES_VALUES_COLUMN'
+    __filters_rows__ = True
 
     column_names: list[str]
 
     def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
         return df.drop_duplicates(subset=self.column_names)
 
+    def commutes_with(self, previous: Operation) -> bool:
+        # Duplicates share the sorted value, so a stable sort keeps the same first occurrence
+        if isinstance(previous, SortColumn): return previous.column_name in self.column_names
+        if isinstance(previous, ClipValuesColumn): return not set(previous.column_names) & set(self.column_names)
+        if isinstance(previous, FilterRows): return predicates.columns(previous.predicate) <= set(self.column_names)
+        return False
+
 
 class RemoveMissingValuesColumn(Operation):
     """
@@ -54,12 +69,95 @@ class RemoveMissingValuesColumn(Operation):
     how: "any" | "all"
     """
     __code__ = 'REMOVE_MISSING_VALUES_COLUMN'
+    __filters_rows__ = True
+    __row_local__ = True
 
     how: str
         
     def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
         return df.dropna(how=self.how)
 
+    def commutes_with(self, previous: Operation) -> bool:
+        # None of these create or remove missing values
+        return isinstance(previous, (SortColumn, RenameColumn, ClipValuesColumn, FilterRows))
+
+
+class FilterRows(Operation):
+    """
+    Filter rules:
+    - Keeps only the rows where the predicate is true (see app/predicates.py for the predicate language)
+    - e.g. {"op": "and", "predicates": [{"op": ">=", "column": "LatD", "value": 30}, {"op": "in", "column": "State", "values": ["OH", "WA"]}]}
+    
+    The predicate is validated when the operation is built and evaluated as a single mask over whole columns
+    """
+    __code__ = 'FILTER_ROWS'
+    __filters_rows__ = True
+    __row_local__ = True
+
+    predicate: predicates.Predicate
+
+    def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
+        mask = predicates.evaluate(self.predicate, df)
+        if mask.all(): return df.copy(deep=False)
+        return df[mask]
+
+    def commutes_with(self, previous: Operation) -> bool:
+        columns = predicates.columns(self.predicate)
+        if isinstance(previous, (SortColumn, RemoveMissingValuesColumn, FilterRows)): return True
+        # Duplicates share the values the predicate reads, so they are either all kept or all removed
+        if isinstance(previous, RemoveDuplicateValuesColumn): return columns <= set(previous.column_names)
+        if isinstance(previous, RenameColumn): return not columns & (set(previous.column_names) | set(previous.new_names))
+        if isinstance(previous, (ClipValuesColumn, ParseDatetimeColumn)): return not columns & set(previous.column_names)
+        if isinstance(previous, (StandardizeColumn, ReindexColumn)): return previous.column_name not in columns
+        return False
+
+    def merge(self, following: Operation) -> Optional[Operation]:
+        if not isinstance(following, FilterRows): return None
+        return FilterRows(predicate=predicates.And(op='and', predicates=[self.predicate, following.predicate]))
+
+    def push_into(self, scan: Scan) -> bool:
+        if not all(scan.keeps(column) for column in predicates.columns(self.predicate)): return False
+        scan.filters.append(self.predicate)
+        return True
+
+
+class SelectColumns(Operation):
+    """
+    Select rules:
+    - Keeps only the columns passed, in the order they are passed
+    """
+    __code__ = 'SELECT_COLUMNS'
+    __row_local__ = True
+
+    column_names: list[str]
+
+    def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
+        return df[self.column_names]
+
+    def push_into(self, scan: Scan) -> bool:
+        if not all(scan.keeps(column) for column in self.column_names): return False
+        scan.columns = list(self.column_names)
+        return True
+
+
+class DropColumns(Operation):
+    """
+    Drop rules:
+    - Removes the columns passed, every other column is kept
+    """
+    __code__ = 'DROP_COLUMNS'
+    __row_local__ = True
+
+    column_names: list[str]
+
+    def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
+        return df.drop(columns=self.column_names)
+
+    def push_into(self, scan: Scan) -> bool:
+        if not all(scan.keeps(column) for column in self.column_names): return False
+        scan.dropped.update(self.column_names)
+        return True
+
 
 class ParseDatetimeColumn(Operation):
     """
@@ -69,17 +167,31 @@ class ParseDatetimeColumn(Operation):
     
     At the moment only one rule of parsing is passed at a time, even with many columns
     The default parsing should probably be "%d/%m/%Y %H:%M:%S" (it is not being defined right now)
+
+    Parsing is done by app/datetimes.py (same result as pd.to_datetime), columns are parsed concurrently (COLUMN_WORKERS threads)
+    and columns holding the same strings (e.g. the timestamps of each sensor on an export) are parsed only once.
     """
     __code__ = 'PARSE_DATETIME_COLUMN'
+    __row_local__ = True
 
     formatting: str = "%d/%m/%Y %H:%M:%S"
     column_names: list[str]
 
     def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
+        groups: list[list[str]] = []
         for column in self.column_names:
-            df[column] = pd.to_datetime(df[column], format=self.formatting)
-        
-        return df
+            group = next((group for group in groups if df[group[0]].equals(df[column])), None)
+            if group is None: groups.append([column])
+            else: group.append(column)
+
+        parse = lambda group: datetimes.parse(df[group[0]], self.formatting)
+        if len(groups) == 1:
+            parsed = [parse(groups[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(groups), COLUMN_WORKERS), thread_name_prefix='parse') as executor:
+                parsed = list(executor.map(parse, groups))
+
+        return df.assign(**{column: values for group, values in zip(groups, parsed) for column in group})
 
 
 class StandardizeColumn(Operation):
@@ -90,12 +202,12 @@ class StandardizeColumn(Operation):
     At the moment only one rule of standardization is used, which is flooring the data
     """
     __code__ = 'STANDARDIZE_COLUMN'
+    __row_local__ = True
 
     column_name: str
         
     def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
-        df.loc[:, self.column_name] = df[self.column_name].dt.floor('Min')
-        return df
+        return df.assign(**{self.column_name: df[self.column_name].dt.floor('Min')})
 
 
 class RenameColumn(Operation):
@@ -105,12 +217,26 @@ class RenameColumn(Operation):
     - New names must be passed in the same order as the ones that will be changed
     """
     __code__ = 'RENAME_COLUMN'
+    __row_local__ = True
     
     column_names: list[str]
     new_names: list[str]
         
     def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
-        return df.rename(columns={name: new_name for name, new_name in zip(self.column_names, self.new_names)})
+        return df.rename(columns=self.mapping())
+
+    def mapping(self) -> dict[str, str]:
+        return {name: new_name for name, new_name in zip(self.column_names, self.new_names)}
+
+    def merge(self, following: Operation) -> Optional[Operation]:
+        if not isinstance(following, RenameColumn): return None
+
+        first, second = self.mapping(), following.mapping()
+        # Columns renamed here are looked up by their new name on the following rename
+        mapping = {name: second.get(new_name, new_name) for name, new_name in first.items()}
+        mapping.update({name: new_name for name, new_name in second.items() if name not in first})
+        mapping = {name: new_name for name, new_name in mapping.items() if name != new_name}
+        return RenameColumn(column_names=list(mapping.keys()), new_names=list(mapping.values()))
 
 
 class ClipValuesColumn(Operation):
@@ -121,16 +247,42 @@ class ClipValuesColumn(Operation):
     - The same rules will apply for every column passed on each call.
     """
     __code__ = 'CLIP_VALUES_COLUMN'
+    __row_local__ = True
 
     column_names: list[str]
     lower_value: Optional[float]
     upper_value: Optional[float]
         
     def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
-        for column_name in self.column_names:
-            df[column_name] = df[column_name].clip(lower=self.lower_value, upper=self.upper_value)
-        
-        return df
+        return df.assign(**{
+            column_name: df[column_name].clip(lower=self.lower_value, upper=self.upper_value)
+            for column_name in self.column_names
+        })
+
+    def merge(self, following: Operation) -> Optional[Operation]:
+        if not isinstance(following, ClipValuesColumn) or set(self.column_names) != set(following.column_names): return None
+
+        # Clipping twice is the same as clipping once by this clip's limits clipped by the following ones
+        first_lower, first_upper = self.limits()
+        following_lower, following_upper = following.limits()
+        lower_value = _clip_limit(first_lower, following_lower, following_upper)
+        upper_value = _clip_limit(first_upper, following_lower, following_upper)
+        if lower_value is None: lower_value = following_lower
+        if upper_value is None: upper_value = following_upper
+        return ClipValuesColumn(column_names=self.column_names, lower_value=lower_value, upper_value=upper_value)
+
+    def limits(self) -> tuple[Optional[float], Optional[float]]:
+        """ Limits as pandas applies them (swapped when the lower value is above the upper one) """
+        if self.lower_value is not None and self.upper_value is not None and self.lower_value > self.upper_value:
+            return self.upper_value, self.lower_value
+        return self.lower_value, self.upper_value
+
+
+def _clip_limit(value: Optional[float], lower_value: Optional[float], upper_value: Optional[float]) -> Optional[float]:
+    if value is None: return None
+    if lower_value is not None: value = max(value, lower_value)
+    if upper_value is not None: value = min(value, upper_value)
+    return value
 
 
 class ResampleValuesColumn(Operation):
@@ -150,13 +302,57 @@ class ResampleValuesColumn(Operation):
         return df.resample(rule=self.frequency, on=self.column_name)
 
 
+class OptimizeDtypes(Operation):
+    """
+    Optimize dtypes rules:
+    - Changes the dtype of columns to smaller ones holding exactly the same values (all columns if column_names is not passed)
+    - Strings with at most category_ratio distinct values per row become categoricals, other strings become Arrow strings (arrow_strings)
+    - Numbers are downcast only if no value changes (downcast)
+    
+    Bytes before and after are kept in df.attrs["memory"] (see app/dtypes.py)
+    """
+    __code__ = 'OPTIMIZE_DTYPES'
+
+    column_names: Optional[list[str]] = None
+    category_ratio: float = 0.5
+    downcast: bool = True
+    arrow_strings: bool = True
+
+    def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
+        return dtypes.optimize(df, self.column_names, self.category_ratio, self.downcast, self.arrow_strings)
+
+
+class ResampleAggregate(Operation):
+    """
+    Resample Aggregate rules:
+    - Groups rows by intervals of frequency (e.g. "1D", "1h", "15min") of a datetime column, or of the index if column_name is not passed
+    - aggregations maps each column to the aggregations computed for it (mean, min, max, sum, count, first, last, std)
+    - Columns of the result are named "<column>_<aggregation>"
+    - The start of each interval takes the place of the datetime column (or of the index)
+    
+    Rows are grouped only once, every aggregation of every column is computed over the same groups.
+    """
+    __code__ = 'RESAMPLE_AGGREGATE'
+
+    frequency: str
+    aggregations: dict[str, list[Literal['mean', 'min', 'max', 'sum', 'count', 'first', 'last', 'std']]]
+    column_name: Optional[str] = None
+
+    def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
+        if not len(self.aggregations) or not all(len(aggregations) for aggregations in self.aggregations.values()):
+            raise ValueError('aggregations must have at least one aggregation for each column')
+
+        resampled = df.resample(rule=self.frequency, on=self.column_name).agg(self.aggregations)
+        resampled.columns = [f'{column}_{aggregation}' for column, aggregation in resampled.columns]
+        return resampled if self.column_name is None else resampled.reset_index()
+
+
 class MeanValuesColumn(Operation):
     __code__ = 'MEAN_VALUES_COLUMN'
 
     def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
         return df.mean()
 
-# TODO: add remove conditional (maybe this will fit on cell functions as maybe it will use replace/remove functions) (not used on mvp)
 # TODO: maybe add a function to change type of columns (not used on mvp)
 
 
@@ -170,5 +366,5 @@ class MeanValuesColumn(Operation):
 COLUMN_OPERATIONS: dict[str, Operation] = {
     cls.__code__: cls
     for _, cls in inspect.getmembers(sys.modules[__name__], predicate=inspect.isclass)
-    if len(cls.__code__)
+    if hasattr(cls, '__code__') and len(cls.__code__)
 }
\ No newline at end of file
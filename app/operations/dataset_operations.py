@@ -1,9 +1,16 @@
 
 import sys, inspect
+import numpy as np
 import pandas as pd
-from pydantic import model_validator
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Optional
+from pydantic import PrivateAttr, model_validator
 
-from app.models import DataGroup, DataTable, Operation
+from app import actions, triplets
+from app.config import MAP_WORKERS
+from app.models import DataGroup, DataTable, Operation, OperationData
+from app.pipeline import Pipeline, pipeline_key
+from app.planner import plan
 
 
 class SplitDataTable(Operation):
@@ -18,6 +25,7 @@ class SplitDataTable(Operation):
     It does not matter if columns are repeated or not, or if all columns are being used.
     """
     __code__ = 'SPLIT_DATA_TABLE'
+    __returns__ = DataGroup
 
     dfs_names: list[str]
     columns_indexes: list[list[int]]
@@ -25,9 +33,9 @@ class SplitDataTable(Operation):
 
 
     @model_validator(mode='after')
-    def enforce_equal(cls, values):
-        if len(values['dfs_names']) == len(values['columns_indexes']) == len(values['columns_names']):
-            return values
+    def enforce_equal(self):
+        if len(self.dfs_names) == len(self.columns_indexes) == len(self.columns_names):
+            return self
         
         raise ValueError('dfs_names, columns_indexes and columns_names must have the same length')  
 
@@ -35,11 +43,8 @@ class SplitDataTable(Operation):
     def __call__(self, df: pd.DataFrame) -> DataGroup:
         df_group = DataGroup()
         for name, indexes, columns in zip(self.dfs_names, self.columns_indexes, self.columns_names):
-            original_column_names: list[str] = df.columns[indexes]
-            # Getting columns of data based on original names and in the correct order
-            new_df = df[original_column_names]
-            # Setting new column names in the same order
-            new_df.columns = columns
+            # Selecting by position and relabeling only touches metadata, the new dataframe shares the columns' data
+            new_df = df.iloc[:, indexes].set_axis(columns, axis=1)
             # Saving dataframe on map
             df_group.dfs.append(DataTable(alias=name, df=new_df))
         
@@ -47,6 +52,43 @@ class SplitDataTable(Operation):
 
 
 
+class SplitSensorTriplets(Operation):
+    """
+    Split rules:
+    - The dataframe must be a sensor export, with a (tag name, value, timestamp) triplet of columns per sensor (see app/triplets.py)
+    - tags maps the tag names to sensor names (as SENSORS on the processor), tags not in it keep their own name
+    - layout "group": Data Group with a table per sensor, named after it, with the columns Timestamp and the sensor name
+    - layout "long": single dataframe with the columns Sensor, Timestamp and Value, one row per reading
+    - Rows without a value or a timestamp are dropped (shorter sensors are padded with them), unless drop_missing is false
+
+    The whole export is split in one pass, tables of the group share the columns of the export instead of copying them.
+    """
+    __code__ = 'SPLIT_SENSOR_TRIPLETS'
+
+    tags: dict[str, str] = {}
+    layout: Literal['group', 'long'] = 'group'
+    drop_missing: bool = True
+
+
+    def returns(self, taken: type) -> type:
+        super().returns(taken)
+        return DataGroup if self.layout == 'group' else pd.DataFrame
+
+
+    def __call__(self, df: pd.DataFrame) -> pd.DataFrame | DataGroup:
+        if self.layout == 'long': return triplets.stack(df, self.tags, self.drop_missing)
+
+        df_group = DataGroup()
+        for tag, table in triplets.split(df, self.drop_missing):
+            name = self.tags.get(tag, tag)
+            if any(current.alias == name for current in df_group.dfs):
+                raise ValueError(f'more than one tag is mapped to sensor {name}')
+            df_group.dfs.append(DataTable(alias=name, df=table.set_axis([triplets.TIMESTAMP, name], axis=1)))
+
+        return df_group
+
+
+
 class JoinDataTable(Operation):
     """
     Joins dataframes in a map into a single one, horizontally
@@ -58,6 +100,8 @@ class JoinDataTable(Operation):
     It does not matter if dataframes are duplicated, or columns are passed more than once.
     """
     __code__ = 'JOIN_DATA_TABLE'
+    __takes__ = (DataGroup,)
+    __returns__ = pd.DataFrame
 
     columns_names: list[list[str]]
 
@@ -69,7 +113,141 @@ class JoinDataTable(Operation):
         new_df = pd.concat([df.df[columns] for df, columns in zip(df_group.dfs, self.columns_names)], axis = 1)
         return new_df
 
-# TODO: create a function to iterate through dataframes and execute the dataframe operation on each of them
+
+class MapDataTable(Operation):
+    """
+    Map rules:
+    - Runs the same operations on every table of a Data Group (or only on the tables in dfs_names)
+    - Operations are passed as on a request (code and attributes) and must take and return a dataframe
+    - Tables run concurrently on a pool of threads (workers, default is MAP_WORKERS from app/config.py)
+    
+    This may be used to split a file by sensor, clean each sensor in parallel and join them back.
+    Tables that are not mapped are kept as they are.
+    """
+    __code__ = 'MAP_DATA_TABLE'
+    __takes__ = (DataGroup,)
+
+    operations: list[OperationData]
+    dfs_names: Optional[list[str]] = None
+    workers: Optional[int] = None
+
+    _pipeline: Pipeline = PrivateAttr()
+
+
+    @model_validator(mode='after')
+    def compile_operations(self):
+        # Imported here as the registry is only complete once every operation module was loaded
+        from app.operations import OPERATIONS
+
+        for op in self.operations:
+            if op.code not in OPERATIONS: raise ValueError(f'operation {op.code} is not a valid operation')
+        try:
+            self._pipeline = Pipeline(pipeline_key(self.operations), plan([OPERATIONS[op.code](**op.attributes) for op in self.operations]))
+        except TypeError as e:
+            raise ValueError(str(e))
+        if self._pipeline.returns is not pd.DataFrame:
+            raise ValueError(f'operations must result in a DataFrame, not in a {self._pipeline.returns.__name__}')
+        return self
+
+
+    def __call__(self, df_group: DataGroup) -> DataGroup:
+        for name in self.dfs_names or []: df_group.get(name)
+        positions = [i for i, table in enumerate(df_group.dfs) if self.dfs_names is None or table.alias in self.dfs_names]
+        if not len(positions): return DataGroup(dfs=df_group.dfs)
+
+        dfs = list(df_group.dfs)
+        with ThreadPoolExecutor(max_workers=min(self.workers or MAP_WORKERS, len(positions)), thread_name_prefix='map') as executor:
+            results = executor.map(self._pipeline, [dfs[i].df for i in positions])
+            for i, df in zip(positions, results):
+                dfs[i] = DataTable(alias=dfs[i].alias, df=df)
+
+        return DataGroup(dfs=dfs)
+
+
+FillStrategy = Literal['equivalent', 'ffill', 'interpolate', 'constant']
+
+
+class FillGaps(Operation):
+    """
+    Fill gaps rules (as fill_missing_all on the reference irradiance processor, for every table and row at once):
+    - Tables must be indexed by timestamps (e.g. after REINDEX_COLUMN), they are all aligned once to the same grid of timestamps
+    - The grid has the frequency and goes from the first to the last timestamp of df_name (GHI on the processor), or of every table if it is None
+    - Missing values of each numeric column are filled with the strategy of its table (strategies, default is strategy):
+      - "equivalent": value of the equivalent table (equivalents, columns matched by position) if it exists and is not zero, otherwise the previous value
+      - "ffill": previous value
+      - "interpolate": straight line between the values around the gap (gaps at the edges take the nearest value)
+      - "constant": value
+    - Equivalent values are read before any table is filled, so the order of the tables does not change the result
+    - How many values were missing and how many could not be filled is kept in df.attrs["gaps"] of each table
+    """
+    __code__ = 'FILL_GAPS'
+    __takes__ = (DataGroup,)
+
+    frequency: str = '1min'
+    df_name: Optional[str] = None
+    equivalents: dict[str, str] = {}
+    strategy: FillStrategy = 'equivalent'
+    strategies: dict[str, FillStrategy] = {}
+    value: float = 0
+
+
+    @model_validator(mode='after')
+    def enforce_frequency(self):
+        pd.tseries.frequencies.to_offset(self.frequency)
+        return self
+
+
+    def __call__(self, df_group: DataGroup) -> DataGroup:
+        for name in [*self.equivalents, *self.equivalents.values(), *self.strategies, *([self.df_name] if self.df_name else [])]:
+            df_group.get(name)
+        if not len(df_group.dfs): return DataGroup(dfs=df_group.dfs)
+
+        grid = self.grid(df_group)
+        aligned = {table.alias: table.df if table.df.index.equals(grid) else table.df.reindex(grid) for table in df_group.dfs}
+        return DataGroup(dfs=[DataTable(alias=table.alias, df=self.fill(table.alias, aligned)) for table in df_group.dfs])
+
+
+    def grid(self, df_group: DataGroup) -> pd.DatetimeIndex:
+        for table in df_group.dfs:
+            if not isinstance(table.df.index, pd.DatetimeIndex):
+                raise ValueError(f'table {table.alias} must be indexed by timestamps (e.g. after REINDEX_COLUMN)')
+
+        indexes = [df_group.get(self.df_name).df.index] if self.df_name else [table.df.index for table in df_group.dfs]
+        start, end = min((index.min() for index in indexes), default=pd.NaT), max((index.max() for index in indexes), default=pd.NaT)
+        if pd.isna(start):
+            raise ValueError(f'table {self.df_name} has no timestamps' if self.df_name else 'the Data Group has no timestamps')
+        return pd.date_range(start, end, freq=self.frequency, name=indexes[0].name)
+
+
+    def fill(self, alias: str, aligned: dict[str, pd.DataFrame]) -> pd.DataFrame:
+        df = aligned[alias]
+        strategy = self.strategies.get(alias, self.strategy)
+        equivalent = aligned[self.equivalents[alias]] if strategy == 'equivalent' and alias in self.equivalents else None
+
+        columns, gaps = {}, {}
+        for position, column in enumerate(df.columns):
+            if not pd.api.types.is_numeric_dtype(df[column].dtype) or pd.api.types.is_bool_dtype(df[column].dtype): continue
+            values = df[column].to_numpy(dtype=float, na_value=np.nan)
+            missing = np.isnan(values)
+            if not missing.any(): continue
+
+            if strategy == 'constant':
+                filled = np.where(missing, self.value, values)
+            elif strategy == 'interpolate':
+                filled = actions.interpolate(values)
+            else:
+                reference = None
+                if equivalent is not None and position < len(equivalent.columns):
+                    reference = equivalent.iloc[:, position].to_numpy(dtype=float, na_value=np.nan)
+                filled, _ = actions.substitute_array(values, missing, reference)
+
+            columns[column] = filled
+            gaps[column] = {'missing': int(missing.sum()), 'unfilled': int(np.isnan(filled).sum())}
+
+        df = df.assign(**columns) if len(columns) else df.copy(deep=False)
+        df.attrs['gaps'] = gaps
+        return df
+
 
 
 
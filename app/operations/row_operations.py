@@ -1,51 +1,177 @@
 import sys, inspect
+import numpy as np
 import pandas as pd
-from typing import Callable, Optional
-
-from app.models import Operation
-
-"""
-    This class is used to carry referential dataframe information to be used on another one
-    
-    df_name -> Is used as referential dataframe for operations. If None, main dataframe should be used
-    
-    both (default: False) -> Is used to guide event behavior:
-        - If True, only triggers behaviors if conditions apply in both main and reference dataframes
-        - If Flase, triggers behaviors even if conditions apply only in main dataframe
-    
-    callback -> Function that will be called somewhere on the code that implements this class when conditions apply
-"""
-class Reference():
-    column_names: list[str]
-    
-    df_name: Optional[str]
-    both: bool
-    callback: Callable
-    
-    def __init__(self, column_names: list[str], callback: Callable, df_name: str | None = None, both: bool = False):
-        self.column_names = column_names
-        self.df_name = df_name
-        self.both = both
-        self.callback = callback
-
-
-class AbruptRules():
-    column_names: list[str]
-    threshold: int
-    reference: Reference
-
-def abrupt(dataframe: pd.DataFrame, rules: AbruptRules) -> pd.DataFrame:
-    previous_index = dataframe.index[0]
-    previous_value = dataframe.iloc[0][rules.column_names[0]]
-    for row_index in dataframe.index:
-        for column_name_index, column_name in rules.column_names:
-            if (abs(dataframe.loc[row_index][column_name] - previous_value) >= rules.threshold):
-                if rules.reference.df_name != None:
-                    # Figure out wtf do I do here
-                    return # Remove this
-        previous_index = row_index
-        previous_value = dataframe.loc[row_index][rules.column_names[0]]
-        
-        
-
-# TODO: maybe add a function that runs an excel formula across all rows on specific columns
\ No newline at end of file
+from typing import Literal, Optional
+from pydantic import BaseModel, Field, model_validator
+
+from app import actions, events
+from app.event_handler import EventRule, handle_events
+from app.models import DataGroup, DataTable, Operation
+
+
+class ReferenceColumn(BaseModel):
+    """
+    This class is used to carry referential column information to be used on another one
+
+    column_name -> Column used as reference
+    df_name -> Table of the Data Group holding the reference column. If None, the same dataframe/table of the operation is used
+    """
+    column_name: str
+    df_name: Optional[str] = None
+
+
+class ReferenceOperation(Operation):
+    """
+    Reference rules (base for operations on a column that may use a reference column):
+    - Works on a dataframe or on a Data Group (df_name is the table used in that case)
+    - The reference column, if passed, is aligned to the column by index before being used
+    """
+    __takes__ = (pd.DataFrame, DataGroup)
+
+    column_name: str
+    df_name: Optional[str] = None
+    reference: Optional[ReferenceColumn] = None
+
+    def apply(self, df: pd.DataFrame, reference: Optional[pd.Series]) -> pd.DataFrame:
+        pass
+
+    def __call__(self, df: pd.DataFrame | DataGroup) -> pd.DataFrame | DataGroup:
+        if isinstance(df, DataGroup):
+            return self.call_group(df)
+
+        if self.reference is not None and self.reference.df_name is not None:
+            raise ValueError('a reference from another table needs a Data Group')
+        reference = df[self.reference.column_name] if self.reference is not None else None
+        return self.apply(df, reference)
+
+    def call_group(self, df_group: DataGroup) -> DataGroup:
+        if self.df_name is None:
+            raise ValueError('df_name must be passed to run on a Data Group')
+
+        table = df_group.get(self.df_name)
+        reference = None
+        if self.reference is not None:
+            reference_df = df_group.get(self.reference.df_name or self.df_name).df
+            reference = reference_df[self.reference.column_name]
+            if not reference.index.equals(table.df.index): reference = reference.reindex(table.df.index)
+        return df_group.replace(DataTable(alias=table.alias, df=self.apply(table.df, reference)))
+
+
+class EventOperation(ReferenceOperation):
+    """
+    Event rules (base for operations that detect events on a column):
+    - The event is computed for the whole column at once, as a boolean mask
+    - output "mask" (default) adds the mask as a new column (mask_name, default "<column_name>_<event>")
+    - output "replace" sets values where the event happened as missing values
+    """
+    output: Literal['mask', 'replace'] = 'mask'
+    mask_name: Optional[str] = None
+
+    def mask(self, values: pd.Series, reference: Optional[pd.Series]) -> np.ndarray:
+        pass
+
+    def apply(self, df: pd.DataFrame, reference: Optional[pd.Series]) -> pd.DataFrame:
+        mask = self.mask(df[self.column_name], reference)
+        if self.output == 'replace':
+            return df.assign(**{self.column_name: df[self.column_name].mask(mask)})
+        return df.assign(**{self.mask_name or f'{self.column_name}_{self.__code__.lower()}': mask})
+
+
+class AbruptChange(EventOperation):
+    """
+    Abrupt change rules (same as the reference irradiance processor):
+    - A value is abrupt when it changes at least threshold from the previous row
+    - ... and the reference column changes less than threshold on the same rows (if there is a reference)
+    - ... and it changes at least threshold again to the value one lookahead later (next row if lookahead is None or the index is not a datetime)
+    - With substituted, each row is compared with the previous one as SUBSTITUTE_FROM_REFERENCE (same reference, lookback as lookahead) leaves it, as the reference does
+    """
+    __code__ = 'ABRUPT_CHANGE'
+
+    threshold: float
+    lookahead: Optional[str] = '1min'
+    substituted: bool = False
+
+    def mask(self, values: pd.Series, reference: Optional[pd.Series]) -> np.ndarray:
+        return events.abrupt(values, self.threshold, reference=reference, lookahead=self.lookahead, substituted=self.substituted)
+
+
+class StagnantValues(EventOperation):
+    """
+    Stagnant rules (same as the reference irradiance processor):
+    - Rows that change at most threshold from the previous row form a window
+    - Windows with at least frequency rows are stagnant
+    - Windows still open at the end of the data are ignored, unless include_trailing is True
+    - If there is a reference, rows are only stagnant when the reference is not stagnant on them too
+    """
+    __code__ = 'STAGNANT_VALUES'
+
+    frequency: int
+    threshold: float
+    include_trailing: bool = False
+
+    def mask(self, values: pd.Series, reference: Optional[pd.Series]) -> np.ndarray:
+        is_stagnant = events.stagnant(values, self.frequency, self.threshold, self.include_trailing)
+        if reference is not None:
+            is_stagnant &= ~events.stagnant(reference, self.frequency, self.threshold, self.include_trailing)
+        return is_stagnant
+
+
+class SubstituteFromReference(ReferenceOperation):
+    """
+    Substitute rules (same as the reference irradiance processor, for all rows at once):
+    - Rows where the mask column (mask_name, e.g. made by ABRUPT_CHANGE or STAGNANT_VALUES) is True are substituted
+    - They take the reference value if it exists and is not zero, otherwise the value of the column one lookback earlier (previous row if lookback is None or the index is not a datetime)
+    - The mask column is dropped afterwards, unless drop_mask is False
+    - How many rows came from each source is kept in df.attrs["substitutions"][column_name]
+    """
+    __code__ = 'SUBSTITUTE_FROM_REFERENCE'
+
+    mask_name: str
+    drop_mask: bool = True
+    lookback: Optional[str] = '1min'
+
+    def apply(self, df: pd.DataFrame, reference: Optional[pd.Series]) -> pd.DataFrame:
+        mask = df[self.mask_name].to_numpy(dtype=bool, na_value=False)
+        values, counts = actions.substitute(df[self.column_name], mask, reference, self.lookback)
+        df = df.assign(**{self.column_name: values})
+        if self.drop_mask: df = df.drop(columns=self.mask_name)
+        df.attrs['substitutions'] = {**df.attrs.get('substitutions', {}), self.column_name: counts}
+        return df
+
+
+class HandleEvents(Operation):
+    """
+    Handle events rules (see app/event_handler.py):
+    - Each rule finds an event (ABRUPT or STAGNANT) on a column, for the whole column at once
+    - ... compares it with the same event on a reference column (ONLY: not on the reference, BOTH: on both)
+    - ... and applies its action (SUBSTITUTE or REMOVE) to every row hit at once
+    - Rules run in order on a Data Group (or on a dataframe, without df_name), each one sees the changes of the previous ones
+    - Hits and sources of the values of each rule are kept in df.attrs["events"][name] of its table
+    """
+    __code__ = 'HANDLE_EVENTS'
+    __takes__ = (pd.DataFrame, DataGroup)
+
+    rules: list[EventRule] = Field(min_length=1)
+
+    @model_validator(mode='after')
+    def enforce_unique_names(self):
+        names = [rule.key() for rule in self.rules]
+        if len(set(names)) != len(names):
+            raise ValueError('rules must have different names (pass a name to rules on the same column and event)')
+        return self
+
+    def __call__(self, df: pd.DataFrame | DataGroup) -> pd.DataFrame | DataGroup:
+        return handle_events(df, self.rules)[0]
+
+
+# TODO: maybe add a function that runs an excel formula across all rows on specific columns
+
+
+
+# --------------------------------------------------------------------------
+# Always leave this at the bottom so it gets all the classes
+ROW_OPERATIONS: dict[str, Operation] = {
+    cls.__code__: cls
+    for _, cls in inspect.getmembers(sys.modules[__name__], predicate=inspect.isclass)
+    if hasattr(cls, '__code__') and len(cls.__code__)
+}
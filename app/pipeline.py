@@ -0,0 +1,106 @@
+import hashlib
+import json
+import threading
+import pandas as pd
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from app.models import DataGroup, Operation, OperationData
+
+
+class Pipeline():
+    """
+    Compiled list of operations, built (and validated) once and reused across requests
+
+    key -> Canonical hash of the operations it was compiled from (see pipeline_key)
+    returns -> Type of data the operations result in (a dataframe or a Data Group)
+
+    Operations pass either a dataframe or a Data Group to the next one,
+    raises TypeError if an operation does not run on the type returned by the previous one.
+    """
+    key: str
+    operations: list[Operation]
+    returns: type
+
+    def __init__(self, key: str, operations: list[Operation], takes: type = pd.DataFrame):
+        self.key = key
+        self.operations = operations
+        self.returns = result_type(operations, takes)
+
+    def __call__(self, df: pd.DataFrame | DataGroup, on_step: Optional[Callable[[int, Operation], None]] = None) -> pd.DataFrame | DataGroup:
+        """ on_step is called before each operation (with its position), e.g. to follow progress or to stop between operations """
+        for i, op in enumerate(self.operations):
+            if on_step is not None: on_step(i, op)
+            df = op(df)
+        return df
+
+    def skip(self, count: int) -> 'Pipeline':
+        """ Same pipeline without its first count operations (e.g. when the file reader already ran them, see planner.pushdown) """
+        if count == 0: return self
+        return Pipeline(self.key, self.operations[count:])
+
+    def __len__(self) -> int:
+        return len(self.operations)
+
+
+def result_type(operations: list[Operation], takes: type = pd.DataFrame) -> type:
+    for i, op in enumerate(operations):
+        try:
+            takes = op.returns(takes)
+        except TypeError as e:
+            raise TypeError(f'operation {i}: {e}') from e
+    return takes
+
+
+def pipeline_key(operations: list[OperationData]) -> str:
+    """ Hashes operations so that the same list always has the same key, no matter the order of attributes """
+    canonical = json.dumps(
+        [{'code': op.code, 'attributes': op.attributes} for op in operations],
+        sort_keys=True, separators=(',', ':'), default=str,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class PipelineCache():
+    """
+    Least recently used cache of compiled pipelines, shared by every request
+
+    Hits and misses are counted so the cache can be sized from its usage
+    """
+    maxsize: int
+    hits: int
+    misses: int
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._pipelines: OrderedDict[str, Pipeline] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Pipeline]:
+        with self._lock:
+            pipeline = self._pipelines.get(key)
+            if pipeline is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._pipelines.move_to_end(key)
+            return pipeline
+
+    def put(self, pipeline: Pipeline):
+        if self.maxsize <= 0: return
+        with self._lock:
+            self._pipelines[pipeline.key] = pipeline
+            self._pipelines.move_to_end(pipeline.key)
+            while len(self._pipelines) > self.maxsize:
+                self._pipelines.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._pipelines.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._pipelines), 'maxsize': self.maxsize}
@@ -0,0 +1,48 @@
+from app.io_functions import Scan
+from app.models import Operation
+
+"""
+    Logical planner, rewrites the list of operations of a request before it is executed
+
+    The rewrites only rely on the hints each operation gives (see app/models/operation.py):
+    - Filters are moved ahead of the operations they commute with (e.g. sorts), so fewer rows are processed
+    - Adjacent operations that can be fused (e.g. RENAME_COLUMN, CLIP_VALUES_COLUMN) become a single one
+    - Operations at the start of the plan that the file reader can run (filters and projections) are pushed into it (see pushdown)
+
+    The result of running the plan is always identical to running the operations in request order.
+"""
+
+
+def plan(operations: list[Operation]) -> list[Operation]:
+    return fuse(push_filters(operations))
+
+
+def push_filters(operations: list[Operation]) -> list[Operation]:
+    planned: list[Operation] = []
+    for op in operations:
+        position = len(planned)
+        if op.__filters_rows__:
+            while position > 0 and op.commutes_with(planned[position - 1]): position -= 1
+        planned.insert(position, op)
+    return planned
+
+
+def fuse(operations: list[Operation]) -> list[Operation]:
+    planned: list[Operation] = []
+    for op in operations:
+        merged = planned[-1].merge(op) if len(planned) else None
+        if merged is None: planned.append(op)
+        else: planned[-1] = merged
+    return planned
+
+
+def pushdown(operations: list[Operation]) -> tuple[Scan, int]:
+    """ Scan of the file running the leading operations the reader can run, and how many of them it runs """
+    scan = Scan()
+    for pushed, op in enumerate(operations):
+        if not op.push_into(scan): return scan, pushed
+    return scan, len(operations)
+
+
+def explain(operations: list[Operation]) -> list[dict]:
+    return [{'code': op.__code__, 'attributes': op.model_dump()} for op in operations]
@@ -0,0 +1,167 @@
+import operator
+import numpy as np
+import pandas as pd
+from typing import Annotated, Any, Callable, Literal, Optional, Union
+from pydantic import BaseModel, Field
+
+"""
+    Small declarative predicate language used to filter rows (see FILTER_ROWS)
+
+    - {"op": "==", "column": "State", "value": "OH"} (also "!=", "<", "<=", ">", ">=")
+    - {"op": "in", "column": "State", "values": ["OH", "WA"]}
+    - {"op": "between", "column": "LatD", "lower": 30, "upper": 40, "inclusive": "both"}
+    - {"op": "isnull", "column": "LonD"}
+    - {"op": "and" | "or", "predicates": [...]} and {"op": "not", "predicate": {...}}
+
+    Predicates are parsed and validated once (when the operation is built) and evaluated on whole columns at once, into a single boolean mask.
+    Comparisons follow pandas: missing values are never equal, lower or greater than anything (so they are only kept by "!=").
+    Big numeric predicates are evaluated in one pass by numexpr, if it is installed (same result, without a temporary array per comparison).
+    Categorical columns are compared once per category instead of once per row.
+"""
+
+# Rows below which numexpr is not worth its overhead (same threshold pandas uses)
+NUMEXPR_MIN_ROWS = 10_000
+
+COMPARISONS: dict[str, Callable[[Any, Any], Any]] = {
+    '==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+}
+
+
+class Comparison(BaseModel):
+    op: Literal['==', '!=', '<', '<=', '>', '>=']
+    column: str
+    value: Any
+
+
+class In(BaseModel):
+    op: Literal['in']
+    column: str
+    values: list[Any]
+
+
+class Between(BaseModel):
+    op: Literal['between']
+    column: str
+    lower: Any
+    upper: Any
+    inclusive: Literal['both', 'neither', 'left', 'right'] = 'both'
+
+
+class IsNull(BaseModel):
+    op: Literal['isnull']
+    column: str
+
+
+class And(BaseModel):
+    op: Literal['and']
+    predicates: list['Predicate'] = Field(min_length=1)
+
+
+class Or(BaseModel):
+    op: Literal['or']
+    predicates: list['Predicate'] = Field(min_length=1)
+
+
+class Not(BaseModel):
+    op: Literal['not']
+    predicate: 'Predicate'
+
+
+Predicate = Annotated[Union[Comparison, In, Between, IsNull, And, Or, Not], Field(discriminator='op')]
+
+for model in (And, Or, Not): model.model_rebuild()
+
+
+def columns(predicate: Predicate) -> set[str]:
+    """ Columns the predicate reads """
+    if isinstance(predicate, (And, Or)): return set().union(*(columns(child) for child in predicate.predicates))
+    if isinstance(predicate, Not): return columns(predicate.predicate)
+    return {predicate.column}
+
+
+def evaluate(predicate: Predicate, df: pd.DataFrame) -> np.ndarray:
+    """ Boolean mask of the rows of df where the predicate is true """
+    missing = columns(predicate) - set(df.columns)
+    if len(missing):
+        raise ValueError(f'columns {", ".join(sorted(missing))} are not in the dataframe')
+
+    mask = evaluate_numexpr(predicate, df)
+    if mask is not None: return mask
+    return _mask(predicate, df)
+
+
+def _mask(predicate: Predicate, df: pd.DataFrame) -> np.ndarray:
+    if isinstance(predicate, And): return np.logical_and.reduce([_mask(child, df) for child in predicate.predicates])
+    if isinstance(predicate, Or): return np.logical_or.reduce([_mask(child, df) for child in predicate.predicates])
+    if isinstance(predicate, Not): return ~_mask(predicate.predicate, df)
+
+    values = df[predicate.column]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # Compared once per category, code -1 (missing) takes the result of a missing value
+        categories = pd.Series(values.cat.categories)
+        per_category = np.append(_leaf(predicate, categories), _leaf(predicate, pd.Series([None], dtype=object)))
+        return per_category[values.cat.codes.to_numpy()]
+    return _leaf(predicate, values)
+
+
+def _leaf(predicate: Predicate, values: pd.Series) -> np.ndarray:
+    if isinstance(predicate, Comparison): mask = COMPARISONS[predicate.op](values, predicate.value)
+    elif isinstance(predicate, In): mask = values.isin(predicate.values)
+    elif isinstance(predicate, Between): mask = values.between(predicate.lower, predicate.upper, inclusive=predicate.inclusive)
+    else: mask = values.isna()
+    # Nullable dtypes give missing results on missing values
+    return mask.to_numpy(dtype=bool, na_value=False)
+
+
+def evaluate_numexpr(predicate: Predicate, df: pd.DataFrame) -> Optional[np.ndarray]:
+    """ Mask of the whole predicate in a single numexpr pass, None if numexpr is not installed or the predicate is not numeric """
+    if len(df) < NUMEXPR_MIN_ROWS: return None
+    try:
+        import numexpr
+    except ImportError:
+        return None
+
+    variables: dict[str, Any] = {}
+    expression = _expression(predicate, df, variables)
+    if expression is None: return None
+    return numexpr.evaluate(expression, local_dict=variables)
+
+
+def _expression(predicate: Predicate, df: pd.DataFrame, variables: dict[str, Any]) -> Optional[str]:
+    """ numexpr expression of the predicate, columns and values are passed as variables so they are never written in the expression """
+    if isinstance(predicate, (And, Or)):
+        children = [_expression(child, df, variables) for child in predicate.predicates]
+        if any(child is None for child in children): return None
+        return '(' + (' & ' if isinstance(predicate, And) else ' | ').join(children) + ')'
+    if isinstance(predicate, Not):
+        child = _expression(predicate.predicate, df, variables)
+        return None if child is None else f'(~{child})'
+
+    values = df[predicate.column]
+    if not isinstance(values.dtype, np.dtype) or values.dtype.kind not in 'if': return None
+    column = _variable(variables, 'c', values.to_numpy())
+
+    if isinstance(predicate, IsNull):
+        # Only NaN differs from itself
+        return f'({column} != {column})'
+    if isinstance(predicate, Comparison):
+        if not _is_number(predicate.value): return None
+        return f'({column} {predicate.op} {_variable(variables, "v", predicate.value)})'
+    if isinstance(predicate, In):
+        if not len(predicate.values) or not all(_is_number(value) for value in predicate.values): return None
+        return '(' + ' | '.join(f'({column} == {_variable(variables, "v", value)})' for value in predicate.values) + ')'
+
+    if not _is_number(predicate.lower) or not _is_number(predicate.upper): return None
+    lower = '>=' if predicate.inclusive in ('both', 'left') else '>'
+    upper = '<=' if predicate.inclusive in ('both', 'right') else '<'
+    return f'(({column} {lower} {_variable(variables, "v", predicate.lower)}) & ({column} {upper} {_variable(variables, "v", predicate.upper)}))'
+
+
+def _variable(variables: dict[str, Any], prefix: str, value: Any) -> str:
+    name = f'{prefix}{len(variables)}'
+    variables[name] = value
+    return name
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (bool, int, float)) and not (isinstance(value, float) and np.isnan(value))
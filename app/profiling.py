@@ -0,0 +1,140 @@
+import threading
+import time
+import tracemalloc
+import pandas as pd
+from typing import Any, Callable, Iterator, Optional
+from pydantic import BaseModel
+
+from app.models import DataGroup
+from app.pipeline import Pipeline
+
+"""
+    Profiling of /file requests, step by step (phases of the request and each operation of the pipeline)
+
+    Wall time, CPU time and the shape of the data are always measured, as they cost close to nothing.
+    Allocated bytes are only measured when a profile is asked for, as tracing allocations slows pandas down.
+    Obs.: allocations are traced for the whole process, so requests with a profile trace them one at a time (the others wait for it).
+    Requests without a profile running meanwhile still add to their numbers, which are approximate on a busy server.
+"""
+
+# Held while allocations are traced, starting, resetting and stopping tracemalloc while another run traces would corrupt its numbers
+TRACING = threading.Lock()
+
+
+class StepProfile(BaseModel):
+    """
+    name -> Phase of the request (parse, validate, wait, encode) or the code of the operation
+    wait -> Time between handing the pipeline to the worker pool and getting it back, minus the operations themselves
+    allocated_bytes -> Peak of memory allocated during the step, above what was allocated before it
+    """
+    name: str
+    wall_seconds: float
+    cpu_seconds: Optional[float] = None
+    rows_in: Optional[int] = None
+    columns_in: Optional[int] = None
+    rows_out: Optional[int] = None
+    columns_out: Optional[int] = None
+    allocated_bytes: Optional[int] = None
+    operation: bool = False
+
+
+class Stopwatch():
+    """ Adds up wall and CPU time over many intervals (e.g. every batch of a streamed response) """
+    wall_seconds: float
+    cpu_seconds: float
+
+    def __init__(self):
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self._started: Optional[tuple[float, float]] = None
+
+    def start(self):
+        self._started = (time.perf_counter(), time.thread_time())
+
+    def stop(self):
+        wall, cpu = self._elapsed()
+        self.wall_seconds += wall
+        self.cpu_seconds += cpu
+        self._started = None
+
+    def step(self, name: str) -> StepProfile:
+        """ Profile of the time measured so far, the running interval included """
+        wall, cpu = self._elapsed()
+        return StepProfile(name=name, wall_seconds=self.wall_seconds + wall, cpu_seconds=self.cpu_seconds + cpu)
+
+    def _elapsed(self) -> tuple[float, float]:
+        if self._started is None: return 0.0, 0.0
+        return time.perf_counter() - self._started[0], time.thread_time() - self._started[1]
+
+
+def measure(name: str, function: Callable, *args) -> tuple[Any, StepProfile]:
+    stopwatch = Stopwatch()
+    stopwatch.start()
+    result = function(*args)
+    stopwatch.stop()
+    return result, stopwatch.step(name)
+
+
+def run_profiled(pipeline: Pipeline, df: pd.DataFrame, trace_memory: bool = False) -> tuple[Any, list[StepProfile]]:
+    """ Runs the pipeline like Pipeline.__call__, profiling each operation (module level, so process workers can pickle it) """
+    if not trace_memory: return _run_profiled(pipeline, df, False)
+
+    with TRACING:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing: tracemalloc.start()
+        try:
+            return _run_profiled(pipeline, df, True)
+        finally:
+            if started_tracing: tracemalloc.stop()
+
+
+def _run_profiled(pipeline: Pipeline, df: pd.DataFrame, trace_memory: bool) -> tuple[Any, list[StepProfile]]:
+    steps: list[StepProfile] = []
+    for op in pipeline.operations:
+        rows_in, columns_in = shape(df)
+        if trace_memory:
+            tracemalloc.reset_peak()
+            allocated_before = tracemalloc.get_traced_memory()[0]
+        df, step = measure(op.__code__, op, df)
+        step.rows_in, step.columns_in = rows_in, columns_in
+        step.rows_out, step.columns_out = shape(df)
+        step.operation = True
+        if trace_memory: step.allocated_bytes = max(tracemalloc.get_traced_memory()[1] - allocated_before, 0)
+        steps.append(step)
+    return df, steps
+
+
+def shape(data: Any) -> tuple[Optional[int], Optional[int]]:
+    """ Data Groups count the rows and columns of all their tables """
+    if isinstance(data, pd.DataFrame): return data.shape
+    if isinstance(data, pd.Series): return len(data), 1
+    if isinstance(data, DataGroup): return sum(len(table.df) for table in data.dfs), sum(len(table.df.columns) for table in data.dfs)
+    return None, None
+
+
+def measured(chunks: Iterator, stopwatch: Stopwatch, on_done: Callable[[], None]) -> Iterator:
+    """ Measures the time spent producing each chunk of a streamed response, not the time spent sending it """
+    chunks = iter(chunks)
+    while True:
+        stopwatch.start()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            break
+        finally:
+            stopwatch.stop()
+        yield chunk
+    on_done()
+
+
+def server_timing(steps: list[StepProfile]) -> str:
+    """ Server-Timing header value, durations in milliseconds. Operations are named by position (op0, op1, ...) """
+    entries = []
+    position = 0
+    for step in steps:
+        name = step.name
+        if step.operation:
+            name = f'op{position};desc="{step.name}"'
+            position += 1
+        entries.append(f'{name};dur={step.wall_seconds * 1000:.3f}')
+    return ', '.join(entries)
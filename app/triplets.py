@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+"""
+    Sensor exports, as read by refference/irradiance_processor.py: a (tag name, value, timestamp) triplet of columns per sensor
+
+    Each triplet is as long as the readings of its sensor, shorter sensors are padded with empty rows at the end.
+    Triplets are read straight from the columns of the export (no dataframe is built per sensor),
+    so splitting or stacking them costs about the size of the export once.
+"""
+
+TIMESTAMP = 'Timestamp'
+VALUE = 'Value'
+SENSOR = 'Sensor'
+
+# Rows checked at a time when looking for the tag name of a triplet
+TAG_BLOCK = 1024
+
+
+def tag_names(export: pd.DataFrame) -> list[Optional[str]]:
+    """ Tag name of each triplet (its first one), None for triplets without readings """
+    if len(export.columns) % 3:
+        raise ValueError('the export must have a (tag name, value, timestamp) triplet of columns per sensor')
+
+    tags = []
+    for i in range(0, len(export.columns), 3):
+        column = export.iloc[:, i].to_numpy()
+        tags.append(None)
+        # Tags are almost always on the first row, so the column is only checked block by block until one is found
+        for start in range(0, len(column), TAG_BLOCK):
+            block = column[start:start + TAG_BLOCK]
+            valid = pd.notna(block)
+            if valid.any():
+                tags[-1] = block[valid.argmax()]
+                break
+    return tags
+
+
+def present(export: pd.DataFrame, i: int) -> Optional[np.ndarray]:
+    """ Rows of the triplet at column i with both a value and a timestamp, None if every row has them """
+    keep = export.iloc[:, i + 1].notna().to_numpy() & export.iloc[:, i + 2].notna().to_numpy()
+    return None if keep.all() else keep
+
+
+def split(export: pd.DataFrame, drop_missing: bool = True) -> list[tuple[str, pd.DataFrame]]:
+    """
+    (tag name, timestamps and values) of each triplet with readings
+    Tables share the columns of the export, only the triplets with rows to drop are copied
+    """
+    tables = []
+    for position, tag in enumerate(tag_names(export)):
+        if tag is None: continue
+        i = 3 * position
+        table = export.iloc[:, [i + 2, i + 1]].set_axis([TIMESTAMP, VALUE], axis=1)
+        keep = present(export, i) if drop_missing else None
+        if keep is not None: table = table[keep]
+        tables.append((tag, table))
+    return tables
+
+
+def stack(export: pd.DataFrame, names: Optional[dict[str, str]] = None, drop_missing: bool = True) -> pd.DataFrame:
+    """
+    Triplets one after the other, as a long dataframe (sensor, timestamp and value)
+    - names maps tag names to sensor names, tags not in it keep their own name
+    - The sensor column is categorical (one small code per row instead of a string)
+    - Timestamps and values are written once into arrays allocated for every kept row, no array is built per sensor
+    """
+    names = names or {}
+    triplets = []
+    for position, tag in enumerate(tag_names(export)):
+        if tag is None: continue
+        i = 3 * position
+        keep = present(export, i) if drop_missing else None
+        triplets.append((i, names.get(tag, tag), keep, len(export) if keep is None else int(keep.sum())))
+
+    sensors = list(dict.fromkeys(name for _, name, _, _ in triplets))
+    codes = np.empty(sum(rows for _, _, _, rows in triplets), dtype=np.min_scalar_type(max(len(sensors) - 1, 0)))
+    timestamps = np.empty(len(codes), dtype=_common_dtype(export.dtypes.iloc[[i + 2 for i, _, _, _ in triplets]]))
+    values = np.empty(len(codes), dtype=_common_dtype(export.dtypes.iloc[[i + 1 for i, _, _, _ in triplets]]))
+
+    start = 0
+    for i, name, keep, rows in triplets:
+        end = start + rows
+        codes[start:end] = sensors.index(name)
+        for output, offset in ((timestamps, 2), (values, 1)):
+            column = export.iloc[:, i + offset].to_numpy()
+            output[start:end] = column if keep is None else column[keep]
+        start = end
+
+    # The dtypes are given so pandas does not infer the type of text timestamps (which allocates more than the column itself),
+    # and arrays of different dtypes are never consolidated, so the dataframe is built on them without copying
+    return pd.DataFrame({
+        SENSOR: pd.Categorical.from_codes(codes, sensors),
+        TIMESTAMP: pd.Series(timestamps, dtype=timestamps.dtype, copy=False),
+        VALUE: pd.Series(values, dtype=values.dtype, copy=False),
+    }, copy=False)
+
+
+def _common_dtype(dtypes: pd.Series) -> np.dtype:
+    """ Numpy dtype that holds values of every dtype (object for extension dtypes, e.g. Arrow backed strings) """
+    dtypes = [dtype if isinstance(dtype, np.dtype) else np.dtype(object) for dtype in dtypes]
+    return np.result_type(*dtypes) if len(dtypes) else np.dtype(float)
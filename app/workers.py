@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+
+class WorkerPoolFull(Exception):
+    pass
+
+
+class WorkerPool():
+    """
+    Bounded pool that runs CPU bound work (pandas) away from the event loop
+
+    - mode "thread" shares memory with the server, mode "process" avoids the GIL but pickles arguments and results
+    - At most workers + queue_size calls are accepted at a time, calls above it raise WorkerPoolFull
+    - Calls that take longer than timeout (waiting time included) raise TimeoutError, the work itself can not be interrupted
+    - initializer runs once on every new process (e.g. to set pandas options), threads share the options of the server
+    - Work that can not be sent to the pool (e.g. chunks read while a response streams) reserves a place on it, counted on the same limits
+      and running on at most workers threads at once (shared with the calls of the pool in thread mode)
+    """
+    mode: str
+    workers: int
+    queue_size: int
+    timeout: float
+
+    def __init__(self, mode: str, workers: int, queue_size: int, timeout: float, initializer: Optional[Callable[[], None]] = None):
+        if mode not in ('thread', 'process'):
+            raise ValueError(f'worker mode {mode} is not valid, it must be "thread" or "process"')
+
+        self.mode = mode
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.initializer = initializer
+        self._executor: Executor | None = None
+        self._lock = threading.Lock()
+        self._running = threading.Semaphore(workers)
+        self._pending = 0
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'timeouts': 0, 'wait_seconds': 0.0, 'run_seconds': 0.0}
+
+    @property
+    def executor(self) -> Executor:
+        # Created on first use, so importing the app does not start processes
+        if self._executor is None:
+            if self.mode == 'thread': self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            else: self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=self.initializer)
+        return self._executor
+
+    async def run(self, function: Callable, *args) -> Any:
+        self._admit()
+        submitted = time.time()
+        if self.mode == 'thread': future = self.executor.submit(self._shared, function, *args)
+        else: future = self.executor.submit(_timed, function, *args)
+        future.add_done_callback(self._done)
+        try:
+            started, finished, result = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            with self._lock: self._stats['timeouts'] += 1
+            raise TimeoutError(f'call did not finish in {self.timeout} seconds')
+
+        with self._lock:
+            self._stats['wait_seconds'] += max(started - submitted, 0)
+            self._stats['run_seconds'] += finished - started
+        return result
+
+    def reserve(self) -> 'Reservation':
+        """ Place for work run outside of the pool, raises WorkerPoolFull as run does (see Reservation) """
+        self._admit()
+        return Reservation(self)
+
+    def _admit(self):
+        with self._lock:
+            if self._pending >= self.workers + self.queue_size:
+                self._stats['rejected'] += 1
+                raise WorkerPoolFull(f'{self._pending} calls are already running or waiting')
+            self._pending += 1
+            self._stats['submitted'] += 1
+
+    def _shared(self, function: Callable, *args) -> tuple[float, float, Any]:
+        with self._running:
+            return _timed(function, *args)
+
+    def _done(self, future: Future):
+        if future.cancelled(): self._release(None)
+        else: self._release(future.exception() is None)
+
+    def _release(self, completed: Optional[bool]):
+        """ completed is None for calls that never ran """
+        with self._lock:
+            self._pending -= 1
+            if completed is not None: self._stats['completed' if completed else 'failed'] += 1
+
+    def info(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'queue_depth': max(self._pending - self.workers, 0),
+                'running': min(self._pending, self.workers),
+                **self._stats,
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class Reservation():
+    """
+    Place reserved on a pool by work that runs outside of it
+
+    - start waits for one of the workers, stop frees it and the place (the threads calling them may differ)
+    - stop also frees the place of work that never started (e.g. cancelled while waiting), calling it again does nothing
+    """
+    pool: WorkerPool
+
+    def __init__(self, pool: WorkerPool):
+        self.pool = pool
+        self._started = False
+        self._released = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.pool._running.acquire()
+        with self._lock: self._started = True
+
+    def stop(self, completed: bool = True):
+        with self._lock:
+            if self._released: return
+            self._released = True
+            started = self._started
+        if started: self.pool._running.release()
+        self.pool._release(completed if started else None)
+
+
+def _timed(function: Callable, *args) -> tuple[float, float, Any]:
+    """ Wall clock (not perf_counter) so times can be compared between processes """
+    started = time.time()
+    result = function(*args)
+    return started, time.time(), result
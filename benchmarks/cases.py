@@ -0,0 +1,192 @@
+import io
+import json
+import os
+import sys
+import pandas as pd
+from typing import Any, Callable, Iterator
+
+from app.models import DataGroup
+from app.operations import OPERATIONS, Operation
+from benchmarks import data
+
+"""
+    Benchmark cases, grouped in suites:
+
+    - operations: every entry of OPERATIONS, run directly on its input
+    - requests: the whole /file request path (parsing, validation, pipeline and streamed response) through the test client
+    - irradiance: each step of refference/irradiance_processor.py, run in order on a fresh processor
+
+    A case is (name, setup, run): setup builds the input for a number of rows and is not timed, run(input) is timed.
+    Steps of the irradiance processor depend on the previous ones, so that suite times every step of one run instead.
+"""
+
+REFERENCE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'refference')
+
+# Default sizes of each suite, the processor loops over every row in python so it only runs on the smallest one
+SUITE_SIZES: dict[str, list[int]] = {
+    'operations': data.SIZES[:3],
+    'requests': data.SIZES[:2],
+    'irradiance': data.SIZES[:1],
+}
+
+SENSOR_NAMES = list(data.SENSOR_TAGS)
+
+Case = tuple[str, Callable[[int], Any], Callable[[Any], Any]]
+
+
+def parsed_sensors(rows: int) -> pd.DataFrame:
+    """ Sensors with parsed, floored and unique timestamps as index """
+    return run_operations(data.sensors(rows), [
+        ('PARSE_DATETIME_COLUMN', {'column_names': ['Timestamp']}),
+        ('STANDARDIZE_COLUMN', {'column_name': 'Timestamp'}),
+        ('REMOVE_DUPLICATES_VALUES_COLUMN', {'column_names': ['Timestamp']}),
+        ('REINDEX_COLUMN', {'column_name': 'Timestamp'}),
+    ])
+
+
+def sensor_group(rows: int) -> DataGroup:
+    return OPERATIONS['SPLIT_DATA_TABLE'](**SPLIT_SENSORS)(data.irradiance(rows))
+
+
+def run_operations(df: pd.DataFrame | DataGroup, operations: list[tuple[str, dict]]) -> pd.DataFrame | DataGroup:
+    for code, attributes in operations: df = OPERATIONS[code](**attributes)(df)
+    return df
+
+
+SPLIT_SENSORS = {
+    'dfs_names': SENSOR_NAMES,
+    'columns_indexes': [[3 * i + 2, 3 * i + 1] for i in range(len(SENSOR_NAMES))],
+    'columns_names': [['Timestamp', sensor] for sensor in SENSOR_NAMES],
+}
+
+CLEAN_AND_REINDEX = [
+    {'code': 'REMOVE_MISSING_VALUES_COLUMN', 'attributes': {'how': 'any'}},
+    {'code': 'PARSE_DATETIME_COLUMN', 'attributes': {'column_names': ['Timestamp']}},
+    {'code': 'SORT_COLUMN', 'attributes': {'column_name': 'Timestamp'}},
+    {'code': 'STANDARDIZE_COLUMN', 'attributes': {'column_name': 'Timestamp'}},
+    {'code': 'REMOVE_DUPLICATES_VALUES_COLUMN', 'attributes': {'column_names': ['Timestamp']}},
+    {'code': 'REINDEX_COLUMN', 'attributes': {'column_name': 'Timestamp'}},
+]
+
+# Sensor used to fill the gaps of each sensor (SENSOR_EQUIVALENTS on the processor)
+SENSOR_EQUIVALENTS = {'PIR1': 'PIR2', 'PIR2': 'PIR1', 'PIR5': 'PIR7', 'PIR7': 'PIR5'}
+
+
+def reindexed_group(rows: int) -> DataGroup:
+    """ Sensors of a Data Group, each one cleaned and indexed by its timestamps (as clean_and_reindex_all on the processor) """
+    return OPERATIONS['MAP_DATA_TABLE'](operations=CLEAN_AND_REINDEX)(sensor_group(rows))
+
+# Input and attributes of each operation, every entry of OPERATIONS must have one
+OPERATION_CASES: dict[str, tuple[Callable[[int], Any], dict]] = {
+    'SORT_COLUMN': (data.cities, {'column_name': 'City'}),
+    'REINDEX_COLUMN': (data.cities, {'column_name': 'City'}),
+    'REMOVE_DUPLICATES_VALUES_COLUMN': (data.cities, {'column_names': ['State', 'City']}),
+    'REMOVE_MISSING_VALUES_COLUMN': (data.cities, {'how': 'any'}),
+    'PARSE_DATETIME_COLUMN': (data.sensors, {'column_names': ['Timestamp']}),
+    'STANDARDIZE_COLUMN': (lambda rows: run_operations(data.sensors(rows), [('PARSE_DATETIME_COLUMN', {'column_names': ['Timestamp']})]), {'column_name': 'Timestamp'}),
+    'RENAME_COLUMN': (data.cities, {'column_names': ['City', 'State'], 'new_names': ['city', 'state']}),
+    'CLIP_VALUES_COLUMN': (parsed_sensors, {'column_names': ['PIR1', 'PIR2', 'PIR5', 'PIR7'], 'lower_value': 0, 'upper_value': 1500}),
+    'RESAMPLE_VALUES_COLUMN': (lambda rows: parsed_sensors(rows).reset_index(), {'column_name': 'Timestamp', 'frequency': '1h'}),
+    'MEAN_VALUES_COLUMN': (parsed_sensors, {}),
+    'RESAMPLE_AGGREGATE': (parsed_sensors, {'frequency': '1D', 'aggregations': {'PIR1': ['mean', 'min', 'max', 'sum', 'count', 'first', 'last', 'std'], 'GHI': ['mean']}}),
+    'OPTIMIZE_DTYPES': (data.cities, {}),
+    'SELECT_COLUMNS': (data.cities, {'column_names': ['State', 'City', 'LatD', 'LonD']}),
+    'DROP_COLUMNS': (data.cities, {'column_names': ['LatM', 'LatS', 'NS', 'LonM', 'LonS', 'EW']}),
+    'FILTER_ROWS': (data.cities, {'predicate': {'op': 'and', 'predicates': [
+        {'op': 'between', 'column': 'LatD', 'lower': 30, 'upper': 45},
+        {'op': 'in', 'column': 'State', 'values': ['CA', 'OH', 'WA']},
+        {'op': 'not', 'predicate': {'op': 'isnull', 'column': 'LonD'}},
+    ]}}),
+    'SPLIT_DATA_TABLE': (data.irradiance, SPLIT_SENSORS),
+    'SPLIT_SENSOR_TRIPLETS': (data.irradiance, {'tags': {tag: sensor for sensor, tag in data.SENSOR_TAGS.items()}}),
+    'JOIN_DATA_TABLE': (sensor_group, {'columns_names': [[sensor] for sensor in SENSOR_NAMES]}),
+    'MAP_DATA_TABLE': (sensor_group, {'operations': CLEAN_AND_REINDEX}),
+    'FILL_GAPS': (reindexed_group, {'df_name': 'GHI', 'equivalents': SENSOR_EQUIVALENTS, 'strategies': {'GHI': 'constant'}}),
+    'ABRUPT_CHANGE': (parsed_sensors, {'column_name': 'PIR1', 'threshold': 800, 'reference': {'column_name': 'PIR2'}}),
+    'STAGNANT_VALUES': (parsed_sensors, {'column_name': 'PIR1', 'frequency': 6, 'threshold': 0.0001, 'reference': {'column_name': 'PIR2'}}),
+    'HANDLE_EVENTS': (parsed_sensors, {'rules': [
+        {'event': {'type': 'STAGNANT', 'args': {'frequency': 6, 'threshold': 0.0001}}, 'action': {'type': 'SUBSTITUTE'},
+         'rules': {'column_name': 'PIR1', 'reference': {'column_name': 'PIR2'}}},
+        {'event': {'type': 'ABRUPT', 'args': {'threshold': 800}}, 'action': {'type': 'SUBSTITUTE'},
+         'rules': {'column_name': 'PIR1', 'reference': {'column_name': 'PIR2'}}},
+    ]}),
+    'SUBSTITUTE_FROM_REFERENCE': (
+        lambda rows: run_operations(parsed_sensors(rows), [('ABRUPT_CHANGE', {'column_name': 'PIR1', 'threshold': 800, 'mask_name': 'abrupt'})]),
+        {'column_name': 'PIR1', 'mask_name': 'abrupt', 'reference': {'column_name': 'PIR2'}},
+    ),
+}
+
+
+def operation_cases() -> Iterator[Case]:
+    missing = set(OPERATIONS) - set(OPERATION_CASES)
+    if len(missing):
+        raise ValueError(f'operations {", ".join(sorted(missing))} have no benchmark case in benchmarks/cases.py')
+
+    for code, (setup, attributes) in OPERATION_CASES.items():
+        op: Operation = OPERATIONS[code](**attributes)
+        yield code, setup, op
+
+
+# Bodies sent to /file, as records (the default layout) with the operations of a typical request
+REQUESTS: dict[str, tuple[Callable[[int], pd.DataFrame], list[dict]]] = {
+    'cities': (data.cities, [
+        {'code': 'REMOVE_MISSING_VALUES_COLUMN', 'attributes': {'how': 'any'}},
+        {'code': 'SORT_COLUMN', 'attributes': {'column_name': 'City'}},
+        {'code': 'REMOVE_DUPLICATES_VALUES_COLUMN', 'attributes': {'column_names': ['City']}},
+        {'code': 'RENAME_COLUMN', 'attributes': {'column_names': ['City'], 'new_names': ['city']}},
+    ]),
+    'irradiance': (data.irradiance, [
+        {'code': 'SPLIT_DATA_TABLE', 'attributes': SPLIT_SENSORS},
+        {'code': 'MAP_DATA_TABLE', 'attributes': {'operations': CLEAN_AND_REINDEX}},
+        {'code': 'JOIN_DATA_TABLE', 'attributes': {'columns_names': [[sensor] for sensor in SENSOR_NAMES]}},
+    ]),
+}
+
+
+def request_cases() -> Iterator[Case]:
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    client = TestClient(app)
+
+    def post(body: bytes) -> int:
+        response = client.post('/file', content=body, headers={'content-type': 'application/json'})
+        if response.status_code != 200:
+            raise RuntimeError(f'/file answered {response.status_code}: {response.text[:200]}')
+        return len(response.content)
+
+    for name, (dataset, operations) in REQUESTS.items():
+        def setup(rows: int, name=name, dataset=dataset, operations=operations) -> bytes:
+            # Records are encoded by pandas, as json.dumps is too slow for the bigger sizes
+            file = dataset(rows).to_json(orient='records')
+            return f'{{"file":{{"alias":{json.dumps(name)},"data":{file}}},"operations":{json.dumps(operations)}}}'.encode()
+        yield name, setup, post
+
+
+def irradiance_steps(csv: str, workers: int = 1) -> Iterator[tuple[str, Callable[[], Any]]]:
+    """ Steps of refference/script.py, in the same order and with the same rules (with more than one worker, every step after open_csv shares a process pool) """
+    if REFERENCE_DIR not in sys.path: sys.path.insert(0, REFERENCE_DIR)
+    from irradiance_processor import IrradianceProcessor, SENSOR_NAMES as REFERENCE_SENSORS
+
+    processor: IrradianceProcessor = None
+
+    def open_csv():
+        nonlocal processor
+        processor = IrradianceProcessor(dir=io.StringIO(csv), decimal=',', sep=';', workers=workers)
+
+    irradiance_clip_rules = IrradianceProcessor.ClipRules(lower_value=0, upper_value=1500)
+    temperature_clip_rules = IrradianceProcessor.ClipRules(lower_value=0, upper_value=50)
+    temperatures = (REFERENCE_SENSORS.Temp2, REFERENCE_SENSORS.Temp3)
+
+    yield 'open_csv', open_csv
+    # The pool is opened once open_csv ran (its workers start on the first step that uses them, as on execute_functions)
+    with processor.open_pool():
+        yield 'separate_dataframes', lambda: processor.separate_dataframes()
+        yield 'clean_and_reindex_all', lambda: processor.clean_and_reindex_all()
+        yield 'fill_missing_all', lambda: processor.fill_missing_all()
+        yield 'clip_range_all', lambda: processor.clip_range_all(specific_rules={sensor: temperature_clip_rules for sensor in temperatures}, rules=irradiance_clip_rules)
+        yield 'fix_all_stagnant_data', lambda: processor.fix_all_stagnant_data(frequency=6, threshold=0.0001)
+        yield 'fix_all_abrupt_changes', lambda: processor.fix_all_abrupt_changes(specific_rules={sensor: 4 for sensor in temperatures}, threshold=800)
+        yield 'remove_all_incorrect_zeroes', lambda: processor.remove_all_incorrect_zeroes()
+        yield 'concat_df_map', lambda: processor.concat_df_map()
+
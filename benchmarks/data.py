@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+"""
+    Synthetic data used by the benchmarks, generated the same way for the same number of rows (fixed seed)
+
+    - cities: same columns as test/cities.csv, with a few missing values and repeated states
+    - irradiance: export of the dataloggers read by refference/irradiance_processor.py,
+      one (tag name, value, timestamp) triplet of columns per sensor and one row per minute
+    - sensors: the same readings with one column per sensor and the timestamps as text (as they arrive on /file)
+"""
+
+SIZES: list[int] = [10_000, 100_000, 1_000_000, 10_000_000]
+
+STATES = np.array(['AL', 'AZ', 'CA', 'CO', 'FL', 'GA', 'IL', 'MA', 'MN', 'NY', 'OH', 'OR', 'PA', 'SD', 'TX', 'WA'])
+
+# Same tag names as SENSORS in refference/irradiance_processor.py
+SENSOR_TAGS: dict[str, str] = {
+    'GHI': 'Datalogger[7].Meteo[1].MRI_IrradianceGlobal',
+    'PIR1': 'Datalogger[1].SensorAI[2].MRI_Value01',
+    'PIR2': 'Datalogger[2].SensorAI[2].MRI_Value01',
+    'PIR5': 'Datalogger[5].SensorAI[2].MRI_Value01',
+    'PIR7': 'Datalogger[7].SensorAI[2].MRI_Value01',
+    'Temp2': 'Datalogger[1].Meteo[1].MRI_TemperatureAmbient',
+    'RH2': 'Datalogger[7].Meteo[1].MRI_Humidity',
+    'Temp3': 'Datalogger[7].Meteo[1].MRI_TemperatureAmbient',
+}
+
+TIMESTAMP_FORMAT = '%d/%m/%Y %H:%M:%S'
+
+
+def cities(rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'LatD': rng.integers(25, 50, rows),
+        'LatM': rng.integers(0, 60, rows),
+        'LatS': rng.integers(0, 60, rows),
+        'NS': 'N',
+        'LonD': rng.integers(70, 125, rows).astype(float),
+        'LonM': rng.integers(0, 60, rows),
+        'LonS': rng.integers(0, 60, rows),
+        'EW': 'W',
+        'City': pd.Series(rng.integers(0, max(rows // 4, 1), rows)).map('City{}'.format),
+        'State': STATES[rng.integers(0, len(STATES), rows)],
+    })
+    df.loc[rng.random(rows) < 0.01, 'LonD'] = np.nan
+    return df
+
+
+def readings(rows: int, seed: int = 0) -> pd.DataFrame:
+    """ One column per sensor indexed by the (irregular) reading times, with the faults the processor fixes """
+    rng = np.random.default_rng(seed)
+    minutes = pd.date_range('2024-04-04', periods=rows, freq='1min')
+    # Readings arrive a few seconds after the minute, flooring them is part of the workflow
+    index = minutes + pd.to_timedelta(rng.integers(0, 30, rows), unit='s')
+    daylight = np.clip(np.sin((minutes.hour.to_numpy() * 60 + minutes.minute.to_numpy() - 360) / 720 * np.pi), 0, None)
+
+    df = pd.DataFrame(index=index)
+    for sensor in SENSOR_TAGS:
+        if sensor.startswith('Temp'):
+            values = 20 + 10 * daylight + rng.normal(0, 0.5, rows)
+        elif sensor.startswith('RH'):
+            values = 80 - 30 * daylight + rng.normal(0, 2, rows)
+        else:
+            values = 1000 * daylight + rng.normal(0, 5, rows)
+            # Spikes and zeroes, only on single readings
+            values[rng.random(rows) < 0.001] = 1400
+            values[rng.random(rows) < 0.001] = 0
+        values = np.round(values, 2)
+        # Stuck readings
+        for start in rng.integers(0, rows, max(rows // 5_000, 1)):
+            values[start:start + 10] = values[start]
+        values[rng.random(rows) < 0.01] = np.nan
+        df[sensor] = values
+    return df
+
+
+def irradiance(rows: int, seed: int = 0) -> pd.DataFrame:
+    df = readings(rows, seed)
+    timestamps = df.index.strftime(TIMESTAMP_FORMAT)
+    columns = {}
+    for sensor, tag in SENSOR_TAGS.items():
+        columns[f'{sensor}_TagName'] = tag
+        columns[f'{sensor}_Value'] = df[sensor].to_numpy()
+        columns[f'{sensor}_Timestamp'] = timestamps
+    return pd.DataFrame(columns)
+
+
+def irradiance_csv(rows: int, seed: int = 0) -> str:
+    """ Same layout the processor reads (decimal "," and separator ";") """
+    return irradiance(rows, seed).to_csv(index=False, decimal=',', sep=';')
+
+
+def sensors(rows: int, seed: int = 0) -> pd.DataFrame:
+    df = readings(rows, seed)
+    return df.reset_index(names='Timestamp').assign(Timestamp=lambda df: df['Timestamp'].dt.strftime(TIMESTAMP_FORMAT))
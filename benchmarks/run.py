@@ -0,0 +1,137 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from typing import Any, Callable, Optional
+
+from benchmarks import cases, data
+
+"""
+    Runs the benchmark suites and saves their timings to JSON
+
+    python -m benchmarks.run --output benchmarks/results.json
+    python -m benchmarks.run --suites operations --sizes 10000000 --output big.json
+    python -m benchmarks.run --compare benchmarks/baseline.json
+
+    With --compare, every case is matched (suite, name and rows) against a previous run
+    and the run fails (exit code 1) if its median got slower than the tolerance allows.
+"""
+
+SUITES = list(cases.SUITE_SIZES)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description='Benchmarks operations, /file requests and the reference irradiance processor')
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=SUITES)
+    parser.add_argument('--sizes', nargs='+', type=lambda size: int(float(size)), help=f'rows of the generated data, default depends on the suite {cases.SUITE_SIZES}')
+    parser.add_argument('--only', nargs='+', help='names of the cases to run (e.g. SORT_COLUMN)')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1], help='workers of the reference processor on the irradiance suite, cases with more than one are named "<step>[workers=<n>]"')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each case, the median is compared')
+    parser.add_argument('--output', help='JSON file the results are written to')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown accepted before a case is flagged')
+    parser.add_argument('--min-seconds', type=float, default=0.005, help='slowdowns below this many seconds are never flagged (timer noise)')
+    args = parser.parse_args(argv)
+
+    results = []
+    for suite in args.suites:
+        for rows in args.sizes or cases.SUITE_SIZES[suite]:
+            results += run_suite(suite, rows, args.repeat, args.only, args.workers)
+
+    report = {'environment': environment(), 'results': results}
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as file: json.dump(report, file, indent=2)
+        print(f'results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as file: baseline = json.load(file)
+        regressions = compare(baseline['results'], results, args.tolerance, args.min_seconds)
+        if len(regressions): return 1
+    return 0
+
+
+def run_suite(suite: str, rows: int, repeat: int, only: Optional[list[str]], workers: list[int] = [1]) -> list[dict]:
+    if suite == 'irradiance': return [entry for count in workers for entry in run_irradiance(rows, repeat, only, count)]
+
+    results = []
+    # Timed with copy-on-write, as the app runs them (see copy_on_write on app/main.py)
+    with pd.option_context('mode.copy_on_write', True):
+        for name, setup, run in (cases.operation_cases() if suite == 'operations' else cases.request_cases()):
+            if only and name not in only: continue
+            source = setup(rows)
+            results.append(result(suite, name, rows, [timed(run, source) for _ in range(repeat)]))
+    return results
+
+
+def run_irradiance(rows: int, repeat: int, only: Optional[list[str]], workers: int = 1) -> list[dict]:
+    csv = data.irradiance_csv(rows)
+    timings: dict[str, list[float]] = {}
+    for _ in range(repeat):
+        # Steps change the processor, so each repetition runs all of them again on a new one
+        # The processor prints its progress, and substitutes values by chained assignment, which does nothing with copy-on-write
+        # (turned on for the whole process once the requests suite imported the app)
+        with contextlib.redirect_stdout(io.StringIO()), pd.option_context('mode.copy_on_write', False):
+            for name, step in cases.irradiance_steps(csv, workers):
+                timings.setdefault(name, []).append(timed(lambda _: step(), None))
+    suffix = f'[workers={workers}]' if workers > 1 else ''
+    return [result('irradiance', name + suffix, rows, seconds) for name, seconds in timings.items() if not only or name in only]
+
+
+def timed(run: Callable[[Any], Any], source: Any) -> float:
+    start = time.perf_counter()
+    run(source)
+    return time.perf_counter() - start
+
+
+def result(suite: str, name: str, rows: int, seconds: list[float]) -> dict:
+    entry = {'suite': suite, 'name': name, 'rows': rows, 'repeat': len(seconds), 'min': min(seconds), 'median': statistics.median(seconds), 'max': max(seconds)}
+    print(f'{suite:<12} {name:<34} {rows:>10,} rows  median {entry["median"]:>10.4f}s  min {entry["min"]:>10.4f}s', flush=True)
+    return entry
+
+
+def compare(baseline: list[dict], results: list[dict], tolerance: float, min_seconds: float) -> list[dict]:
+    """ Prints how every case changed from the baseline, returns the ones that got slower than the tolerance """
+    previous = {(entry['suite'], entry['name'], entry['rows']): entry for entry in baseline}
+    regressions = []
+    print(f'\ncompared to baseline (tolerance {tolerance:.0%}):')
+    for entry in results:
+        before = previous.get((entry['suite'], entry['name'], entry['rows']))
+        if before is None: continue
+
+        ratio = entry['median'] / before['median'] if before['median'] else float('inf')
+        regressed = ratio > 1 + tolerance and entry['median'] - before['median'] > min_seconds
+        if regressed: regressions.append(entry)
+        flag = 'REGRESSION' if regressed else ''
+        print(f'{entry["suite"]:<12} {entry["name"]:<34} {entry["rows"]:>10,} rows  {before["median"]:>10.4f}s -> {entry["median"]:>10.4f}s  x{ratio:.2f}  {flag}')
+
+    print(f'{len(regressions)} regression(s)')
+    return regressions
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': time.time(),
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,7 +9,9 @@ Created on Thu Apr 13 14:44:26 2023
 from enum import StrEnum
 from datetime import timedelta
 import pandas as pd
-from typing import Type, Callable
+from typing import Type, Callable, Optional
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 import io
 
 # Ignoring deprecation warnings, which can confuse the code messages being generated
@@ -123,10 +125,17 @@ class IrradianceProcessor(object):
     original_dataframe: pd.DataFrame
     processed_dataframe: pd.DataFrame
     dataframe_dictionary: dict[Type[NEW_COLUMN_NAMES], pd.DataFrame]
+    workers: int # Sensors processed at the same time by each main method (1 runs them one after the other)
+    pool: str # 'process' or 'thread' (auxiliar methods loop over rows in python, so only processes run them truly in parallel)
+    executor: Optional[Executor]
     
     """ Initalizes list of existing Operations """
-    def __init__(self, dir: str | io.StringIO, decimal: str, sep: str):
+    def __init__(self, dir: str | io.StringIO, decimal: str, sep: str, workers: int = 1, pool: str = 'process'):
+        if pool not in ('process', 'thread'): raise ValueError('pool must be "process" or "thread"')
         self.executables = []
+        self.workers = workers
+        self.pool = pool
+        self.executor = None
         self.open_csv(dir=dir, decimal=decimal, sep=sep)
         return None
         
@@ -144,11 +153,29 @@ class IrradianceProcessor(object):
         
     """ Executes functions and concatenates dataframe map into a single dataframe """
     def execute_functions(self) -> pd.DataFrame:
-        for executable in self.executables:
-            if len(executable.args) > 0: executable.function(**executable.args)
-            else: executable.function()
+        # The same pool of workers is used by every function
+        with self.open_pool():
+            for executable in self.executables:
+                if len(executable.args) > 0: executable.function(**executable.args)
+                else: executable.function()
         self.concat_df_map()
         return self.processed_dataframe
+    
+    """ Starts the pool of workers used by the main methods until the context ends (nothing is started if there is a single worker or a pool already) """
+    @contextmanager
+    def open_pool(self):
+        
+        if self.workers <= 1 or self.executor is not None:
+            yield self.executor
+            return
+        
+        executor_type = ProcessPoolExecutor if self.pool == 'process' else ThreadPoolExecutor
+        with executor_type(max_workers=self.workers) as executor:
+            self.executor = executor
+            try:
+                yield executor
+            finally:
+                self.executor = None
         
     """ Separates original dataframe into a map of sensor data """
     def separate_dataframes(self):
@@ -169,7 +196,7 @@ class IrradianceProcessor(object):
     def clean_and_reindex_all(self):
         
         print('Cleaning and reindexing dataframes ...')
-        for key in self.dataframe_dictionary: self.dataframe_dictionary[key] = self._clean_and_reindex(self.dataframe_dictionary[key])
+        self._run_all('_clean_and_reindex', {key: (df,) for key, df in self.dataframe_dictionary.items()})
     
     """ Fills NAN values for all dataframes, with corresponding values from equivalent sensors or near values """
     def fill_missing_all(self):
@@ -182,12 +209,10 @@ class IrradianceProcessor(object):
         new_timestamps = pd.date_range(boundaries['start'], boundaries['end'], freq=" 1min")
         
         # Fill indexes with new complete timestamps
-        for key in self.dataframe_dictionary:
-            self.dataframe_dictionary[key] = self._complete_timestamps(self.dataframe_dictionary[key], new_timestamps)
+        self._run_all('_complete_timestamps', {key: (df, new_timestamps) for key, df in self.dataframe_dictionary.items()})
         
         # Fills missing data in each dataframe
-        for key in self.dataframe_dictionary:
-            self.dataframe_dictionary[key] = self._fill_missing(key, self.dataframe_dictionary[key], self.dataframe_dictionary[SENSOR_EQUIVALENTS[key]])
+        self._run_all_equivalents('_fill_missing', {key: () for key in self.dataframe_dictionary})
     
     """ 
     Removes rows with indexes before initial time and after ending time from all dataframes 
@@ -196,7 +221,7 @@ class IrradianceProcessor(object):
     def remove_all_meaningless_timestamps(self, initial_time, ending_time):
         
         print('Removing useless timestamps ...')
-        for key in self.dataframe_dictionary: self.dataframe_dictionary[key] = self._remove_meaningless_timestamps(self.dataframe_dictionary[key], initial_time, ending_time)
+        self._run_all('_remove_meaningless_timestamps', {key: (df, initial_time, ending_time) for key, df in self.dataframe_dictionary.items()})
     
     class ClipRules():
         lower_value: float
@@ -210,34 +235,33 @@ class IrradianceProcessor(object):
     def clip_range_all(self, specific_rules: dict[Type[SENSOR_NAMES], ClipRules], rules: ClipRules):
         
         print('Clipping out of boundaries values ...')
-        for key in self.dataframe_dictionary:
-            if len(specific_rules) > 0 and key in specific_rules:
-                self.dataframe_dictionary[key] = self._clip_range(self.dataframe_dictionary[key], lower_value=specific_rules[key].lower_value, upper_value=specific_rules[key].upper_value)
-            else:
-                self.dataframe_dictionary[key] = self._clip_range(self.dataframe_dictionary[key], lower_value=rules.lower_value, upper_value=rules.upper_value)
+        arguments = {}
+        for key, df in self.dataframe_dictionary.items():
+            key_rules = specific_rules[key] if len(specific_rules) > 0 and key in specific_rules else rules
+            arguments[key] = (df, key_rules.lower_value, key_rules.upper_value)
+        self._run_all('_clip_range', arguments)
     
     """ Finds and substitutes all stagnant values across all dataframes for a given frequency window """
     def fix_all_stagnant_data(self, frequency: int, threshold: float):
         
         print('Replacing stagnant data ...')
-        for key in self.dataframe_dictionary: self.dataframe_dictionary[key] = self._fix_stagnant_data(key, self.dataframe_dictionary[key], self.dataframe_dictionary[SENSOR_EQUIVALENTS[key]], frequency, threshold)
+        self._run_all_equivalents('_fix_stagnant_data', {key: (frequency, threshold) for key in self.dataframe_dictionary})
     
     
     """ Finds and substitutes values where abrupt changes where detected over a threshold on all dataframes """
     def fix_all_abrupt_changes(self, specific_rules: dict[SENSOR_NAMES, int], threshold: int):
         
         print('Fixing abrupt changes ...')
-        for key in self.dataframe_dictionary: 
-            if len(specific_rules) > 0 and key in specific_rules:
-                self.dataframe_dictionary[key] = self._fix_abrupt_changes(key, dataframe=self.dataframe_dictionary[key], equivalent_dataframe=self.dataframe_dictionary[SENSOR_EQUIVALENTS[key]], threshold=specific_rules[key])
-            else:
-                self.dataframe_dictionary[key] = self._fix_abrupt_changes(key, self.dataframe_dictionary[key], self.dataframe_dictionary[SENSOR_EQUIVALENTS[key]], threshold)
+        arguments = {}
+        for key in self.dataframe_dictionary:
+            arguments[key] = (specific_rules[key] if len(specific_rules) > 0 and key in specific_rules else threshold,)
+        self._run_all_equivalents('_fix_abrupt_changes', arguments)
     
     """ Finds and substitutes all incorrect zeroes from all dataframes comparing with equivalent dataframes """
     def remove_all_incorrect_zeroes(self):
         
         print('Removing incorrect zeroes ...')
-        for key in self.dataframe_dictionary: self.dataframe_dictionary[key] = self._remove_incorrect_zeroes(key, self.dataframe_dictionary[key], self.dataframe_dictionary[SENSOR_EQUIVALENTS[key]])
+        self._run_all_equivalents('_remove_incorrect_zeroes', {key: () for key in self.dataframe_dictionary})
     
     """ Concatenates dataframe map into a single dataframe in which the column names are the sensor names """
     def concat_df_map(self):
@@ -414,6 +438,51 @@ class IrradianceProcessor(object):
     General Methods
     """
     
+    """
+    Runs an auxiliar method for every sensor (arguments of each one by key), on the pool of workers if there is more than one
+    Obs.: Only for methods that do not read other sensors, dataframes are replaced once every sensor is done
+    """
+    def _run_all(self, method: str, arguments: dict[Type[SENSOR_NAMES], tuple]):
+        
+        with self.open_pool() as executor:
+            if executor is None:
+                results = {key: _run_auxiliar(method, *args) for key, args in arguments.items()}
+            else:
+                futures = {key: executor.submit(_run_auxiliar, method, *args) for key, args in arguments.items()}
+                results = {key: future.result() for key, future in futures.items()}
+        
+        self.dataframe_dictionary.update(results)
+    
+    """
+    Runs an auxiliar method that reads the equivalent sensor, called as method(key, dataframe, equivalent_dataframe, *arguments[key])
+    Obs.: The result is the same as running the sensors one after the other, in the order of the dictionary:
+    a sensor reads its equivalent already processed if the equivalent comes before it (e.g. PIR2 is filled from the filled PIR1),
+    and as it was before the stage otherwise. Sensors that depend on each other are run one after the other on the same worker,
+    only the independent groups (e.g. PIR1 and PIR2, PIR5 and PIR7, each sensor that is its own equivalent) run in parallel.
+    """
+    def _run_all_equivalents(self, method: str, arguments: dict[Type[SENSOR_NAMES], tuple]):
+        
+        order = list(self.dataframe_dictionary)
+        # Each sensor joins the group of the equivalent it has to wait for
+        groups: dict[Type[SENSOR_NAMES], list] = {}
+        group_of: dict[Type[SENSOR_NAMES], Type[SENSOR_NAMES]] = {}
+        for key in order:
+            equivalent = SENSOR_EQUIVALENTS[key]
+            waits = equivalent != key and equivalent in group_of
+            group_of[key] = group_of[equivalent] if waits else key
+            # Equivalents that come later are read as they are now (they are only changed on copies)
+            before = None if equivalent == key or waits else self.dataframe_dictionary[equivalent]
+            groups.setdefault(group_of[key], []).append((key, self.dataframe_dictionary[key], equivalent, before, arguments[key]))
+        
+        with self.open_pool() as executor:
+            if executor is None:
+                results = [_run_equivalents(method, sensors) for sensors in groups.values()]
+            else:
+                futures = [executor.submit(_run_equivalents, method, sensors) for sensors in groups.values()]
+                results = [future.result() for future in futures]
+        
+        for result in results: self.dataframe_dictionary.update(result)
+    
     """ Substitutes one value by index from a dataframe for the same index from another dataframe """
     def _substitute(self, index: pd.Index, dataframe: pd.DataFrame, equivalent_dataframe: pd.DataFrame) -> pd.DataFrame:
         
@@ -430,3 +499,20 @@ class IrradianceProcessor(object):
         
         return dataframe
     
+
+
+""" Runs an auxiliar method on a processor without any data (module level, so process pools only send the method's own arguments to the workers) """
+def _run_auxiliar(method: str, *args):
+    return getattr(IrradianceProcessor.__new__(IrradianceProcessor), method)(*args)
+
+""" 
+Runs an auxiliar method for a group of sensors in order, each one reading the processed dataframe of the equivalents before it
+Obs.: Methods substitute values in place, so each dataframe is copied first (a sensor that is its own equivalent reads its own copy, as it did in place)
+"""
+def _run_equivalents(method: str, sensors: list[tuple]):
+    done = {}
+    for key, dataframe, equivalent, before, args in sensors:
+        dataframe = dataframe.copy()
+        equivalent_dataframe = dataframe if equivalent == key else done[equivalent] if before is None else before
+        done[key] = _run_auxiliar(method, key, dataframe, equivalent_dataframe, *args)
+    return done
@@ -3,6 +3,9 @@ from irradiance_processor import IrradianceProcessor, CSV, NEW_CSV, MEAN_CSV, SE
 def run(ip: IrradianceProcessor):
     # Creates instance of data processor
     # ip = IrradianceProcessor(dir=CSV, decimal=',', sep=';')
+    # Sensors may be processed in parallel by each step with a pool of workers (processes by default)
+    # Equivalent sensors (e.g. PIR1 and PIR2) still run one after the other, so there are at most 6 groups to run at the same time
+    # ip = IrradianceProcessor(dir=CSV, decimal=',', sep=';', workers=6, pool='process')
 
     # Separates original dataframe into a map of sensor data
     ip.add_func(ip.separate_dataframes)